@@ -0,0 +1,101 @@
+"""Measure the per-event overhead of parsing and routing API Gateway events
+
+Run from the root of the repository with
+
+    python -m benchmarks.bench_event_parsing [notifications per batch]
+
+The cost of finding the authorization header, decoding the body into
+notifications and choosing a response is compared for the original
+lower-cased header copy, json.loads of dictionaries and chain of path
+comparisons, and the Notification records, route table and static responses
+used now. Verifying the token and processing the notifications are left out
+as both paths do the same work for them. The decoder is orjson when it's
+installed.
+"""
+import json
+import sys
+import timeit
+
+from functions.auth0_cis_webhook_consumer import app
+from functions.auth0_cis_webhook_consumer.notifications import (
+    hash_token,
+    parse_notifications
+)
+from functions.auth0_cis_webhook_consumer.profiles import json_loads
+
+
+def legacy_route(event):
+    """The request handling from before the route table, kept as a baseline"""
+    headers = (
+        {x.lower(): event['headers'][x] for x in event['headers']}
+        if event['headers'] is not None else {})
+    authorization = headers.get('authorization')
+    body = json.loads(event['body'])
+    if event.get('path') == '/error':
+        return {'headers': {'Content-Type': 'text/html'}, 'statusCode': 400,
+                'body': 'error'}
+    elif event.get('path') == '/test':
+        return {'headers': {'Content-Type': 'text/html'}, 'statusCode': 200,
+                'body': 'API request received'}
+    elif event.get('path') == '/post':
+        notifications = body if isinstance(body, list) else [body]
+        parsed = [
+            (notification.get('id'), notification.get('operation'))
+            if isinstance(notification, dict) else (None, None)
+            for notification in notifications]
+        return authorization, parsed, {
+            'headers': {'Content-Type': 'text/html'}, 'statusCode': 200,
+            'body': 'Update succeeded'}
+    return {'headers': {'Content-Type': 'text/html'}, 'statusCode': 404,
+            'body': 'not found'}
+
+
+def current_route(event):
+    """process_api_call with the /post route stopped before verification"""
+    return app.process_api_call(event, None)
+
+
+def parse_post(event, context, authorization):
+    notifications, _ = parse_notifications(
+        event['body'], hash_token(authorization))
+    return app.UPDATE_SUCCEEDED_RESPONSE
+
+
+def build_event(path, body):
+    return {
+        'resource': '/{proxy+}', 'path': path, 'httpMethod': 'POST',
+        'headers': {
+            'Accept': '*/*', 'Authorization': 'Bearer ' + 'x' * 800,
+            'Content-Type': 'application/json', 'Host': 'example.com',
+            'User-Agent': 'python-requests/2.32', 'X-Amzn-Trace-Id': 'Root=1',
+            'X-Forwarded-For': '192.0.2.1', 'X-Forwarded-Port': '443',
+            'X-Forwarded-Proto': 'https', 'CloudFront-Is-Mobile-Viewer': 'false',
+            'CloudFront-Viewer-Country': 'US', 'Via': '1.1 example'},
+        'body': json.dumps(body)}
+
+
+def main():
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    app.ROUTES['/post'] = parse_post
+    notification = {'id': 'ad|Mozilla-LDAP|jdoe', 'operation': 'update',
+                    'time': 1700000000}
+    events = [
+        ('/test', build_event('/test', notification)),
+        ('/post single', build_event('/post', notification)),
+        ('/post batch of {}'.format(batch_size), build_event(
+            '/post', [dict(notification, id='user{}'.format(i))
+                      for i in range(batch_size)])),
+    ]
+    print('Decoding with {}'.format(json_loads.__module__))
+    for name, event in events:
+        for label, function in (('legacy', legacy_route),
+                                ('current', current_route)):
+            runs = 2000
+            best = min(timeit.repeat(
+                lambda: function(event), number=runs, repeat=5)) / runs
+            print('{:<20} {:<8} {:9.2f} us per event'.format(
+                name, label, best * 1e6))
+
+
+if __name__ == '__main__':
+    main()
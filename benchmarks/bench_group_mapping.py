@@ -0,0 +1,81 @@
+"""Measure the cost of mapping a profile's access_information to Auth0 groups
+
+Run from the root of the repository with
+
+    python -m benchmarks.bench_group_mapping [groups per publisher]
+
+Synthetic profiles with many publishers and thousands of groups are mapped
+by the original if/elif implementation, by GroupMapper with the default rules
+and by GroupMapper with include, exclude, regex and rename rules.
+"""
+import sys
+import timeit
+
+from functions.auth0_cis_webhook_consumer.group_mapping import GroupMapper
+
+
+def legacy_access_groups(profile):
+    """The group computation from before GroupMapper, kept as a baseline"""
+    access_groups = []
+    for publisher_name, data in profile.get(
+            'access_information', {}).items():
+        if data.get('values') is None:
+            continue
+        for value in data['values']:
+            if publisher_name == 'ldap':
+                access_groups.append(value)
+            elif publisher_name == 'hris':
+                continue
+            elif publisher_name == 'access_provider':
+                continue
+            else:
+                access_groups.append('_'.join([publisher_name, value]))
+    return access_groups
+
+
+def build_profile(groups_per_publisher):
+    return {'access_information': {
+        'ldap': {'values': {
+            'team_{}'.format(i): None for i in range(groups_per_publisher)}},
+        'hris': {'values': {
+            'field_{}'.format(i): str(i) for i in range(100)}},
+        'access_provider': {'values': {
+            'provider_{}'.format(i): None for i in range(100)}},
+        'mozilliansorg': {'values': {
+            'group_{}'.format(i): None for i in range(groups_per_publisher)}},
+        'github': {'values': {
+            'org_{}/team'.format(i): None
+            for i in range(groups_per_publisher)}}}}
+
+
+def main():
+    groups_per_publisher = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    profile = build_profile(groups_per_publisher)
+    default_mapper = GroupMapper()
+    filtered_mapper = GroupMapper({
+        'ldap': {'prefix': '', 'exclude_regex': '_1',
+                 'rename': {'team_0': 'team_zero'}},
+        'mozilliansorg': {'include': [
+            'group_{}'.format(i) for i in range(0, groups_per_publisher, 2)]},
+        'hris': {'enabled': False},
+        'access_provider': {'enabled': False},
+        '*': {'include_regex': '^org_[0-9]*5/'}})
+    assert (legacy_access_groups(profile)
+            == default_mapper.map(profile['access_information']))
+    candidates = [
+        ('legacy if/elif', lambda: legacy_access_groups(profile)),
+        ('GroupMapper default', lambda: default_mapper.map(
+            profile['access_information'])),
+        ('GroupMapper filtered', lambda: filtered_mapper.map(
+            profile['access_information'])),
+    ]
+    print('{} groups per publisher, {} groups in total'.format(
+        groups_per_publisher, len(legacy_access_groups(profile))))
+    for name, function in candidates:
+        runs = 200
+        best = min(timeit.repeat(function, number=runs, repeat=5)) / runs
+        print('{:<22} {:9.1f} us per profile'.format(name, best * 1e6))
+
+
+if __name__ == '__main__':
+    main()
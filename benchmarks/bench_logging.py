@@ -0,0 +1,107 @@
+"""Measure the per-event cost of logging on the hot path
+
+Run from the root of the repository with
+
+    python -m benchmarks.bench_logging [events]
+
+The statements logged for each notification, a DEBUG and an INFO record
+with a few arguments, are timed for the original setup of eagerly built
+.format() messages written synchronously as text, and for lazy %-style
+messages through the JSON, redacting and sampling setup used now, written
+synchronously (the default) and through the LOG_ASYNC queue, at LOG_LEVEL
+INFO and DEBUG. Records are written to /dev/null. Both the time until the
+logging calls return and the time until every record has been written,
+which is what an invocation waits for as the queue is drained before it
+returns, are reported.
+"""
+import logging
+import os
+import sys
+import time
+
+from functions.auth0_cis_webhook_consumer import structured_logging
+
+USER_ID = 'ad|Mozilla-LDAP|jdoe'
+GROUPS = ['mozilliansorg_{}'.format(i) for i in range(20)]
+URL = 'https://auth.example.com/api/v2/users/ad%7CMozilla-LDAP%7Cjdoe'
+
+
+def legacy_events(log, count):
+    for _ in range(count):
+        log.debug('Fetching user profile for {} with groups {}'.format(
+            USER_ID, GROUPS))
+        log.info('Auth0 Management API profile update succeeded {}'.format(
+            URL))
+
+
+def lazy_events(log, count):
+    for _ in range(count):
+        log.debug('Fetching user profile for %s with groups %s',
+                  USER_ID, GROUPS)
+        log.info('Auth0 Management API profile update succeeded %s', URL)
+
+
+def configure_legacy(level, stream):
+    logging.logThreads = True
+    logging.logProcesses = True
+    logging.logMultiprocessing = True
+    root = logging.getLogger()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter(fmt=structured_logging.TEXT_FORMAT))
+    root.addHandler(handler)
+    root.setLevel(level)
+
+
+def measure(configure, events, count):
+    root = logging.getLogger()
+    with open(os.devnull, 'w') as stream:
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        root.addHandler(logging.StreamHandler(stream))
+        configure(stream)
+        log = logging.getLogger('bench')
+        caller = written = None
+        for _ in range(5):
+            start = time.perf_counter()
+            events(log, count)
+            returned = time.perf_counter()
+            structured_logging.flush_logs()
+            finished = time.perf_counter()
+            caller = min(caller or returned - start, returned - start)
+            written = min(written or finished - start, finished - start)
+        structured_logging.stop_logging()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+    return caller / count, written / count
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    setups = []
+    for level in ('INFO', 'DEBUG'):
+        setups.append(('legacy text', level, legacy_events,
+                       lambda stream, level=level: configure_legacy(
+                           level, stream)))
+        setups.append((
+            'json sync', level, lazy_events,
+            lambda stream, level=level:
+            structured_logging.configure_logging({
+                'level': level, 'format': 'json',
+                'debug_sample_rate': 1.0, 'async': False})))
+        for rate in ((1.0, 0.1) if level == 'DEBUG' else (1.0,)):
+            setups.append((
+                'json queued sample {}'.format(rate), level, lazy_events,
+                lambda stream, level=level, rate=rate:
+                structured_logging.configure_logging({
+                    'level': level, 'format': 'json',
+                    'debug_sample_rate': rate, 'async': True})))
+    print('{:<24} {:<6} {:>9} {:>9}  us per event'.format(
+        'setup', 'level', 'caller', 'written'))
+    for name, level, events, configure in setups:
+        caller, written = measure(configure, events, count)
+        print('{:<24} {:<6} {:9.2f} {:9.2f}'.format(
+            name, level, caller * 1e6, written * 1e6))
+
+
+if __name__ == '__main__':
+    main()
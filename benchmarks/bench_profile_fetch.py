@@ -0,0 +1,133 @@
+"""Measure the CPU time and memory of fetching and decoding a CIS profile
+
+Run from the root of the repository with
+
+    python -m benchmarks.bench_profile_fetch [iterations] [groups]
+
+A synthetic CIS v2 profile, with metadata and signature blocks on every
+attribute and many groups, is served by a local stub PersonAPI. Each mode
+fetches it with the pooled session and decodes it
+
+* legacy : response.json() called twice, as get_user_profile used to
+* decode : read_profile decoding the body once and pruning it
+* stream : read_profile parsing the body incrementally with ijson
+
+CPU time is measured for the calling thread only, so the stub server's work
+isn't counted. Peak is the most memory allocated during a fetch and retained
+is the size of the profile kept afterwards.
+"""
+import base64
+import json
+import statistics
+import sys
+import time
+import tracemalloc
+
+from functions.auth0_cis_webhook_consumer.profiles import ijson, read_profile
+from functions.auth0_cis_webhook_consumer.sessions import (
+    http_request,
+    close_sessions
+)
+from .stub_server import StubServer
+
+
+def attribute(value):
+    return {
+        'value': value,
+        'metadata': {
+            'classification': 'PUBLIC', 'last_modified': '2020-01-01T00:00:00Z',
+            'created': '2020-01-01T00:00:00Z', 'publisher_authority': 'mozilliansorg',
+            'verified': True, 'display': 'staff'},
+        'signature': {
+            'publisher': {'alg': 'RS256', 'typ': 'JWS', 'name': 'mozilliansorg',
+                          'value': base64.b64encode(bytes(256)).decode()},
+            'additional': [{'alg': 'RS256', 'typ': 'JWS', 'name': 'access_provider',
+                            'value': base64.b64encode(bytes(256)).decode()}]}}
+
+
+def build_profile(groups):
+    profile = {name: attribute('value of {}'.format(name)) for name in (
+        'uuid', 'user_id', 'login_method', 'active', 'last_modified',
+        'created', 'usernames', 'primary_username', 'first_name',
+        'last_name', 'alternative_name', 'primary_email', 'pronouns',
+        'fun_title', 'description', 'location', 'timezone', 'languages',
+        'tags', 'pgp_public_keys', 'ssh_public_keys', 'picture',
+        'phone_numbers', 'uris')}
+    profile['identities'] = {
+        name: attribute(name) for name in (
+            'github_id_v3', 'github_id_v4', 'github_primary_email',
+            'mozilliansorg_id', 'bugzilla_mozilla_org_id',
+            'bugzilla_mozilla_org_primary_email', 'mozilla_ldap_id',
+            'mozilla_ldap_primary_email', 'mozilla_posix_id',
+            'google_oauth2_id', 'google_primary_email', 'firefox_accounts_id',
+            'firefox_accounts_primary_email')}
+    profile['staff_information'] = {
+        name: attribute(name) for name in (
+            'manager', 'director', 'staff', 'title', 'team', 'cost_center',
+            'worker_type', 'wpr_desk_number', 'office_location')}
+    profile['access_information'] = {
+        publisher: dict(attribute(None), values={
+            '{}_group_{}'.format(publisher, i): None for i in range(groups)})
+        for publisher in ('ldap', 'mozilliansorg', 'access_provider')}
+    profile['access_information']['hris'] = dict(
+        attribute(None), values={'employee_id': '1234', 'worker_type': 'x'})
+    return profile
+
+
+def legacy(url):
+    response = http_request('GET', url=url)
+    if response.ok and response.json().get('uuid', {}).get('value'):
+        return response.json()
+
+
+def decode(url):
+    return read_profile(http_request('GET', url=url))
+
+
+def stream(url):
+    return read_profile(http_request('GET', url=url, stream=True), True)
+
+
+def measure(call, url, iterations):
+    cpu = []
+    peaks = []
+    retained = []
+    call(url)
+    for _ in range(iterations):
+        start = time.thread_time()
+        call(url)
+        cpu.append((time.thread_time() - start) * 1000)
+    for _ in range(max(iterations // 10, 3)):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        profile = call(url)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peaks.append(peak - before)
+        retained.append(current - before)
+        del profile
+    return statistics.median(cpu), statistics.median(peaks), statistics.median(
+        retained)
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    groups = int(sys.argv[2]) if len(sys.argv) > 2 else 600
+    body = json.dumps(build_profile(groups)).encode('utf-8')
+    routes = {('GET', '/'): lambda handler: (200, {}, body)}
+    modes = [('legacy', legacy), ('decode', decode)]
+    if ijson is not None:
+        modes.append(('stream', stream))
+    else:
+        print('ijson is not installed, skipping stream')
+    print('Profile size {:.0f} KB'.format(len(body) / 1024))
+    with StubServer(routes) as server:
+        for name, call in modes:
+            cpu, peak, retained = measure(call, server.url + '/', iterations)
+            print('{:<7} cpu {:7.3f} ms  peak {:8.1f} KB  retained '
+                  '{:8.1f} KB'.format(name, cpu, peak / 1024, retained / 1024))
+    close_sessions()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""Simulate several containers writing to a ratelimited Auth0 Management API
+
+Run from the root of the repository with
+
+    python -m benchmarks.bench_ratelimit [requests] [rate] [burst]
+
+A stub Management API enforces a token bucket of `burst` requests refilling
+at `rate` requests per second and returns Auth0's X-RateLimit headers. Four
+simulated containers, each with two threads, send updates through
+send_auth0_update in three modes
+
+* reactive : No client side limiter, only sleeping after a 429
+* local    : A token bucket per container
+* dynamodb : A DynamoDBTokenBucket per container sharing one item in a
+             moto mocked DynamoDB table
+"""
+import math
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from functions.auth0_cis_webhook_consumer import utils
+from functions.auth0_cis_webhook_consumer.ratelimit import (
+    DynamoDBTokenBucket,
+    TokenBucket
+)
+from .stub_server import StubServer
+
+CONTAINERS = 4
+THREADS_PER_CONTAINER = 2
+
+
+class ServerBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+        self.throttled = 0
+        self.accepted = 0
+
+    def __call__(self, handler):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                status = 200
+                self.accepted += 1
+            else:
+                status = 429
+                self.throttled += 1
+            headers = {
+                'X-RateLimit-Limit': self.burst,
+                'X-RateLimit-Remaining': math.floor(self.tokens),
+                'X-RateLimit-Reset': math.ceil(
+                    now + (self.burst - self.tokens) / self.rate)}
+        return status, headers, {}
+
+
+def run(mode, total, rate, burst):
+    bucket = ServerBucket(rate, burst)
+    with StubServer({('PATCH', '/'): bucket}) as server:
+        limiters = [
+            None if mode == 'reactive'
+            else DynamoDBTokenBucket('ratelimit') if mode == 'dynamodb'
+            else TokenBucket()
+            for _ in range(CONTAINERS)]
+        updates = [
+            {'url': server.url + '/api/v2/users/{}'.format(i),
+             'headers': {},
+             'payload': {'app_metadata': {'groups': []}},
+             'rate_limiter': limiters[i % CONTAINERS]}
+            for i in range(total)]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(CONTAINERS * THREADS_PER_CONTAINER) as pool:
+            results = list(pool.map(
+                lambda update: utils.send_auth0_update(
+                    'user', update, lambda: 900000),
+                updates))
+        elapsed = time.perf_counter() - start
+    print('{:<9} {:4d} ok  {:4d} lost  {:5d} 429s  {:6.2f} s  '
+          '{:6.1f} updates/s'.format(
+              mode, sum(results), results.count(False), bucket.throttled,
+              elapsed, sum(results) / elapsed))
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 50
+    burst = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    for mode in ('reactive', 'local'):
+        run(mode, total, rate, burst)
+    import boto3
+    from moto import mock_aws
+    for name, value in (('AWS_DEFAULT_REGION', 'us-west-2'),
+                        ('AWS_ACCESS_KEY_ID', 'fake-access-key'),
+                        ('AWS_SECRET_ACCESS_KEY', 'fake-secret-key')):
+        os.environ.setdefault(name, value)
+    with mock_aws():
+        boto3.client('dynamodb').create_table(
+            TableName='ratelimit',
+            KeySchema=[{'AttributeName': 'id', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[
+                {'AttributeName': 'id', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST')
+        run('dynamodb', total, rate, burst)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Compare one-shot requests calls with the pooled keep-alive sessions
+
+Run from the root of the repository with
+
+    python -m benchmarks.bench_sessions [iterations] [latency_ms]
+
+The stub server can add an artificial delay before accepting each new
+connection to approximate the cost of a TCP and TLS handshake to a remote
+host.
+"""
+import statistics
+import sys
+import time
+
+import requests
+
+from functions.auth0_cis_webhook_consumer.sessions import (
+    http_request,
+    close_sessions
+)
+from .stub_server import StubServer
+
+
+def run(label, call, url, iterations):
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        call(url)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    print('{:<10} mean {:7.3f} ms  p50 {:7.3f} ms  p99 {:7.3f} ms'.format(
+        label,
+        statistics.mean(timings),
+        timings[len(timings) // 2],
+        timings[int(len(timings) * 0.99) - 1]))
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    handshake_delay = (
+        float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.005)
+    routes = {('GET', '/'): lambda handler: (200, {}, {'uuid': 'x'})}
+    with StubServer(routes) as server:
+        original_setup = server.server.RequestHandlerClass.setup
+
+        def slow_setup(handler):
+            time.sleep(handshake_delay)
+            original_setup(handler)
+
+        server.server.RequestHandlerClass.setup = slow_setup
+        url = server.url + '/v2/user/user_id/test'
+        server.connection_count = 0
+        run('requests', lambda u: requests.get(u, timeout=10), url,
+            iterations)
+        print('           connections opened : {}'.format(
+            server.connection_count))
+        server.connection_count = 0
+        run('pooled', lambda u: http_request('GET', u), url, iterations)
+        print('           connections opened : {}'.format(
+            server.connection_count))
+        close_sessions()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""Measure cold start import time and the latency of the first response
+
+Run from the root of the repository with
+
+    python -m benchmarks.bench_startup [runs]
+
+Each run starts a fresh Python interpreter, imports the Lambda handler and
+serves a single /test request, the same work a new Lambda container does
+before its first response.
+"""
+import json
+import statistics
+import subprocess
+import sys
+
+CHILD = '''
+import json, sys, time
+start = time.perf_counter()
+from functions.auth0_cis_webhook_consumer import app
+imported = time.perf_counter()
+app.lambda_handler(
+    {'resource': '/{proxy+}', 'httpMethod': 'POST', 'path': '/test',
+     'headers': {}, 'body': '{}'}, None)
+responded = time.perf_counter()
+print(json.dumps({
+    'import': (imported - start) * 1000,
+    'first_response': (responded - imported) * 1000,
+    'boto3': 'boto3' in sys.modules,
+    'jose': 'jose' in sys.modules}))
+'''
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    # The handler writes its EMF metrics to stdout before the results line
+    results = [
+        json.loads(subprocess.run(
+            [sys.executable, '-c', CHILD],
+            capture_output=True, check=True, text=True
+        ).stdout.splitlines()[-1])
+        for _ in range(runs)]
+    for name in ('import', 'first_response'):
+        timings = sorted(result[name] for result in results)
+        print('{:<15} mean {:8.3f} ms  min {:8.3f} ms  max {:8.3f} ms'.format(
+            name, statistics.mean(timings), timings[0], timings[-1]))
+    print('boto3 imported : {}'.format(results[0]['boto3']))
+    print('jose imported  : {}'.format(results[0]['jose']))
+
+
+if __name__ == '__main__':
+    main()
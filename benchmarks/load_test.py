@@ -0,0 +1,325 @@
+"""Fire signed CIS webhooks at lambda_handler against local stub upstreams
+
+Run from the root of the repository with
+
+    python -m benchmarks.load_test --rate 50 --duration 10
+
+Stub servers stand in for the CIS notification discovery document and JWKS,
+the Auth0 token endpoint, the PersonAPI and the Auth0 Management API of
+each target tenant. Each can add latency and return errors, and each
+Management API enforces its own token bucket ratelimit with Auth0's
+X-RateLimit headers. Client secrets are served by a moto mocked AWS Secrets
+Manager.
+
+Webhooks are sent at a fixed rate, open loop, from a pool of threads that
+share the AWS Lambda global scope like many warm invocations of one
+container would. Latency is measured from when each webhook was scheduled
+so that queueing behind a slow upstream is counted. Run with --help for the
+options.
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+from .stub_server import StubServer
+
+NOTIFICATION_AUDIENCE = 'hook.example.com'
+PERSON_API_AUDIENCE = 'api.example.com'
+MANAGEMENT_API_AUDIENCE = 'management.example.com'
+ENVIRONMENT_NAME = 'loadtest'
+KEY_ID = 'loadtest'
+
+
+class Upstream:
+    """Wrap stub routes with latency, errors and per route call counts
+
+    :param latency: Mean seconds to delay each response by
+    :param error_rate: Fraction of calls answered with a 503
+    """
+
+    def __init__(self, latency: float, error_rate: float):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def route(self, name, route):
+        def wrapper(handler):
+            with self.lock:
+                self.calls[name] += 1
+            if self.latency:
+                time.sleep(random.uniform(0.5, 1.5) * self.latency)
+            if random.random() < self.error_rate:
+                return 503, {}, {'error': 'injected'}
+            return route(handler)
+        return wrapper
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def build_keys():
+    """Create an RSA key to sign webhooks with and its JWKS"""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from jose import jwk
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    private_pem = private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption())
+    public_pem = private_key.public_key().public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo)
+    public_jwk = jwk.construct(public_pem, 'RS256').to_dict()
+    public_jwk.update({'kid': KEY_ID, 'alg': 'RS256', 'use': 'sig'})
+    return private_pem, {'keys': [public_jwk]}
+
+
+def sign_webhook_tokens(private_pem, issuer, count):
+    from jose import jwt
+    now = int(time.time())
+    return [
+        jwt.encode(
+            {'iss': issuer, 'aud': NOTIFICATION_AUDIENCE, 'iat': now,
+             'exp': now + 3600, 'sub': 'cis-webhook-{}'.format(i)},
+            private_pem, algorithm='RS256', headers={'kid': KEY_ID})
+        for i in range(count)]
+
+
+def access_token_route(handler):
+    from jose import jwt
+    token = jwt.encode(
+        {'exp': int(time.time()) + 86400}, 'secret', algorithm='HS256')
+    return 200, {}, {'access_token': token, 'token_type': 'Bearer',
+                     'expires_in': 86400}
+
+
+def create_secrets(targets):
+    import boto3
+    client = boto3.client('secretsmanager')
+    path = '/iam/cis/{}/auth0_cis_webhook_consumer/'.format(ENVIRONMENT_NAME)
+    for name in ['personapi_client_secret', 'management_api_client_secret'] + [
+            'management_api_client_secret_tenant{}'.format(index)
+            for index in range(1, targets)]:
+        client.create_secret(
+            Name=path + name,
+            SecretString=json.dumps({path + name: 'secret'}))
+
+
+def run(args):
+    auth = Upstream(args.auth_latency / 1000, 0)
+    personapi = Upstream(args.latency / 1000, args.error_rate)
+    management = Upstream(args.latency / 1000, args.error_rate)
+    versions = defaultdict(int)
+    writes = Counter()
+    private_pem, jwks = build_keys()
+
+    def profile_route(handler):
+        user_id = handler.path.split('/v2/user/user_id/')[1].split('?')[0]
+        if random.random() < args.change_rate:
+            versions[user_id] += 1
+        version = versions[user_id]
+        return 200, {}, {
+            'uuid': {'value': user_id},
+            'access_information': {
+                'ldap': {'values': {
+                    'team_{}'.format((version + i) % 50): None
+                    for i in range(args.groups)}},
+                'mozilliansorg': {'values': {'nda': None}}}}
+
+    def add_management_routes(server, bucket):
+        def patch_route(handler):
+            status, headers, body = bucket(handler)
+            if status == 200:
+                user_id = handler.path.split('/api/v2/users/')[1]
+                writes[server.url, user_id] += 1
+            return status, headers, body
+
+        server.routes.update({
+            ('GET', '/.well-known/openid-configuration'): management.route(
+                'discovery', lambda handler: (200, {}, {
+                    'issuer': server.url + '/',
+                    'token_endpoint': auth_url + '/oauth/token'})),
+            ('PATCH', '/api/v2/users/'): management.route(
+                'patch', patch_route)})
+
+    auth_server = StubServer({})
+    management_servers = [StubServer({}) for _ in range(args.targets)]
+    auth_url = auth_server.url
+    auth_server.routes.update({
+        ('GET', '/.well-known/mozilla-iam'): auth.route(
+            'discovery', lambda handler: (200, {}, {
+                'oidc_discovery_uri':
+                    auth_url + '/.well-known/openid-configuration'})),
+        ('GET', '/.well-known/openid-configuration'): auth.route(
+            'discovery', lambda handler: (200, {}, {
+                'issuer': auth_url + '/',
+                'jwks_uri': auth_url + '/.well-known/jwks.json',
+                'token_endpoint': auth_url + '/oauth/token'})),
+        ('GET', '/.well-known/jwks.json'): auth.route(
+            'jwks', lambda handler: (200, {}, jwks)),
+        ('POST', '/oauth/token'): auth.route('token', access_token_route)})
+    personapi_server = StubServer({
+        ('GET', '/v2/user/user_id/'): personapi.route('profile', profile_route)})
+
+    os.environ.update({
+        'AWS_DEFAULT_REGION': 'us-west-2',
+        'AWS_ACCESS_KEY_ID': 'loadtest',
+        'AWS_SECRET_ACCESS_KEY': 'loadtest',
+        'ENVIRONMENT_NAME': ENVIRONMENT_NAME,
+        'LOG_LEVEL': os.getenv('LOG_LEVEL', 'CRITICAL'),
+        'METRICS': os.getenv('METRICS', 'none'),
+        'NOTIFICATION_DISCOVERY_URL': auth_url + '/.well-known/mozilla-iam',
+        'NOTIFICATION_AUDIENCE': NOTIFICATION_AUDIENCE,
+        'PERSON_API_DISCOVERY_URL':
+            auth_url + '/.well-known/openid-configuration',
+        'PERSON_API_CLIENT_ID': 'personapi',
+        'PERSON_API_AUDIENCE': PERSON_API_AUDIENCE,
+        'PERSON_API_URL': personapi_server.url,
+        'MANAGEMENT_API_DISCOVERY_URL':
+            management_servers[0].url + '/.well-known/openid-configuration',
+        'MANAGEMENT_API_CLIENT_ID': 'management',
+        'MANAGEMENT_API_AUDIENCE': MANAGEMENT_API_AUDIENCE,
+        'MANAGEMENT_API_TARGETS': json.dumps([{
+            'name': 'tenant{}'.format(index),
+            'client_id': 'management',
+            'audience': MANAGEMENT_API_AUDIENCE,
+            'discovery_url':
+                server.url + '/.well-known/openid-configuration'}
+            for index, server in enumerate(management_servers)
+            if index > 0])})
+    # Config reads the environment when the package is first imported,
+    # which bench_ratelimit does
+    from .bench_ratelimit import ServerBucket
+    buckets = []
+    for server in management_servers:
+        buckets.append(ServerBucket(args.auth0_rate, args.auth0_burst))
+        add_management_routes(server, buckets[-1])
+    from moto import mock_aws
+    with ExitStack() as stack:
+        for context in [mock_aws(), auth_server, personapi_server,
+                        *management_servers]:
+            stack.enter_context(context)
+        create_secrets(args.targets)
+        from functions.auth0_cis_webhook_consumer import app
+        tokens = sign_webhook_tokens(private_pem, auth_url + '/', args.tokens)
+        users = ['ad|Mozilla-LDAP|user{}'.format(i) for i in range(args.users)]
+        total = int(args.rate * args.duration)
+        events = [{
+            'resource': '/{proxy+}', 'path': '/post', 'httpMethod': 'POST',
+            'headers': {'Authorization': 'Bearer ' + random.choice(tokens)},
+            'body': json.dumps({'id': random.choice(users),
+                                'operation': 'update'})}
+            for _ in range(total)]
+        latencies = []
+        service_times = []
+        statuses = Counter()
+        lock = threading.Lock()
+
+        class Context:
+            function_name = 'loadtest'
+
+            def __init__(self):
+                self.deadline = time.time() + 900
+
+            def get_remaining_time_in_millis(self):
+                return int((self.deadline - time.time()) * 1000)
+
+        def invoke(index, event):
+            scheduled = start + index / args.rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            began = time.perf_counter()
+            response = app.lambda_handler(event, Context())
+            finished = time.perf_counter()
+            with lock:
+                latencies.append((finished - scheduled) * 1000)
+                service_times.append((finished - began) * 1000)
+                statuses[response.get('statusCode')] += 1
+
+        if args.warm_up:
+            print('Warm-up {}'.format(
+                app.lambda_handler({'warm': {}}, Context())))
+        start = time.perf_counter() + 0.1
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            list(pool.map(invoke, range(total), events))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    service_times.sort()
+    succeeded = statuses.get(200, 0)
+    print('Sent {} webhooks at {:.0f}/s over {:.1f} s with {} threads'.format(
+        total, args.rate, elapsed, args.concurrency))
+    print('Throughput {:.1f} successful webhooks/s'.format(
+        succeeded / elapsed))
+    print('Status codes {}'.format(dict(sorted(statuses.items()))))
+    for name, values in (('latency', latencies),
+                         ('service time', service_times)):
+        print('{:<13} p50 {:8.1f} ms  p95 {:8.1f} ms  p99 {:8.1f} ms  '
+              'max {:8.1f} ms'.format(
+                  name, percentile(values, 0.5), percentile(values, 0.95),
+                  percentile(values, 0.99), values[-1] if values else 0))
+    for name, upstream in (('auth', auth), ('personapi', personapi),
+                           ('management', management)):
+        print('{:<10} calls {}'.format(name, dict(upstream.calls)))
+    print('Management API 429s {}'.format(
+        sum(bucket.throttled for bucket in buckets)))
+    print('Lost updates {} (webhooks which failed), {} users written to {} '
+          'tenants'.format(total - succeeded, len(writes), args.targets))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rate', type=float, default=50,
+                        help='Webhooks per second (default 50)')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='Seconds to send webhooks for (default 10)')
+    parser.add_argument('--concurrency', type=int, default=32,
+                        help='Threads invoking lambda_handler (default 32)')
+    parser.add_argument('--users', type=int, default=200,
+                        help='Distinct users notified about (default 200)')
+    parser.add_argument('--tokens', type=int, default=10,
+                        help='Distinct signed webhook tokens (default 10)')
+    parser.add_argument('--groups', type=int, default=20,
+                        help='Groups in each profile (default 20)')
+    parser.add_argument('--change-rate', type=float, default=1.0,
+                        help='Fraction of profile fetches which return '
+                             'changed groups (default 1.0)')
+    parser.add_argument('--latency', type=float, default=20,
+                        help='Mean PersonAPI and Management API latency in '
+                             'ms (default 20)')
+    parser.add_argument('--auth-latency', type=float, default=5,
+                        help='Mean discovery, JWKS and token endpoint '
+                             'latency in ms (default 5)')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='Fraction of PersonAPI and Management API calls '
+                             'answered with a 503 (default 0)')
+    parser.add_argument('--auth0-rate', type=float, default=100,
+                        help='Management API ratelimit refill per second '
+                             '(default 100)')
+    parser.add_argument('--auth0-burst', type=int, default=20,
+                        help='Management API ratelimit bucket size '
+                             '(default 20)')
+    parser.add_argument('--targets', type=int, default=1,
+                        help='Auth0 tenants to write every update to, each '
+                             'with its own Management API (default 1)')
+    parser.add_argument('--warm-up', action='store_true',
+                        help='Send a warm-up ping before the webhooks so '
+                             'the first ones find warm caches and '
+                             'connections')
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
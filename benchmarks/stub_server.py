@@ -0,0 +1,74 @@
+"""A minimal threaded HTTP stub server used by the benchmarks"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Tuple
+
+# A route returns a tuple of (status code, headers, JSON serializable body).
+# A bytes body is sent as is, already encoded
+Route = Callable[[BaseHTTPRequestHandler], Tuple[int, dict, object]]
+
+
+class StubServer:
+    """Serve canned JSON responses on localhost with HTTP/1.1 keep-alive
+
+    :param routes: A dictionary mapping (method, path prefix) to a Route
+    """
+
+    def __init__(self, routes: Dict[Tuple[str, str], Route]):
+        self.routes = routes
+        self.request_count = 0
+        self.connection_count = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                stub.connection_count += 1
+                super().setup()
+
+            def log_message(self, *args):
+                pass
+
+            def _handle(self):
+                stub.request_count += 1
+                length = int(self.headers.get('Content-Length') or 0)
+                self.request_body = self.rfile.read(length) if length else b''
+                for (method, prefix), route in stub.routes.items():
+                    if method == self.command and self.path.startswith(prefix):
+                        status, headers, body = route(self)
+                        break
+                else:
+                    status, headers, body = 404, {}, {'error': 'not found'}
+                payload = (
+                    body if isinstance(body, bytes)
+                    else json.dumps(body).encode('utf-8'))
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                for name, value in headers.items():
+                    self.send_header(name, str(value))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(payload)
+
+            do_GET = do_HEAD = do_POST = do_PATCH = _handle
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
@@ -1,129 +1,371 @@
 import json
 import logging
 import traceback
-import os
+from typing import List, Optional
 
-from .config import Config
+from .config import CONFIG
 
 from .utils import (
     verify_token,
-    process_auth0_user
+    process_auth0_user,
+    invalidate_user_profiles,
+    log_invocation_stats
 )
+from .pipeline import (
+    enqueue_notifications,
+    process_auth0_users,
+    queue_retries,
+    replay_retry_queue,
+    skip_duplicates
+)
+from .reconcile import reconcile
+from .notifications import (
+    Notification,
+    hash_token,
+    parse_notifications
+)
+from .profiles import json_loads
+from .metrics import METRICS
+from .sessions import set_deadline
+from .profiler import get_profiler
+from .structured_logging import configure_logging, flush_logs
+from .warmup import is_warm_up_event, warm_up
 from .lambda_types import LambdaDict, LambdaContext
 
 logger = logging.getLogger()
-if len(logging.getLogger().handlers) == 0:
-    logger.addHandler(logging.StreamHandler())
-fmt = "[%(levelname)s] %(asctime)s %(filename)s:%(lineno)d %(message)s\n"
-formatter = logging.Formatter(fmt=fmt)
-logging.getLogger().handlers[0].setFormatter(formatter)
+configure_logging()
 logging.getLogger('boto3').propagate = False
 logging.getLogger('botocore').propagate = False
 logging.getLogger('urllib3').propagate = False
-logging.getLogger().setLevel(os.getenv('LOG_LEVEL', 'INFO'))
-CONFIG = Config()
+
+PROFILER = get_profiler()
+
+# With provisioned concurrency the container is initialized before any
+# request arrives, so the upstream fetches a first request would otherwise
+# wait for are done here
+if CONFIG.warm_up_on_init:
+    warm_up()
+
+# Upstream calls aren't started once less time than this remains, leaving
+# time to report results, queue retries and flush metrics
+DEADLINE_MARGIN_MILLIS = 10000
+
+
+def html_response(status_code: int, body: str) -> dict:
+    """Build an API Gateway proxy response with a text/html body"""
+    return {
+        'headers': {'Content-Type': 'text/html'},
+        'statusCode': status_code,
+        'body': body}
+
+
+# Responses which never vary, built once rather than for every request
+TEST_RESPONSE = html_response(200, 'API request received')
+ERROR_RESPONSE = html_response(
+    400, "Since you requested the /error API endpoint I'll go ahead and "
+         "serve back a 400")
+METHOD_NOT_ALLOWED_RESPONSE = html_response(405, '405 Method Not Allowed')
+MISSING_BODY_RESPONSE = html_response(400, 'Missing POST body')
+NOT_FOUND_RESPONSE = html_response(404, "That path wasn't found")
+UNAUTHORIZED_RESPONSE = html_response(401, 'Authorization token invalid')
+SERVER_ERROR_RESPONSE = html_response(500, 'Error')
+UPDATE_SUCCEEDED_RESPONSE = html_response(200, 'Update succeeded')
+UPDATE_FAILED_RESPONSE = html_response(500, 'Update failed')
+UPDATE_QUEUED_RESPONSE = html_response(202, 'Update queued')
+QUEUE_FAILED_RESPONSE = html_response(500, 'Unable to queue update')
+
+STATIC_ROUTES = {
+    '/error': ERROR_RESPONSE,
+    '/test': TEST_RESPONSE,
+}
+
+
+def get_header(headers: Optional[dict], name: str) -> Optional[str]:
+    """Find a request header without lower casing a copy of every header
+
+    :param headers: The API Gateway event's headers, which keep the case the
+        client sent
+    :param name: The lower case header name
+    :return: The header's value or None if it's absent
+    """
+    if not headers:
+        return None
+    value = headers.get(name.title())
+    if value is None:
+        value = headers.get(name)
+    if value is None:
+        for key in headers:
+            if key.lower() == name:
+                return headers[key]
+    return value
+
+
+def batch_response(
+        notifications: List[Optional[Notification]],
+        results: List[bool],
+        field: str,
+        success_status: int) -> dict:
+    """Build the JSON response reporting each notification in a batch
+
+    :param notifications: The batch's notifications
+    :param results: A boolean for each notification
+    :param field: The name of the result field, "success" or "queued"
+    :param success_status: The status code if every result is True
+    :return: A dictionary of an API Gateway HTTP response
+    """
+    return {
+        'headers': {'Content-Type': 'application/json'},
+        'statusCode': success_status if all(results) else 500,
+        'body': json.dumps([
+            {'id': notification.id,
+             'operation': notification.operation,
+             field: result}
+            if notification is not None else {field: result}
+            for notification, result in zip(notifications, results)])}
+
+
+def process_notifications(
+        notifications: List[Optional[Notification]],
+        is_batch: bool,
+        context: LambdaContext) -> List[bool]:
+    """Process POSTed notifications and queue those which fail to be retried
+
+    :param notifications: A list of CIS notifications, None for those which
+        were invalid
+    :param is_batch: If True the notifications are processed concurrently
+        as a batch
+    :param context: AWS Lambda context object
+    :return: A list of booleans, one for each notification, indicating if
+        processing succeeded
+    """
+    invalidate_user_profiles(notifications)
+    if is_batch:
+        results = process_auth0_users(
+            notifications, context.get_remaining_time_in_millis)
+    else:
+        results = [
+            notification is not None and process_notification(
+                notification, context)
+            for notification in notifications]
+    queue_retries(notifications, results)
+    return results
+
+
+def process_notification(
+        notification: Notification,
+        context: LambdaContext) -> bool:
+    """Process a single POSTed notification, treating any error as a
+    failure so that it's queued to be retried like in a batch
+
+    :param notification: A CIS notification
+    :param context: AWS Lambda context object
+    :return: True if processing succeeded otherwise False
+    """
+    try:
+        return process_auth0_user(
+            notification.id,
+            notification.operation,
+            context.get_remaining_time_in_millis)
+    except Exception as e:
+        logger.error('Unable to process %s for %s : %s',
+                     notification.operation, notification.id, e)
+        return False
 
 
-def process_api_call(
+def process_post(
         event: LambdaDict,
         context: LambdaContext,
-        cis_webhook_authorization: str,
-        body: dict) -> dict:
-    """Process an API Gateway call depending on the URL path called
+        cis_webhook_authorization: Optional[str]) -> dict:
+    """Process CIS notifications POSTed to /post
+
+    The body may contain either a single CIS notification or a JSON array of
+    notifications which are processed as a batch. The bearer token is
+    verified before the body is decoded. Notifications which fail are added
+    to the retry queue if one is configured. If an ingest queue is
+    configured notifications are only verified and queued, to be processed
+    when SQS delivers them back as a batch. Notifications which have already
+    been received are answered as succeeded without any upstream calls
 
     :param event: The API Gateway request event
     :param context: AWS Lambda context object
     :param cis_webhook_authorization: A bearer token from the CIS webhook
            service
-    :param body: The parsed body that was POSTed to the API Gateway
     :return: A dictionary of an API Gateway HTTP response
     """
-    if event.get('path') == '/error':
-        return {
-            'headers': {'Content-Type': 'text/html'},
-            'statusCode': 400,
-            'body': "Since you requested the /error API endpoint I'll go "
-                    "ahead and serve back a 400"}
-    elif event.get('path') == '/test':
-        return {
-            'headers': {'Content-Type': 'text/html'},
-            'statusCode': 200,
-            'body': 'API request received'}
-    elif event.get('path') == '/post':
-        if verify_token(
-                cis_webhook_authorization,
-                CONFIG.notification_jwks,
-                CONFIG.notification_oidc_discovery_document['issuer']):
-            user_id = body.get('id')
-            # https://github.com/mozilla-iam/cis/blob/73f21ab201b4f242512786dfc8e1707fccf7f3c5/python-modules/cis_notifications/cis_notifications/event.py#L44-L51
-            operation = body.get('operation')
-            if (user_id is not None and operation is not None
-                    and process_auth0_user(
-                        user_id,
-                        operation,
-                        context.get_remaining_time_in_millis)):
-                return {
-                    'headers': {'Content-Type': 'text/html'},
-                    'statusCode': 200,
-                    'body': 'Update succeeded'}
-            else:
-                return {
-                    'headers': {'Content-Type': 'text/html'},
-                    'statusCode': 500,
-                    'body': 'Update failed'}
-        else:
-            return {
-                'headers': {'Content-Type': 'text/html'},
-                'statusCode': 401,
-                'body': "Authorization token invalid"}
-    else:
-        return {
-            'headers': {'Content-Type': 'text/html'},
-            'statusCode': 404,
-            'body': "That path wasn't found"}
+    if not verify_token(
+            cis_webhook_authorization,
+            CONFIG.notification_jwks,
+            CONFIG.notification_oidc_discovery_document['issuer'],
+            CONFIG.refresh_notification_jwks):
+        return UNAUTHORIZED_RESPONSE
+    try:
+        notifications, is_batch = parse_notifications(
+            event['body'], hash_token(cis_webhook_authorization))
+    except ValueError:
+        logger.error('Unable to parse POSTed body : %s', event['body'])
+        return SERVER_ERROR_RESPONSE
+    METRICS.count('Notifications', len(notifications))
+    if CONFIG.ingest_queue_url is not None:
+        results = skip_duplicates(notifications, enqueue_notifications)
+        if is_batch:
+            return batch_response(notifications, results, 'queued', 202)
+        return UPDATE_QUEUED_RESPONSE if results[0] else QUEUE_FAILED_RESPONSE
+    results = skip_duplicates(
+        notifications,
+        lambda new_notifications: process_notifications(
+            new_notifications, is_batch, context))
+    if is_batch:
+        return batch_response(notifications, results, 'success', 200)
+    return UPDATE_SUCCEEDED_RESPONSE if results[0] else UPDATE_FAILED_RESPONSE
+
+
+# Paths whose response depends on the request
+ROUTES = {
+    '/post': process_post,
+}
+
+
+def process_api_call(event: LambdaDict, context: LambdaContext) -> dict:
+    """Process an API Gateway call depending on the URL path called
+
+    :param event: The API Gateway request event
+    :param context: AWS Lambda context object
+    :return: A dictionary of an API Gateway HTTP response
+    """
+    if event.get('httpMethod') != 'POST':
+        return METHOD_NOT_ALLOWED_RESPONSE
+    elif not event.get('body'):
+        logger.debug('Missing POST body')
+        return MISSING_BODY_RESPONSE
+    path = event.get('path')
+    static_response = STATIC_ROUTES.get(path)
+    if static_response is not None:
+        return static_response
+    route = ROUTES.get(path)
+    if route is None:
+        return NOT_FOUND_RESPONSE
+    try:
+        return route(
+            event, context,
+            get_header(event.get('headers'), 'authorization'))
+    except Exception as e:
+        logger.error(str(e))
+        logger.error(traceback.format_exc())
+        return SERVER_ERROR_RESPONSE
+
+
+def process_sqs_event(event: LambdaDict, context: LambdaContext) -> LambdaDict:
+    """Process a batch of CIS notifications delivered by an SQS queue
+
+    Each SQS message body is a JSON CIS notification. Messages which fail are
+    reported back to SQS as partial batch failures so that only those messages
+    are retried.
+
+    :param event: AWS SQS event containing a list of Records
+    :param context: Lambda context about the invocation and environment
+    :return: An SQS partial batch response dictionary
+    """
+    message_ids = []
+    notifications = []
+    for record in event['Records']:
+        message_ids.append(record.get('messageId'))
+        try:
+            notifications.append(
+                Notification.from_dict(json_loads(record.get('body'))))
+        except (TypeError, ValueError):
+            logger.error(
+                'Unable to parse SQS message body : %s', record.get('body'))
+            notifications.append(None)
+    invalidate_user_profiles(notifications)
+    results = process_auth0_users(
+        notifications, context.get_remaining_time_in_millis)
+    return {'batchItemFailures': [
+        {'itemIdentifier': message_id}
+        for message_id, result in zip(message_ids, results) if not result]}
+
+
+def process_reconcile_event(
+        event: LambdaDict,
+        context: LambdaContext) -> LambdaDict:
+    """Run a reconciliation of every user's groups from the PersonAPI to Auth0
+
+    If the reconciliation isn't complete when time runs out, and this
+    invocation got through at least one page, the function invokes itself
+    asynchronously with the checkpoint so that whichever container receives
+    the invocation resumes from it
+
+    :param event: An event containing a "reconcile" dictionary which may set
+        "dry_run", "restart" and the "checkpoint" to resume from
+    :param context: Lambda context about the invocation and environment
+    :return: The reconciliation checkpoint
+    """
+    options = event['reconcile']
+    checkpoint = reconcile(
+        context.get_remaining_time_in_millis,
+        bool(options.get('dry_run')),
+        options.get('checkpoint'),
+        bool(options.get('restart')))
+    if (not checkpoint['complete'] and checkpoint['next_page'] is not None
+            and checkpoint['progress'] and 'error' not in checkpoint):
+        import boto3
+        resume = {name: value for name, value in checkpoint.items()
+                  if name != 'progress'}
+        boto3.client('lambda').invoke(
+            FunctionName=context.function_name,
+            InvocationType='Event',
+            Payload=json.dumps({'reconcile': {
+                'dry_run': checkpoint['dry_run'],
+                'checkpoint': resume}}).encode('utf-8'))
+        logger.info('Invoked %s to resume the reconciliation',
+                    context.function_name)
+    return checkpoint
 
 
 def lambda_handler(event: LambdaDict, context: LambdaContext) -> LambdaDict:
-    """Handler for all API Gateway requests
+    """Handler for all API Gateway requests, SQS batches, scheduled replays
+    of the retry queue, reconciliations and warm-up pings
 
-    :param event: AWS API Gateway input fields for AWS Lambda
+    :param event: AWS API Gateway, AWS SQS, Amazon EventBridge scheduled
+        event, reconcile or warm input fields for AWS Lambda
     :param context: Lambda context about the invocation and environment
-    :return: An AWS API Gateway output dictionary for proxy mode
+    :return: An AWS API Gateway output dictionary for proxy mode, an SQS
+        partial batch response, the replay counts, the reconciliation
+        checkpoint or the warm-up results
     """
-    if event.get('resource') == '/{proxy+}':
-        if event.get('httpMethod') != 'POST':
-            return {
-                'headers': {'Content-Type': 'text/html'},
-                'statusCode': 405,
-                'body': '405 Method Not Allowed'}
-        elif not event.get('body'):
-            logger.debug('Missing POST body')
-            return {
-                'headers': {'Content-Type': 'text/html'},
-                'statusCode': 400,
-                'body': 'Missing POST body'}
+    if is_warm_up_event(event):
+        # Warm-up pings only fill the caches, without the profiler, deadline,
+        # stats or metrics of an invocation
         try:
-            headers = (
-                {x.lower(): event['headers'][x] for x in event['headers']}
-                if event['headers'] is not None else {})
-            cis_webhook_authorization = headers.get('authorization')
-            body = json.loads(event['body'])
-            return process_api_call(
-                event, context, cis_webhook_authorization, body)
-        except json.decoder.JSONDecodeError:
-            logger.error('Unable to parse POSTed body : {}'.format(
-                event['body']))
-            return {
-                'headers': {'Content-Type': 'text/html'},
-                'statusCode': 500,
-                'body': 'Error'}
-        except Exception as e:
-            logger.error(str(e))
-            logger.error(traceback.format_exc())
-            return {
-                'headers': {'Content-Type': 'text/html'},
-                'statusCode': 500,
-                'body': 'Error'}
+            return warm_up()
+        finally:
+            flush_logs()
+    if PROFILER is not None:
+        PROFILER.start()
+    if context is not None:
+        set_deadline(
+            context.get_remaining_time_in_millis() - DEADLINE_MARGIN_MILLIS)
+    try:
+        with METRICS.timer('Handler'):
+            return route_event(event, context)
+    finally:
+        set_deadline(None)
+        if PROFILER is not None:
+            PROFILER.stop()
+        log_invocation_stats()
+        METRICS.flush()
+        flush_logs()
+
+
+def route_event(event: LambdaDict, context: LambdaContext) -> LambdaDict:
+    """Call the function for the type of event passed to lambda_handler"""
+    if event.get('Records') is not None:
+        return process_sqs_event(event, context)
+    elif isinstance(event.get('reconcile'), dict):
+        return process_reconcile_event(event, context)
+    elif event.get('detail-type') == 'Scheduled Event':
+        return replay_retry_queue(context.get_remaining_time_in_millis)
+    elif event.get('resource') == '/{proxy+}':
+        return process_api_call(event, context)
     else:
-        # Not an API Gateway invocation
+        # Not an API Gateway or SQS invocation
         return {'error': 'Not an API Gateway invocation'}
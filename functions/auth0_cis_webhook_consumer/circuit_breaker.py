@@ -0,0 +1,97 @@
+import logging
+import threading
+import time
+from collections import deque
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(requests.RequestException):
+    """Raised instead of calling an upstream whose circuit is open"""
+
+
+class CircuitBreaker:
+    """Stop calling an upstream while most of its recent calls are failing
+
+    The outcomes of the last `window` calls are kept. Once at least
+    `min_calls` have been seen and the fraction which failed reaches
+    `failure_rate` the circuit opens and calls are rejected without being
+    made, so that work fails fast and goes to the retry path instead of
+    waiting on a degraded upstream. After `cooldown` seconds a single probe
+    call is let through, closing the circuit if it succeeds or opening it
+    again if it fails.
+
+    :param name: The upstream, used in log messages
+    :param failure_rate: The fraction of failed calls which opens the circuit
+    :param min_calls: The fewest calls to judge the failure rate on
+    :param window: The number of most recent calls to judge
+    :param cooldown: Seconds to reject calls for once the circuit opens
+    """
+
+    def __init__(
+            self,
+            name: str,
+            failure_rate: float = 0.5,
+            min_calls: int = 10,
+            window: int = 20,
+            cooldown: float = 30):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self._outcomes = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        self.stats = {'opened': 0, 'rejected': 0}
+
+    def allow(self) -> bool:
+        """Check if a call may be made
+
+        :return: True if the call may go ahead, in which case its outcome
+            must be passed to record
+        """
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if (self.state == 'open'
+                    and time.monotonic() >= self._opened_at + self.cooldown):
+                self.state = 'half_open'
+            if self.state == 'half_open' and not self._probing:
+                self._probing = True
+                return True
+            self.stats['rejected'] += 1
+            return False
+
+    def record(self, success: bool) -> None:
+        """Record the outcome of a call that was allowed
+
+        :param success: False if the call raised or got a 5xx response
+        """
+        with self._lock:
+            if self.state == 'half_open':
+                self._probing = False
+                if success:
+                    logger.info('Closing the circuit to %s', self.name)
+                    self.state = 'closed'
+                    self._outcomes.clear()
+                else:
+                    self._open('the probe call failed')
+            elif self.state == 'closed':
+                self._outcomes.append(success)
+                failures = self._outcomes.count(False)
+                if (len(self._outcomes) >= self.min_calls
+                        and failures >= self.failure_rate
+                        * len(self._outcomes)):
+                    self._open('{} of the last {} calls failed'.format(
+                        failures, len(self._outcomes)))
+
+    def _open(self, reason: str) -> None:
+        logger.error('Opening the circuit to %s for %s seconds as %s',
+                     self.name, self.cooldown, reason)
+        self.state = 'open'
+        self._opened_at = time.monotonic()
+        self.stats['opened'] += 1
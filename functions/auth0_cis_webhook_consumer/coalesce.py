@@ -0,0 +1,88 @@
+import logging
+from collections import OrderedDict
+from typing import Hashable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# When a user has several operations within a window the one with the highest
+# priority runs, and of equal priorities the latest runs. create is ignored by
+# prepare_auth0_update so anything beats it, and a delete can't be undone by
+# an update which follows it
+OPERATION_PRIORITY = {'create': 0, 'update': 1, 'delete': 2}
+
+
+class CoalescingWindow:
+    """Collapse the CIS notifications for each user into a single operation
+
+    Notifications are added to the window, keyed by user ID, until it's
+    drained. Operations which aren't in OPERATION_PRIORITY are never
+    collapsed so that each of them fails on its own.
+
+    :param max_size: The maximum number of users held in the window. Once
+        full it must be drained before a new user can be added
+    """
+
+    def __init__(self, max_size: int = 1000):
+        self.max_size = max_size
+        self._operations = OrderedDict()
+        self.stats = {'received': 0, 'collapsed': 0, 'windows': 0}
+
+    def __len__(self) -> int:
+        return len(self._operations)
+
+    @staticmethod
+    def key(user_id: str, operation: str) -> Hashable:
+        """Return the key a notification is coalesced under
+
+        :param user_id: The user's user ID
+        :param operation: The operation to perform
+        :return: The user ID or, for unknown operations, a tuple of the user
+            ID and operation
+        """
+        if operation in OPERATION_PRIORITY:
+            return user_id
+        return user_id, operation
+
+    def is_full(self, user_id: str, operation: str) -> bool:
+        """Check if a notification can't be added without draining first
+
+        :param user_id: The user's user ID
+        :param operation: The operation to perform
+        :return: True if the window is full and the notification's key isn't
+            already in it
+        """
+        return (len(self._operations) >= self.max_size
+                and self.key(user_id, operation) not in self._operations)
+
+    def add(self, user_id: str, operation: str) -> Hashable:
+        """Add a notification to the window
+
+        :param user_id: The user's user ID
+        :param operation: The operation to perform
+        :return: The key the notification was coalesced under
+        """
+        key = self.key(user_id, operation)
+        self.stats['received'] += 1
+        current = self._operations.get(key)
+        if current is None:
+            self._operations[key] = (user_id, operation)
+            return key
+        self.stats['collapsed'] += 1
+        if (OPERATION_PRIORITY.get(operation, 0)
+                >= OPERATION_PRIORITY.get(current[1], 0)):
+            self._operations[key] = (user_id, operation)
+        return key
+
+    def drain(self) -> List[Tuple[Hashable, str, str]]:
+        """Empty the window
+
+        :return: A list of tuples of the key, user ID and operation to run
+            for each key, in the order each key was first added
+        """
+        operations = [
+            (key, user_id, operation)
+            for key, (user_id, operation) in self._operations.items()]
+        self._operations.clear()
+        if operations:
+            self.stats['windows'] += 1
+        return operations
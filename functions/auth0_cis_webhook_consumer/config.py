@@ -1,28 +1,56 @@
 import logging
 import os
 import json
-from typing import Optional
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
 
-import requests
-import boto3
-from botocore.exceptions import ClientError
+from .url_cache import UrlCache
 
 logger = logging.getLogger(__name__)
 
+SECRET_NAMES = ('personapi_client_secret', 'management_api_client_secret')
+
+# The name of the Management API target configured by MANAGEMENT_API_*
+DEFAULT_TARGET_NAME = 'default'
+
+
+def get_secrets_manager_client():
+    """Return the AWS Secrets Manager client, creating it on first use
+
+    boto3 is imported here rather than at module load so that invocations
+    which never need a secret don't pay to import it
+    """
+    global secrets_manager_client
+    if 'secrets_manager_client' not in globals():
+        import boto3
+        secrets_manager_client = boto3.client('secretsmanager')
+    return secrets_manager_client
+
+
+def log_secret_error(secret_name, error):
+    code = error.response['Error']['Code']
+    if code == 'ResourceNotFoundException':
+        logger.debug("The requested secret " + secret_name + " was not found")
+    elif code == 'InvalidRequestException':
+        logger.debug("The request was invalid due to: %s", error)
+    elif code == 'InvalidParameterException':
+        logger.debug("The request had invalid params: %s", error)
+    else:
+        logger.error("Unable to fetch secret %s : %s", secret_name, error)
+
+
 def get_secret_value(self, path, secret_name):
+    from botocore.exceptions import ClientError
     #if the secret exists return it
     if secret_name in self._secrets:
         return self._secrets[secret_name]
     else: #otherwise fetch it from AWS Secrets Manager
         try:
-            response = boto3.client('secretsmanager').get_secret_value(SecretId=path+secret_name)
+            response = get_secrets_manager_client().get_secret_value(
+                SecretId=path+secret_name)
         except ClientError as e:
-            if e.response['Error']['Code'] == 'ResourceNotFoundException':
-                logger.debug("The requested secret " + secret_name + " was not found")
-            elif e.response['Error']['Code'] == 'InvalidRequestException':
-                logger.debug("The request was invalid due to: "+ e)
-            elif e.response['Error']['Code'] == 'InvalidParameterException':
-                logger.debug("The request had invalid params: "+ e)
+            log_secret_error(secret_name, e)
         else:
             #load the secret as JSON
             secret = json.loads(response['SecretString'])
@@ -30,14 +58,110 @@ def get_secret_value(self, path, secret_name):
             self._secrets[secret_name] = secret[path+secret_name]
             return secret[path+secret_name]
 
+
+def get_secret_values(self, path, secret_names):
+    """Fetch several secrets in a single BatchGetSecretValue call
+
+    If the batch call isn't possible the secrets are fetched concurrently
+    with individual GetSecretValue calls instead
+
+    :param path: The path prefix of the secrets
+    :param secret_names: The names of the secrets under the path
+    :return: A dictionary of secret names and values
+    """
+    from botocore.exceptions import ClientError
+    missing = [name for name in secret_names if name not in self._secrets]
+    if missing:
+        try:
+            response = get_secrets_manager_client().batch_get_secret_value(
+                SecretIdList=[path + name for name in missing])
+        except ClientError as e:
+            logger.debug('Unable to batch fetch secrets, fetching them '
+                         'individually : %s', e)
+            with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+                list(executor.map(
+                    lambda name: get_secret_value(self, path, name), missing))
+        else:
+            for secret_value in response.get('SecretValues', []):
+                name = secret_value['Name'][len(path):]
+                secret = json.loads(secret_value['SecretString'])
+                self._secrets[name] = secret[secret_value['Name']]
+            for error in response.get('Errors', []):
+                logger.debug('Unable to fetch secret %s : %s %s',
+                             error.get('SecretId'),
+                             error.get('ErrorCode'),
+                             error.get('Message'))
+    return {name: self._secrets.get(name) for name in secret_names}
+
+
 class Config:
     def __init__(self):
         self._notification_discovery_document = None
         self._notification_oidc_discovery_document = None
         self._notification_jwks = None
         self._secrets = {}
-        self._fetched_urls = {}
+        self._url_cache = UrlCache(
+            default_ttl=float(os.getenv('URL_CACHE_DEFAULT_TTL', '3600')),
+            min_ttl=float(os.getenv('URL_CACHE_MIN_TTL', '60')),
+            max_ttl=float(os.getenv('URL_CACHE_MAX_TTL', '86400')),
+            negative_ttl=float(os.getenv('URL_CACHE_NEGATIVE_TTL', '5')),
+            max_negative_ttl=float(
+                os.getenv('URL_CACHE_MAX_NEGATIVE_TTL', '300')),
+            snapshot_path=os.getenv('URL_CACHE_SNAPSHOT_PATH'))
         self.authorization = {}
+        self.token_store = os.getenv('TOKEN_STORE', 'memory')
+        self.token_store_location = os.getenv(
+            'TOKEN_STORE_LOCATION',
+            '/tmp/auth0-cis-webhook-consumer-tokens'
+            if self.token_store == 'file' else None)
+        self.token_renew_margin = int(os.getenv('TOKEN_RENEW_MARGIN', '900'))
+        self.rate_limiter = os.getenv('RATE_LIMITER', 'memory')
+        self.rate_limiter_table = os.getenv('RATE_LIMITER_TABLE')
+        self.rate_limiter_initial_rate = (
+            float(os.getenv('RATE_LIMITER_INITIAL_RATE'))
+            if os.getenv('RATE_LIMITER_INITIAL_RATE') else None)
+        self.rate_limiter_initial_burst = (
+            float(os.getenv('RATE_LIMITER_INITIAL_BURST'))
+            if os.getenv('RATE_LIMITER_INITIAL_BURST') else None)
+        self.group_digest_store = os.getenv('GROUP_DIGEST_STORE', 'memory')
+        self.group_digest_table = os.getenv('GROUP_DIGEST_TABLE')
+        self.group_digest_ttl = int(os.getenv('GROUP_DIGEST_TTL', '3600'))
+        self.group_digest_max_size = int(
+            os.getenv('GROUP_DIGEST_MAX_SIZE', '10000'))
+        self.group_digest_verify = (
+            os.getenv('GROUP_DIGEST_VERIFY', 'false').lower() == 'true')
+        self.dedup_store = os.getenv('DEDUP_STORE', 'memory')
+        self.dedup_table = os.getenv('DEDUP_TABLE')
+        self.dedup_ttl = int(os.getenv('DEDUP_TTL', '3600'))
+        self.dedup_max_size = int(os.getenv('DEDUP_MAX_SIZE', '10000'))
+        self.profile_fetch = os.getenv('PROFILE_FETCH', 'decode')
+        self.profile_cache = os.getenv('PROFILE_CACHE', 'memory')
+        self.profile_cache_table = os.getenv('PROFILE_CACHE_TABLE')
+        self.profile_cache_ttl = int(os.getenv('PROFILE_CACHE_TTL', '300'))
+        self.profile_cache_max_size = int(
+            os.getenv('PROFILE_CACHE_MAX_SIZE', '1000'))
+        self.group_mapping_rules = (
+            json.loads(os.getenv('GROUP_MAPPING_RULES'))
+            if os.getenv('GROUP_MAPPING_RULES') else None)
+        self.ingest_queue_url = os.getenv('INGEST_QUEUE_URL')
+        self.retry_queue = os.getenv('RETRY_QUEUE', 'none')
+        self.retry_queue_location = os.getenv('RETRY_QUEUE_LOCATION')
+        self.retry_dead_letter_location = os.getenv(
+            'RETRY_DEAD_LETTER_LOCATION')
+        self.retry_max_attempts = int(os.getenv('RETRY_MAX_ATTEMPTS', '5'))
+        self.retry_backoff = float(os.getenv('RETRY_BACKOFF', '30'))
+        self.retry_max_backoff = float(os.getenv('RETRY_MAX_BACKOFF', '900'))
+        self.reconcile_checkpoint_store = os.getenv(
+            'RECONCILE_CHECKPOINT_STORE', 'file')
+        self.reconcile_checkpoint_location = os.getenv(
+            'RECONCILE_CHECKPOINT_LOCATION',
+            '/tmp/auth0-cis-webhook-consumer-reconcile.json')
+        self.coalesce_max_users = int(
+            os.getenv('COALESCE_MAX_USERS', '1000'))
+        self.personapi_concurrency = int(
+            os.getenv('PERSON_API_CONCURRENCY', '8'))
+        self.management_api_concurrency = int(
+            os.getenv('MANAGEMENT_API_CONCURRENCY', '4'))
         self.domain_name = os.getenv('DOMAIN_NAME')
         self.environment_name = os.getenv('ENVIRONMENT_NAME')
         self.user_whitelist = (
@@ -46,40 +170,104 @@ class Config:
         self.notification_discovery_url = os.getenv(
             'NOTIFICATION_DISCOVERY_URL')
         self.notification_audience = os.getenv('NOTIFICATION_AUDIENCE')
+        self.verified_token_cache_size = int(
+            os.getenv('VERIFIED_TOKEN_CACHE_SIZE', '128'))
+        self.warm_up_on_init = (
+            os.getenv('WARM_UP_ON_INIT', 'false').lower() == 'true')
+        self.warm_up_timeout = float(os.getenv('WARM_UP_TIMEOUT', '8'))
 
         #build path to secrets
-        path = '/iam/cis/{}/auth0_cis_webhook_consumer/'.format(
+        self._secrets_path = '/iam/cis/{}/auth0_cis_webhook_consumer/'.format(
                 self.environment_name)
+        self._secrets_loaded = False
+        self._secrets_lock = threading.Lock()
 
-        self.person_api = {
+        # client_secret values are fetched on first use by load_secrets
+        # Only set to reach a PersonAPI which isn't at person.<audience>, for
+        # example a local stub
+        self._personapi_url = os.getenv('PERSON_API_URL')
+        self._person_api = {
             'client_id': os.getenv('PERSON_API_CLIENT_ID'),
-            'client_secret': get_secret_value(self, path, 'personapi_client_secret'),
             'audience': os.getenv('PERSON_API_AUDIENCE'),
             'discovery_url': os.getenv('PERSON_API_DISCOVERY_URL')
         }
-        self.management_api = {
+        self._management_api = {
+            'name': DEFAULT_TARGET_NAME,
             'client_id': os.getenv('MANAGEMENT_API_CLIENT_ID'),
-            'client_secret': get_secret_value(self, path,'management_api_client_secret'),
             'audience': os.getenv('MANAGEMENT_API_AUDIENCE'),
-            'discovery_url': os.getenv('MANAGEMENT_API_DISCOVERY_URL')
+            'discovery_url': os.getenv('MANAGEMENT_API_DISCOVERY_URL'),
+            'secret_name': 'management_api_client_secret',
+            'user_id_prefixes': (
+                json.loads(os.getenv('MANAGEMENT_API_USER_ID_PREFIXES'))
+                if os.getenv('MANAGEMENT_API_USER_ID_PREFIXES') else None)
         }
+        # Further Auth0 tenants to write every change to, each a dictionary
+        # of name, client_id, audience, discovery_url and optionally
+        # secret_name and user_id_prefixes
+        self._extra_management_apis = [
+            dict(target, secret_name=target.get(
+                'secret_name',
+                'management_api_client_secret_{}'.format(target['name'])))
+            for target in json.loads(
+                os.getenv('MANAGEMENT_API_TARGETS') or '[]')]
 
-    def get_url(self, url):
-        if self._fetched_urls.get(url) is None:
-            logger.debug('Fetching URL : {}'.format(url))
-            response = requests.get(url)
-            if response.ok:
-                self._fetched_urls[url] = response.json()
-                return self._fetched_urls[url]
-            else:
-                logger.error('Unable to fetch {} : {} {}'.format(
-                    url,
-                    response.status_code,
-                    response.text
-                ))
-                return None
-        else:
-            return self._fetched_urls[url]
+    def load_secrets(self) -> None:
+        """Fetch all client secrets from AWS Secrets Manager at once"""
+        with self._secrets_lock:
+            if self._secrets_loaded:
+                return
+            secrets = get_secret_values(
+                self, self._secrets_path, SECRET_NAMES + tuple(
+                    target['secret_name']
+                    for target in self._extra_management_apis))
+            self._person_api['client_secret'] = secrets[
+                'personapi_client_secret']
+            for target in [self._management_api] + self._extra_management_apis:
+                target['client_secret'] = secrets[target['secret_name']]
+            self._secrets_loaded = True
+
+    @property
+    def person_api(self) -> dict:
+        if not self._secrets_loaded:
+            self.load_secrets()
+        return self._person_api
+
+    @property
+    def personapi_url(self) -> str:
+        return self._personapi_url or 'https://person.{}'.format(
+            self.person_api['audience'])
+
+    @property
+    def management_api(self) -> dict:
+        if not self._secrets_loaded:
+            self.load_secrets()
+        return self._management_api
+
+    @property
+    def management_api_targets(self) -> List[dict]:
+        """Every Auth0 Management API to write to, the one configured by
+        MANAGEMENT_API_* first"""
+        if not self._secrets_loaded:
+            self.load_secrets()
+        return [self._management_api] + self._extra_management_apis
+
+    @property
+    def management_api_target_count(self) -> int:
+        return 1 + len(self._extra_management_apis)
+
+    @property
+    def management_api_target_names(self) -> List[str]:
+        """The name of every Management API target, without loading
+        secrets"""
+        return [self._management_api['name']] + [
+            target['name'] for target in self._extra_management_apis]
+
+    def get_url(self, url, force=False):
+        return self._url_cache.get(url, force)
+
+    @property
+    def url_cache_stats(self) -> dict:
+        return self._url_cache.stats
 
     @property
     def notification_discovery_document(self) -> Optional[dict]:
@@ -95,6 +283,10 @@ class Config:
         return self.get_url(
             self.notification_oidc_discovery_document['jwks_uri'])
 
+    def refresh_notification_jwks(self) -> Optional[dict]:
+        return self.get_url(
+            self.notification_oidc_discovery_document['jwks_uri'], force=True)
+
     @property
     def personapi_discovery_document(self) -> Optional[dict]:
         return self.get_url(self.person_api['discovery_url'])
@@ -102,3 +294,7 @@ class Config:
     @property
     def management_api_discovery_document(self) -> Optional[dict]:
         return self.get_url(self.management_api['discovery_url'])
+
+
+# A single Config shared by every module in the AWS Lambda global scope
+CONFIG = Config()
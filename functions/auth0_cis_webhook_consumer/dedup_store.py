@@ -0,0 +1,173 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from .notifications import Notification
+
+logger = logging.getLogger(__name__)
+
+
+def notification_key(notification: Notification) -> Optional[str]:
+    """Return the key that identifies a delivery of a CIS notification
+
+    A notification without a time can't be told apart from a later change to
+    the same user, so it has no key and is never treated as a duplicate
+
+    :param notification: A CIS notification
+    :return: A hex digest of the id, operation and time or None
+    """
+    if notification.timestamp is None:
+        return None
+    return hashlib.sha256(json.dumps(
+        [notification.id, notification.operation, notification.timestamp]
+    ).encode('utf-8')).hexdigest()
+
+
+class MemoryDedupStore:
+    """Remember which CIS notifications have already been processed
+
+    Entries are held in a bounded LRU in the AWS Lambda global scope and
+    expire after a TTL.
+
+    :param ttl: Seconds to remember a notification for
+    :param max_size: The maximum number of notifications to remember
+    """
+
+    def __init__(self, ttl: int = 3600, max_size: int = 10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'claimed': 0, 'duplicates': 0, 'released': 0}
+
+    def _claim_locally(self, key: str) -> bool:
+        with self._lock:
+            expiry = self._entries.get(key)
+            if expiry is not None and expiry > time.time():
+                self._entries.move_to_end(key)
+                return False
+            self._entries[key] = time.time() + self.ttl
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            return True
+
+    def claim(self, key: str) -> bool:
+        """Record that a notification is being processed
+
+        :param key: The key from notification_key
+        :return: True if the notification is new and should be processed,
+            False if it's a duplicate
+        """
+        if self._claim_locally(key):
+            self.stats['claimed'] += 1
+            return True
+        self.stats['duplicates'] += 1
+        return False
+
+    def release(self, key: str) -> None:
+        """Forget a notification which failed so that a redelivery of it is
+        processed
+
+        :param key: The key from notification_key
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+        self.stats['released'] += 1
+
+
+class DynamoDBDedupStore(MemoryDedupStore):
+    """Remember processed notifications in a DynamoDB table shared by all
+    containers
+
+    The in memory LRU answers repeats of notifications claimed by this
+    container and anything else is claimed with a conditional write, so only
+    one container processes each notification. If DynamoDB can't be reached
+    notifications are processed rather than dropped. The table must have a
+    string partition key named "id". Enabling DynamoDB TTL on the "expiry"
+    attribute removes expired entries.
+
+    :param table_name: The name of the DynamoDB table
+    :param ttl: Seconds to remember a notification for
+    :param max_size: The maximum number of notifications to remember in
+        memory
+    """
+
+    def __init__(
+            self,
+            table_name: str,
+            ttl: int = 3600,
+            max_size: int = 10000):
+        super().__init__(ttl, max_size)
+        self.table_name = table_name
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import boto3
+            self._client = boto3.client('dynamodb')
+        return self._client
+
+    def claim(self, key: str) -> bool:
+        if not self._claim_locally(key):
+            self.stats['duplicates'] += 1
+            return False
+        from botocore.exceptions import ClientError
+        now = int(time.time())
+        try:
+            self.client.put_item(
+                TableName=self.table_name,
+                Item={'id': {'S': key},
+                      'expiry': {'N': str(now + self.ttl)}},
+                ConditionExpression=(
+                    'attribute_not_exists(id) OR expiry < :now'),
+                ExpressionAttributeValues={':now': {'N': str(now)}})
+        except ClientError as e:
+            if (e.response['Error']['Code']
+                    == 'ConditionalCheckFailedException'):
+                # Only claims made by this container are remembered in
+                # memory, as another container releases its claims itself
+                with self._lock:
+                    self._entries.pop(key, None)
+                self.stats['duplicates'] += 1
+                return False
+            logger.error('Unable to claim notification : %s', e)
+        self.stats['claimed'] += 1
+        return True
+
+    def release(self, key: str) -> None:
+        super().release(key)
+        from botocore.exceptions import ClientError
+        try:
+            self.client.delete_item(
+                TableName=self.table_name, Key={'id': {'S': key}})
+        except ClientError as e:
+            logger.error('Unable to release notification : %s', e)
+
+
+def get_dedup_store(
+        backend: str,
+        table_name: Optional[str] = None,
+        ttl: int = 3600,
+        max_size: int = 10000) -> Optional[MemoryDedupStore]:
+    """Build the notification dedup store for a backend
+
+    :param backend: One of "memory", "dynamodb" or "none"
+    :param table_name: The DynamoDB table name for the dynamodb backend
+    :param ttl: Seconds to remember a notification for
+    :param max_size: The maximum number of notifications to remember in
+        memory
+    :return: A dedup store or None if duplicates are processed again
+    """
+    if backend == 'none':
+        return None
+    elif backend == 'dynamodb':
+        return DynamoDBDedupStore(table_name, ttl, max_size)
+    elif backend != 'memory':
+        logger.error('Unknown dedup store %s, using memory', backend)
+    return MemoryDedupStore(ttl, max_size)
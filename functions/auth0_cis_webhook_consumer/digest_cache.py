@@ -0,0 +1,179 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def groups_digest(groups: List[str]) -> str:
+    """Return a digest of a set of groups which ignores their order
+
+    :param groups: A list of group names
+    :return: A hex digest
+    """
+    return hashlib.sha256(
+        json.dumps(sorted(set(groups))).encode('utf-8')).hexdigest()
+
+
+class MemoryDigestStore:
+    """Remember a digest of the groups last written to each Auth0 user
+
+    Entries are held in a bounded LRU in the AWS Lambda global scope and
+    expire after a TTL so that changes made to Auth0 by something other than
+    this consumer are eventually overwritten.
+
+    :param ttl: Seconds to remember a digest for
+    :param max_size: The maximum number of users to remember
+    """
+
+    def __init__(self, ttl: int = 3600, max_size: int = 10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {
+            'hits': 0, 'misses': 0, 'skipped_writes': 0, 'verified_skips': 0}
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the digest last written for a user
+
+        :param key: The Management API issuer and user ID
+        :return: The digest or None if it's unknown or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.time():
+                self._entries.move_to_end(key)
+                return entry[0]
+            self._entries.pop(key, None)
+        return None
+
+    def put(self, key: str, digest: str) -> None:
+        """Remember the digest written for a user
+
+        :param key: The Management API issuer and user ID
+        :param digest: The digest from groups_digest
+        """
+        with self._lock:
+            self._entries[key] = (digest, time.time() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        """Forget the digest for a user
+
+        :param key: The Management API issuer and user ID
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def is_unchanged(self, key: str, digest: str) -> Optional[bool]:
+        """Check if a digest matches the one last written for a user
+
+        :param key: The Management API issuer and user ID
+        :param digest: The digest from groups_digest
+        :return: True if the groups are unchanged and the write can be
+            skipped, False if they've changed or None if no digest is known
+        """
+        stored = self.get(key)
+        if stored is None:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        if stored == digest:
+            self.stats['skipped_writes'] += 1
+            return True
+        return False
+
+
+class DynamoDBDigestStore(MemoryDigestStore):
+    """Remember group digests in a DynamoDB table shared by all containers
+
+    The table must have a string partition key named "id". Enabling
+    DynamoDB TTL on the "expiry" attribute removes expired digests.
+
+    :param table_name: The name of the DynamoDB table
+    :param ttl: Seconds to remember a digest for
+    :param max_size: The maximum number of users to remember in memory
+    """
+
+    def __init__(
+            self,
+            table_name: str,
+            ttl: int = 3600,
+            max_size: int = 10000):
+        super().__init__(ttl, max_size)
+        self.table_name = table_name
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import boto3
+            self._client = boto3.client('dynamodb')
+        return self._client
+
+    def get(self, key: str) -> Optional[str]:
+        digest = super().get(key)
+        if digest is not None:
+            return digest
+        from botocore.exceptions import ClientError
+        try:
+            item = self.client.get_item(
+                TableName=self.table_name,
+                Key={'id': {'S': key}}).get('Item')
+        except ClientError as e:
+            logger.error('Unable to read group digest : %s', e)
+            return None
+        if item is None or int(item['expiry']['N']) <= time.time():
+            return None
+        super().put(key, item['digest']['S'])
+        return item['digest']['S']
+
+    def put(self, key: str, digest: str) -> None:
+        super().put(key, digest)
+        from botocore.exceptions import ClientError
+        try:
+            self.client.put_item(
+                TableName=self.table_name,
+                Item={'id': {'S': key},
+                      'digest': {'S': digest},
+                      'expiry': {'N': str(int(time.time() + self.ttl))}})
+        except ClientError as e:
+            logger.error('Unable to store group digest : %s', e)
+
+    def delete(self, key: str) -> None:
+        super().delete(key)
+        from botocore.exceptions import ClientError
+        try:
+            self.client.delete_item(
+                TableName=self.table_name, Key={'id': {'S': key}})
+        except ClientError as e:
+            logger.error('Unable to delete group digest : %s', e)
+
+
+def get_digest_store(
+        backend: str,
+        table_name: Optional[str] = None,
+        ttl: int = 3600,
+        max_size: int = 10000) -> Optional[MemoryDigestStore]:
+    """Build the group digest store for a backend
+
+    :param backend: One of "memory", "dynamodb" or "none"
+    :param table_name: The DynamoDB table name for the dynamodb backend
+    :param ttl: Seconds to remember a digest for
+    :param max_size: The maximum number of users to remember in memory
+    :return: A digest store or None if skipping unchanged writes is disabled
+    """
+    if backend == 'none':
+        return None
+    elif backend == 'dynamodb':
+        return DynamoDBDigestStore(table_name, ttl, max_size)
+    elif backend != 'memory':
+        logger.error('Unknown digest store %s, using memory', backend)
+    return MemoryDigestStore(ttl, max_size)
@@ -0,0 +1,133 @@
+import logging
+import re
+from typing import Callable, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# The rules applied when none are configured. Groups from the ldap publisher
+# are used as is, the hris section contains employee_id, worker_type etc
+# rather than groups, the access_provider section doesn't seem to contain
+# anything, and all other publishers' groups are prefixed with "publisher_"
+DEFAULT_RULES = {
+    'ldap': {'prefix': ''},
+    'hris': {'enabled': False},
+    'access_provider': {'enabled': False},
+    '*': {'prefix': '{publisher}_'},
+}
+
+RULE_FIELDS = {
+    'enabled', 'prefix', 'include', 'exclude', 'include_regex',
+    'exclude_regex', 'rename'}
+
+
+def compile_rule(
+        publisher: str,
+        rule: dict) -> Optional[Callable[[Iterable[str]], List[str]]]:
+    """Compile a publisher's rule into a function that maps its groups
+
+    A group is kept if it's in include (when set), matches include_regex
+    (when set), isn't in exclude and doesn't match exclude_regex. Kept groups
+    are then renamed and finally prefixed.
+
+    :param publisher: The name of the publisher in access_information
+    :param rule: A dictionary of the rule's settings
+    :return: A function given the publisher's group values that returns the
+        Auth0 group names, or None if the publisher is disabled
+    """
+    unknown = set(rule) - RULE_FIELDS
+    if unknown:
+        raise ValueError('Unknown group mapping settings {} for {}'.format(
+            ', '.join(sorted(unknown)), publisher))
+    if not rule.get('enabled', True):
+        return None
+    prefix = rule.get('prefix', '{publisher}_').format(publisher=publisher)
+    include = set(rule['include']) if rule.get('include') is not None else None
+    exclude = set(rule.get('exclude') or [])
+    try:
+        include_regex = (re.compile(rule['include_regex'])
+                         if rule.get('include_regex') else None)
+        exclude_regex = (re.compile(rule['exclude_regex'])
+                         if rule.get('exclude_regex') else None)
+    except re.error as e:
+        raise ValueError('Invalid group mapping regex for {} : {}'.format(
+            publisher, e))
+    rename = dict(rule.get('rename') or {})
+
+    if (include is None and not exclude and include_regex is None
+            and exclude_regex is None and not rename):
+        # Most publishers only need a prefix
+        if not prefix:
+            return list
+        return lambda values: [prefix + value for value in values]
+
+    def mapping(values: Iterable[str]) -> List[str]:
+        # Each configured filter is a single comprehension so that no
+        # per group function calls are made
+        if include is not None:
+            values = [value for value in values if value in include]
+        if exclude:
+            values = [value for value in values if value not in exclude]
+        if include_regex is not None:
+            values = [value for value in values if include_regex.search(value)]
+        if exclude_regex is not None:
+            values = [
+                value for value in values if not exclude_regex.search(value)]
+        if rename:
+            values = [rename.get(value, value) for value in values]
+        return [prefix + value for value in values]
+
+    return mapping
+
+
+class GroupMapper:
+    """Map the access_information of CIS profiles to Auth0 groups
+
+    Rules are compiled once into a dispatch table indexed by publisher name.
+    Publishers without a rule of their own use the "*" rule, compiled the
+    first time each publisher is seen. Disabled publishers are skipped
+    without reading their values.
+
+    :param rules: A dictionary of publisher name, or "*" for all other
+        publishers, and rule dictionary
+    """
+
+    def __init__(self, rules: Optional[dict] = None):
+        rules = DEFAULT_RULES if rules is None else rules
+        self.default_rule = rules.get('*', {})
+        self.dispatch = {
+            publisher: compile_rule(publisher, rule)
+            for publisher, rule in rules.items() if publisher != '*'}
+        # Check the default rule compiles before it's first needed
+        compile_rule('*', self.default_rule)
+
+    def get_mapping(
+            self,
+            publisher: str) -> Optional[Callable[[Iterable[str]], List[str]]]:
+        """Return the compiled mapping for a publisher
+
+        :param publisher: The name of the publisher in access_information
+        :return: The mapping function or None if the publisher is disabled
+        """
+        try:
+            return self.dispatch[publisher]
+        except KeyError:
+            mapping = compile_rule(publisher, self.default_rule)
+            self.dispatch[publisher] = mapping
+            return mapping
+
+    def map(self, access_information: Dict[str, dict]) -> List[str]:
+        """Build the list of Auth0 groups from a profile's access_information
+
+        :param access_information: The access_information section of a CIS
+            user profile
+        :return: A list of group names
+        """
+        groups = []
+        for publisher, data in access_information.items():
+            mapping = self.get_mapping(publisher)
+            if mapping is None:
+                continue
+            values = data.get('values')
+            if values:
+                groups.extend(mapping(values))
+        return groups
@@ -0,0 +1,110 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class KeySet:
+    """A JSON Web Key Set pre-parsed into key objects indexed by kid
+
+    Parsing a JWK into a key object is the expensive part of preparing to
+    verify an RSA signature so it's done once per JWKS document instead of
+    once per token.
+
+    :param jwks: A JSON Web Key Set dictionary
+    """
+
+    def __init__(self, jwks: dict):
+        from jose import jwk, exceptions
+        self.jwks = jwks
+        self.keys = {}
+        for key_data in jwks.get('keys', []):
+            if key_data.get('kid') is None:
+                continue
+            algorithm = key_data.get('alg', 'RS256')
+            try:
+                self.keys[key_data['kid']] = (
+                    jwk.construct(key_data, algorithm), algorithm)
+            except exceptions.JOSEError as e:
+                logger.error('Unable to parse JWK %s : %s', key_data['kid'], e)
+
+    def get(self, kid: Optional[str]) -> Optional[tuple]:
+        """Return the key object and its algorithm for a kid
+
+        :param kid: The key ID from a token header
+        :return: A tuple of the key object and algorithm or None if the kid
+            isn't in the key set
+        """
+        return self.keys.get(kid)
+
+
+class VerifiedTokenCache:
+    """A bounded LRU cache of bearer tokens that have already been verified
+
+    Tokens are stored by a hash of the token together with the issuer and
+    audience they were verified against, never the token itself, and are
+    evicted once the token's exp has passed.
+
+    :param max_size: The maximum number of tokens to keep
+    """
+
+    def __init__(self, max_size: int = 128):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    @staticmethod
+    def key(token: str, issuer: str, audience: str) -> str:
+        """Build the cache key for a token
+
+        :param token: The raw bearer token
+        :param issuer: The issuer the token is verified against
+        :param audience: The audience the token is verified against
+        :return: A hex digest identifying the token, issuer and audience
+        """
+        return hashlib.sha256(
+            '\n'.join([token, issuer or '', audience or '']).encode('utf-8')
+        ).hexdigest()
+
+    def get(self, key: str) -> bool:
+        """Check if a token has been verified and hasn't yet expired
+
+        :param key: The cache key from VerifiedTokenCache.key
+        :return: True if the token is cached and still valid, otherwise False
+        """
+        with self._lock:
+            expiry = self._entries.get(key)
+            if expiry is not None and expiry > time.time():
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return True
+            if expiry is not None:
+                del self._entries[key]
+                self.stats['evictions'] += 1
+            self.stats['misses'] += 1
+            return False
+
+    def put(self, key: str, expiry: Optional[int]) -> None:
+        """Record that a token was verified
+
+        :param key: The cache key from VerifiedTokenCache.key
+        :param expiry: Seconds since the epoch at which the token expires. If
+            None the token isn't cached
+        """
+        if expiry is None or self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = int(expiry)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,210 @@
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = 'auth0-cis-webhook-consumer'
+
+# CloudWatch accepts at most 100 values for a metric in one EMF document
+MAX_VALUES = 100
+
+
+def get_metrics_settings() -> dict:
+    """Read the metrics settings from the environment
+
+    These are read here rather than in Config as sessions.py, which Config
+    depends on, records upstream calls
+
+    :return: A dictionary of enabled and namespace
+    """
+    return {
+        'enabled': os.getenv('METRICS', 'emf') == 'emf',
+        'namespace': os.getenv('METRICS_NAMESPACE', 'Auth0CISWebhookConsumer')
+    }
+
+
+class Metrics:
+    """Collect per-stage timings and counts and emit them as CloudWatch
+    Embedded Metric Format
+
+    Values are accumulated in memory during an invocation and written as a
+    few JSON lines to stdout by flush, where CloudWatch Logs extracts them
+    into metrics.
+
+    :param enabled: If False nothing is recorded
+    :param namespace: The CloudWatch metrics namespace
+    """
+
+    def __init__(self, enabled: bool = True, namespace: str = SERVICE_NAME):
+        self.enabled = enabled
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._reset()
+        self._snapshots = {}
+
+    def _reset(self) -> None:
+        self.timings = defaultdict(list)
+        self.counts = defaultdict(float)
+        self.upstreams = defaultdict(lambda: {
+            'timings': [], 'counts': defaultdict(float)})
+
+    def add_time(self, name: str, milliseconds: float) -> None:
+        """Record a duration
+
+        :param name: The metric name, for example the stage
+        :param milliseconds: The duration
+        """
+        if self.enabled:
+            with self._lock:
+                self.timings[name].append(milliseconds)
+
+    def count(self, name: str, value: float = 1) -> None:
+        """Add to a count
+
+        :param name: The metric name
+        :param value: The amount to add
+        """
+        if self.enabled:
+            with self._lock:
+                self.counts[name] += value
+
+    @contextmanager
+    def timer(self, name: str):
+        """Time the body of a with statement
+
+        :param name: The metric name, for example the stage
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, (time.perf_counter() - start) * 1000)
+
+    def record_upstream(
+            self,
+            upstream: str,
+            status: Optional[int],
+            milliseconds: float,
+            retries: int = 0) -> None:
+        """Record an HTTP call to an upstream
+
+        :param upstream: The host called
+        :param status: The HTTP status code or None if no response was
+            received
+        :param milliseconds: The time until the response headers arrived
+        :param retries: The number of times the call was retried
+        """
+        if not self.enabled:
+            return
+        status_name = (
+            'StatusError' if status is None
+            else 'Status429' if status == 429
+            else 'Status{}xx'.format(status // 100))
+        with self._lock:
+            upstream_metrics = self.upstreams[upstream]
+            upstream_metrics['timings'].append(milliseconds)
+            upstream_metrics['counts']['Requests'] += 1
+            upstream_metrics['counts'][status_name] += 1
+            upstream_metrics['counts']['Retries'] += retries
+
+    def record_stats(
+            self,
+            prefix: str,
+            stats: dict,
+            cumulative: bool = True) -> None:
+        """Record the counts of a cache or other component
+
+        :param prefix: Prefix for the metric names, for example
+            "ProfileCache"
+        :param stats: A dictionary of count name and value
+        :param cumulative: If True the stats are running totals and only the
+            change since they were last recorded is counted
+        """
+        if not self.enabled:
+            return
+        previous = self._snapshots.get(prefix, {}) if cumulative else {}
+        for name, value in stats.items():
+            if isinstance(value, (int, float)):
+                delta = value - previous.get(name, 0)
+                if delta:
+                    self.count(prefix + name.title().replace('_', ''), delta)
+        if cumulative:
+            self._snapshots[prefix] = dict(stats)
+
+    def build_documents(self) -> List[dict]:
+        """Build the EMF documents for everything recorded and reset
+
+        :return: A list of EMF document dictionaries
+        """
+        with self._lock:
+            timings, counts, upstreams = (
+                self.timings, self.counts, self.upstreams)
+            self._reset()
+        timestamp = int(time.time() * 1000)
+        documents = []
+
+        def document(dimensions: dict, values: dict, units: dict) -> dict:
+            return dict(dimensions, **values, _aws={
+                'Timestamp': timestamp,
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [list(dimensions)],
+                    'Metrics': [{'Name': name, 'Unit': units[name]}
+                                for name in values]}]})
+
+        values = {name: values[-MAX_VALUES:]
+                  for name, values in timings.items()}
+        values.update(counts)
+        if values:
+            units = {name: 'Milliseconds' if name in timings else 'Count'
+                     for name in values}
+            documents.append(document(
+                {'Service': SERVICE_NAME}, values, units))
+        for upstream, upstream_metrics in upstreams.items():
+            values = {'Latency': upstream_metrics['timings'][-MAX_VALUES:]}
+            values.update(upstream_metrics['counts'])
+            units = {name: 'Milliseconds' if name == 'Latency' else 'Count'
+                     for name in values}
+            documents.append(document(
+                {'Service': SERVICE_NAME, 'Upstream': upstream},
+                values, units))
+        return documents
+
+    def flush(self) -> None:
+        """Write everything recorded to stdout as EMF lines and reset"""
+        if not self.enabled:
+            return
+        lines = [json.dumps(document) for document in self.build_documents()]
+        if lines:
+            sys.stdout.write('\n'.join(lines) + '\n')
+            sys.stdout.flush()
+
+
+METRICS = Metrics(**get_metrics_settings())
+
+
+def timed(name: str) -> Callable:
+    """Decorate a function so that each call's duration is recorded
+
+    :param name: The metric name, for example the stage
+    """
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not METRICS.enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                METRICS.add_time(name, (time.perf_counter() - start) * 1000)
+        return wrapper
+    return decorator
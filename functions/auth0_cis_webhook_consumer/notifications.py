@@ -0,0 +1,99 @@
+import hashlib
+import logging
+from typing import List, Optional, Tuple, Union
+
+from .profiles import json_loads
+
+logger = logging.getLogger(__name__)
+
+
+class Notification:
+    """A CIS notification reduced to the fields the consumer uses
+
+    Batches hold thousands of these so they have fixed slots rather than a
+    per-instance dictionary.
+
+    :param user_id: The CIS user ID, the notification's "id"
+    :param operation: The operation to perform, for example "update"
+    :param timestamp: The notification's "time", if the publisher set one
+    :param token_hash: A hash of the bearer token the notification was
+        POSTed with, if it was POSTed
+    """
+
+    __slots__ = ('id', 'operation', 'timestamp', 'token_hash')
+
+    def __init__(
+            self,
+            user_id: str,
+            operation: str,
+            timestamp: Optional[int] = None,
+            token_hash: Optional[str] = None):
+        self.id = user_id
+        self.operation = operation
+        self.timestamp = timestamp
+        self.token_hash = token_hash
+
+    def __repr__(self) -> str:
+        return 'Notification({!r}, {!r})'.format(self.id, self.operation)
+
+    def __eq__(self, other) -> bool:
+        return (isinstance(other, Notification)
+                and (self.id, self.operation) == (other.id, other.operation))
+
+    @classmethod
+    def from_dict(
+            cls,
+            value,
+            token_hash: Optional[str] = None) -> Optional['Notification']:
+        """Build a notification from a decoded JSON value
+
+        https://github.com/mozilla-iam/cis/blob/73f21ab201b4f242512786dfc8e1707fccf7f3c5/python-modules/cis_notifications/cis_notifications/event.py#L44-L51
+
+        :param value: A decoded CIS notification
+        :param token_hash: A hash of the bearer token it was POSTed with
+        :return: The notification or None if the value isn't a dictionary
+            with an "id" and an "operation"
+        """
+        if not isinstance(value, dict):
+            return None
+        user_id = value.get('id')
+        operation = value.get('operation')
+        if user_id is None or operation is None:
+            return None
+        return cls(user_id, operation, value.get('time'), token_hash)
+
+    def to_dict(self) -> dict:
+        """Return the id and operation, the compact form that is queued"""
+        return {'id': self.id, 'operation': self.operation}
+
+
+def hash_token(token: Optional[str]) -> Optional[str]:
+    """Identify a bearer token without keeping the token itself
+
+    :param token: A raw bearer token
+    :return: A hex digest of the token or None if there's no token
+    """
+    if not token:
+        return None
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def parse_notifications(
+        body: Union[str, bytes],
+        token_hash: Optional[str] = None
+) -> Tuple[List[Optional[Notification]], bool]:
+    """Decode a POSTed body into notifications in one pass
+
+    The body is decoded with orjson when it's installed.
+
+    :param body: A JSON CIS notification or a JSON array of them
+    :param token_hash: A hash of the bearer token the body was POSTed with
+    :return: A tuple of a list with a notification, or None if it's invalid,
+        for each notification in the body and whether the body was an array
+    :raises ValueError: If the body isn't valid JSON
+    """
+    value = json_loads(body)
+    if isinstance(value, list):
+        return [Notification.from_dict(item, token_hash)
+                for item in value], True
+    return [Notification.from_dict(value, token_hash)], False
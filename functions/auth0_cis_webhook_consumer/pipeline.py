@@ -0,0 +1,341 @@
+import asyncio
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+from . import utils
+from .coalesce import CoalescingWindow
+from .config import CONFIG
+from .dedup_store import notification_key
+from .metrics import METRICS, timed
+from .notifications import Notification
+from .retry_queue import SQSRetryQueue, get_backoff, get_retry_queue
+
+logger = logging.getLogger(__name__)
+
+# Stop taking messages from the retry queue once less time than this remains
+REPLAY_MARGIN_MILLIS = 60000
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Return the thread pool used to run blocking upstream calls
+
+    The pool is created once and kept in the AWS Lambda global scope. It has
+    one thread for every concurrent call allowed to each upstream, including
+    each Management API target.
+    """
+    global executor
+    if 'executor' not in globals():
+        executor = ThreadPoolExecutor(
+            max_workers=(CONFIG.personapi_concurrency
+                         + CONFIG.management_api_concurrency
+                         * CONFIG.management_api_target_count),
+            thread_name_prefix='upstream')
+    return executor
+
+
+async def process_auth0_users_async(
+        notifications: List[Optional[Notification]],
+        get_remaining_time_in_millis: Callable[[], int]) -> List[bool]:
+    """Process a batch of CIS notifications concurrently
+
+    Each notification passes through two stages, fetching the profile from
+    the PersonAPI and then writing to the Auth0 Management API of every
+    target at once. The PersonAPI and each target have their own concurrency
+    limit so that profile fetches for some users overlap with Management API
+    writes for others, and a slow Auth0 tenant doesn't hold up the rest.
+
+    Notifications are coalesced by user so that a user republished many
+    times in one batch is only processed once, with the operation chosen by
+    the rules in CoalescingWindow. Every notification for a user gets the
+    result of that user's single operation. At most COALESCE_MAX_USERS users
+    are held at once and larger batches are processed in several windows.
+
+    :param notifications: A list of CIS notifications, None for those which
+        were invalid
+    :param get_remaining_time_in_millis: Function that returns how much time
+        remains to complete execution
+    :return: A list of booleans, one for each notification in the order they
+        were passed, indicating if processing succeeded
+    """
+    loop = asyncio.get_running_loop()
+    pool = get_executor()
+    personapi_limit = asyncio.Semaphore(CONFIG.personapi_concurrency)
+    management_api_limits = defaultdict(
+        lambda: asyncio.Semaphore(CONFIG.management_api_concurrency))
+
+    async def send(user_id: str, update: dict) -> bool:
+        async with management_api_limits[update.get('target')]:
+            return await loop.run_in_executor(
+                pool, utils.send_auth0_update, user_id, update,
+                get_remaining_time_in_millis)
+
+    async def process(user_id: str, operation: str) -> bool:
+        try:
+            async with personapi_limit:
+                success, updates = await loop.run_in_executor(
+                    pool, utils.prepare_auth0_updates, user_id, operation)
+            results = await asyncio.gather(
+                *[send(user_id, update) for update in updates])
+            return success and all(results)
+        except Exception as e:
+            logger.error('Unable to process %s for %s : %s',
+                         operation, user_id, e)
+            return False
+
+    window = CoalescingWindow(CONFIG.coalesce_max_users)
+    results = {}
+
+    async def process_window() -> None:
+        operations = window.drain()
+        window_results = await asyncio.gather(
+            *[process(user_id, operation)
+              for _, user_id, operation in operations])
+        results.update(zip(
+            [key for key, _, _ in operations], window_results))
+
+    keys = []
+    for notification in notifications:
+        if notification is None:
+            keys.append(None)
+            continue
+        user_id, operation = notification.id, notification.operation
+        if window.is_full(user_id, operation):
+            await process_window()
+        keys.append(window.add(user_id, operation))
+    await process_window()
+    METRICS.record_stats('Coalesce', {
+        'received': window.stats['received'],
+        'collapsed': window.stats['collapsed']}, cumulative=False)
+    logger.info(
+        'Processed %s unique users out of %s notifications received, '
+        'collapsing %s',
+        len(results), len(notifications), window.stats['collapsed'])
+    return [results.get(key, False) for key in keys]
+
+
+@timed('ProcessBatch')
+def process_auth0_users(
+        notifications: List[Optional[Notification]],
+        get_remaining_time_in_millis: Callable[[], int]) -> List[bool]:
+    """Process a batch of CIS notifications in a single invocation
+
+    A synchronous wrapper around process_auth0_users_async. Access tokens,
+    discovery documents and HTTP connections are held in the AWS Lambda
+    global scope and are shared by every notification in the batch.
+
+    :param notifications: A list of CIS notifications, None for those which
+        were invalid
+    :param get_remaining_time_in_millis: Function that returns how much time
+        remains to complete execution
+    :return: A list of booleans, one for each notification in the order they
+        were passed, indicating if processing succeeded
+    """
+    return asyncio.run(process_auth0_users_async(
+        notifications, get_remaining_time_in_millis))
+
+
+def get_retry_queues() -> tuple:
+    """Return the retry queue and its dead-letter queue, creating them on first
+    use
+
+    :return: A tuple of the retry queue and the dead-letter queue, either of
+        which may be None if not configured
+    """
+    global retry_queues
+    if 'retry_queues' not in globals():
+        retry_queues = (
+            get_retry_queue(CONFIG.retry_queue, CONFIG.retry_queue_location),
+            get_retry_queue(
+                CONFIG.retry_queue, CONFIG.retry_dead_letter_location))
+    return retry_queues
+
+
+def get_ingest_queue() -> Optional[SQSRetryQueue]:
+    """Return the SQS queue that /post hands notifications to, creating it on
+    first use
+
+    :return: The queue or None if notifications are processed as they're
+        POSTed
+    """
+    global ingest_queue
+    if 'ingest_queue' not in globals():
+        ingest_queue = (
+            SQSRetryQueue(CONFIG.ingest_queue_url)
+            if CONFIG.ingest_queue_url else None)
+    return ingest_queue
+
+
+def enqueue_notifications(
+        notifications: List[Optional[Notification]]) -> List[bool]:
+    """Hand notifications to the ingest queue to be processed in batches
+
+    Only the id and operation of each notification are queued. The SQS event
+    source mapping delivers them back to the function as batches.
+
+    :param notifications: A list of CIS notifications, None for those which
+        were invalid
+    :return: A list of booleans, one for each notification, indicating if it
+        was queued
+    """
+    results = [False] * len(notifications)
+    indexes = []
+    records = []
+    for index, notification in enumerate(notifications):
+        if notification is None:
+            logger.error('Unable to queue an invalid notification')
+            continue
+        indexes.append(index)
+        records.append(notification.to_dict())
+    if not records:
+        return results
+    try:
+        sent = get_ingest_queue().send_batch(records)
+    except Exception as e:
+        logger.error('Unable to queue notifications : %s', e)
+        sent = [False] * len(records)
+    for index, result in zip(indexes, sent):
+        results[index] = result
+    return results
+
+
+def skip_duplicates(
+        notifications: List[Optional[Notification]],
+        process: Callable[[List[Optional[Notification]]], List[bool]]
+) -> List[bool]:
+    """Process only the notifications which haven't been seen before
+
+    CIS may deliver a notification more than once. Each is claimed in the
+    dedup store and those already claimed are reported as succeeded without
+    being processed again. Notifications which fail, or are being processed
+    when process raises, are released so that a redelivery of them is
+    processed.
+
+    :param notifications: A list of CIS notifications, None for those which
+        were invalid
+    :param process: Function given the new notifications that returns a
+        list of booleans indicating if processing each succeeded
+    :return: A list of booleans, one for each notification, indicating if
+        processing succeeded or it was a duplicate
+    """
+    if utils.DEDUP_STORE is None:
+        return process(notifications)
+    keys = [notification_key(notification)
+            if notification is not None else None
+            for notification in notifications]
+    results = [True] * len(notifications)
+    indexes = [index for index, key in enumerate(keys)
+               if key is None or utils.DEDUP_STORE.claim(key)]
+    if len(indexes) < len(notifications):
+        logger.info('Skipping %s duplicate notifications',
+                    len(notifications) - len(indexes))
+    if not indexes:
+        return results
+    try:
+        processed = process([notifications[index] for index in indexes])
+    except Exception:
+        # Nothing is known to have been processed, so every claim is
+        # released for a redelivery to be processed
+        for index in indexes:
+            if keys[index] is not None:
+                utils.DEDUP_STORE.release(keys[index])
+        raise
+    for index, result in zip(indexes, processed):
+        results[index] = result
+        if not result and keys[index] is not None:
+            utils.DEDUP_STORE.release(keys[index])
+    return results
+
+
+def queue_retries(
+        notifications: List[Optional[Notification]],
+        results: List[bool]) -> int:
+    """Add the notifications which failed to the retry queue
+
+    :param notifications: A list of CIS notifications, None for those which
+        were invalid
+    :param results: A list of booleans, one for each notification,
+        indicating if processing succeeded
+    :return: The number of notifications queued
+    """
+    retry_queue = get_retry_queues()[0]
+    if retry_queue is None:
+        return 0
+    queued = set()
+    for notification, result in zip(notifications, results):
+        if result or notification is None:
+            continue
+        key = (notification.id, notification.operation)
+        if key in queued:
+            continue
+        try:
+            retry_queue.send(
+                {'id': key[0], 'operation': key[1], 'attempts': 1},
+                get_backoff(1, CONFIG.retry_backoff, CONFIG.retry_max_backoff))
+        except Exception as e:
+            logger.critical(
+                'Unable to queue %s for %s to be retried. As a result this '
+                'update will be lost : %s', key[1], key[0], e)
+            continue
+        queued.add(key)
+    if queued:
+        logger.info('Queued %s notifications to be retried', len(queued))
+    return len(queued)
+
+
+def replay_retry_queue(
+        get_remaining_time_in_millis: Callable[[], int],
+        max_messages: int = 10) -> dict:
+    """Drain the retry queue through the batch processing pipeline
+
+    Each message records how many times its notification has been tried.
+    Notifications which fail again are put back on the queue with an
+    exponentially increasing delay until they've been tried
+    RETRY_MAX_ATTEMPTS times, after which they're moved to the dead-letter
+    queue.
+
+    :param get_remaining_time_in_millis: Function that returns how much time
+        remains to complete execution
+    :param max_messages: The number of messages to process in each batch
+    :return: A dictionary of counts of the messages replayed, succeeded,
+        requeued and dead_lettered
+    """
+    retry_queue, dead_letter_queue = get_retry_queues()
+    stats = {'replayed': 0, 'succeeded': 0, 'requeued': 0, 'dead_lettered': 0}
+    if retry_queue is None:
+        logger.error('No retry queue is configured')
+        return stats
+    while get_remaining_time_in_millis() > REPLAY_MARGIN_MILLIS:
+        messages = retry_queue.receive(max_messages)
+        if not messages:
+            break
+        notifications = [
+            Notification.from_dict(message) for _, message in messages]
+        # The profile may have changed since the notification failed, and the
+        # cache may hold the stale copy it was tried with, so it's fetched
+        # again
+        utils.invalidate_user_profiles(notifications)
+        results = process_auth0_users(
+            notifications, get_remaining_time_in_millis)
+        for (handle, message), result in zip(messages, results):
+            stats['replayed'] += 1
+            attempts = message.get('attempts', 1) + 1
+            if result:
+                stats['succeeded'] += 1
+            elif attempts < CONFIG.retry_max_attempts:
+                retry_queue.send(
+                    dict(message, attempts=attempts),
+                    get_backoff(attempts, CONFIG.retry_backoff,
+                                CONFIG.retry_max_backoff))
+                stats['requeued'] += 1
+            elif dead_letter_queue is not None:
+                dead_letter_queue.send(dict(message, attempts=attempts))
+                stats['dead_lettered'] += 1
+            else:
+                logger.critical('Giving up on %s after %s attempts : %s',
+                                message.get('id'), attempts, message)
+                stats['dead_lettered'] += 1
+            retry_queue.delete(handle)
+    logger.info('Replayed the retry queue : %s', stats)
+    return stats
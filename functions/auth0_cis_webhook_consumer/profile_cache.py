@@ -0,0 +1,167 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryProfileCache:
+    """A bounded LRU cache of pruned PersonAPI profiles with a TTL
+
+    Profiles are kept in the AWS Lambda global scope. Counts of hits, misses,
+    evictions and invalidations are kept until they're collected with
+    pop_stats, once per invocation.
+
+    :param ttl: Seconds to keep a profile for
+    :param max_size: The maximum number of profiles to keep
+    """
+
+    def __init__(self, ttl: int = 300, max_size: int = 1000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = self._empty_stats()
+
+    @staticmethod
+    def _empty_stats() -> dict:
+        return {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get(self, user_id: str) -> Optional[dict]:
+        """Return the cached profile for a user
+
+        :param user_id: A CIS user ID
+        :return: The profile or None if it isn't cached or has expired
+        """
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[1] > time.time():
+                self._entries.move_to_end(user_id)
+                self.stats['hits'] += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[user_id]
+                self.stats['evictions'] += 1
+            self.stats['misses'] += 1
+            return None
+
+    def put(self, user_id: str, profile: dict) -> None:
+        """Cache a profile
+
+        :param user_id: A CIS user ID
+        :param profile: The pruned profile from read_profile
+        """
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[user_id] = (profile, time.time() + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def invalidate(self, user_id: str) -> None:
+        """Forget a user's profile because a new notification arrived for it
+
+        :param user_id: A CIS user ID
+        """
+        with self._lock:
+            if self._entries.pop(user_id, None) is not None:
+                self.stats['invalidations'] += 1
+
+    def pop_stats(self) -> dict:
+        """Return the counts since they were last collected and reset them"""
+        with self._lock:
+            stats, self.stats = self.stats, self._empty_stats()
+        stats['size'] = len(self._entries)
+        return stats
+
+
+class DynamoDBProfileCache(MemoryProfileCache):
+    """A cache of pruned PersonAPI profiles shared by all containers
+
+    Profiles aren't also kept in memory as an invalidation made by one
+    container couldn't reach the memory of the others. The table must have a
+    string partition key named "id". Enabling DynamoDB TTL on the "expiry"
+    attribute removes expired profiles.
+
+    :param table_name: The name of the DynamoDB table
+    :param ttl: Seconds to keep a profile for
+    """
+
+    def __init__(self, table_name: str, ttl: int = 300):
+        super().__init__(ttl, 0)
+        self.table_name = table_name
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import boto3
+            self._client = boto3.client('dynamodb')
+        return self._client
+
+    def _key(self, user_id: str) -> dict:
+        return {'id': {'S': 'profile#{}'.format(user_id)}}
+
+    def get(self, user_id: str) -> Optional[dict]:
+        from botocore.exceptions import ClientError
+        try:
+            item = self.client.get_item(
+                TableName=self.table_name,
+                Key=self._key(user_id),
+                ConsistentRead=True).get('Item')
+        except ClientError as e:
+            logger.error('Unable to read cached profile : %s', e)
+            item = None
+        if item is None or int(item['expiry']['N']) <= time.time():
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        return json.loads(item['profile']['S'])
+
+    def put(self, user_id: str, profile: dict) -> None:
+        from botocore.exceptions import ClientError
+        item = dict(self._key(user_id))
+        item.update({
+            'profile': {'S': json.dumps(profile)},
+            'expiry': {'N': str(int(time.time() + self.ttl))}})
+        try:
+            self.client.put_item(TableName=self.table_name, Item=item)
+        except ClientError as e:
+            logger.error('Unable to cache profile : %s', e)
+
+    def invalidate(self, user_id: str) -> None:
+        from botocore.exceptions import ClientError
+        try:
+            self.client.delete_item(
+                TableName=self.table_name, Key=self._key(user_id))
+        except ClientError as e:
+            logger.error('Unable to invalidate cached profile : %s', e)
+            return
+        self.stats['invalidations'] += 1
+
+
+def get_profile_cache(
+        backend: str,
+        table_name: Optional[str] = None,
+        ttl: int = 300,
+        max_size: int = 1000) -> Optional[MemoryProfileCache]:
+    """Build the PersonAPI profile cache for a backend
+
+    :param backend: One of "memory", "dynamodb" or "none"
+    :param table_name: The DynamoDB table name for the dynamodb backend
+    :param ttl: Seconds to keep a profile for
+    :param max_size: The maximum number of profiles to keep in memory
+    :return: A profile cache or None if caching is disabled
+    """
+    if backend == 'none':
+        return None
+    elif backend == 'dynamodb':
+        return DynamoDBProfileCache(table_name, ttl)
+    elif backend != 'memory':
+        logger.error('Unknown profile cache %s, using memory', backend)
+    return MemoryProfileCache(ttl, max_size)
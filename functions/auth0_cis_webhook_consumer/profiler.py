@@ -0,0 +1,75 @@
+import logging
+import os
+import sys
+import threading
+from collections import Counter
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class SamplingProfiler:
+    """Periodically sample the stack of every thread during an invocation
+
+    Samples are aggregated into collapsed stacks, one line of semicolon
+    separated frames and a count, which can be fed to flamegraph tools.
+    Sampling happens in a background thread so the profiled code isn't
+    modified and the overhead is set by the interval.
+
+    :param interval: Seconds between samples
+    :param top: The number of most frequent stacks to log
+    """
+
+    def __init__(self, interval: float = 0.005, top: int = 20):
+        self.interval = interval
+        self.top = top
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{}:{}'.format(
+                        os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self) -> None:
+        self.stacks.clear()
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._sample, name='profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop sampling and log the most frequent stacks"""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        total = sum(self.stacks.values())
+        logger.info('Profiler collected %s samples, most frequent '
+                    'stacks :\n%s', total, '\n'.join(
+                        '{} {}'.format(stack, count)
+                        for stack, count in self.stacks.most_common(
+                            self.top)))
+
+
+def get_profiler() -> Optional[SamplingProfiler]:
+    """Build the sampling profiler if PROFILER is set to "sampling"
+
+    :return: A profiler or None if profiling is disabled
+    """
+    if os.getenv('PROFILER', 'none') != 'sampling':
+        return None
+    return SamplingProfiler(
+        interval=float(os.getenv('PROFILER_INTERVAL', '0.005')),
+        top=int(os.getenv('PROFILER_TOP', '20')))
@@ -0,0 +1,93 @@
+import json
+import logging
+from typing import Optional
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+try:
+    import ijson
+    PARSE_ERRORS = (ValueError, ijson.JSONError)
+except ImportError:
+    ijson = None
+    PARSE_ERRORS = (ValueError,)
+
+logger = logging.getLogger(__name__)
+
+# The only attributes of a CIS profile that are used
+PROFILE_FIELDS = ('uuid', 'access_information')
+
+
+def prune_profile(profile: dict) -> dict:
+    """Keep only the attributes of a CIS profile which are used
+
+    The metadata and signature blocks of each access_information publisher
+    are dropped along with every other attribute.
+
+    :param profile: A CIS user profile
+    :return: A profile containing uuid and the values of each
+        access_information publisher
+    """
+    access_information = profile.get('access_information') or {}
+    return {
+        'uuid': profile.get('uuid') or {},
+        'access_information': {
+            publisher: {'values': data.get('values')}
+            for publisher, data in access_information.items()
+            if isinstance(data, dict)}}
+
+
+def stream_profile(fileobj) -> dict:
+    """Parse a CIS profile incrementally, only building the attributes used
+
+    Requires the optional ijson package. Attributes other than those in
+    PROFILE_FIELDS are parsed but never turned into Python objects.
+
+    :param fileobj: A file like object of the JSON profile
+    :return: A pruned profile
+    """
+    profile = {}
+    builder = None
+    depth = 0
+    for prefix, event, value in ijson.parse(fileobj, use_float=True):
+        if builder is None:
+            if (event == 'map_key' and prefix == ''
+                    and value in PROFILE_FIELDS):
+                field = value
+                builder = ijson.ObjectBuilder()
+            continue
+        builder.event(event, value)
+        if event in ('start_map', 'start_array'):
+            depth += 1
+        elif event in ('end_map', 'end_array'):
+            depth -= 1
+        if depth == 0:
+            profile[field] = builder.value
+            builder = None
+    return prune_profile(profile)
+
+
+def read_profile(response, stream: bool = False) -> Optional[dict]:
+    """Decode a PersonAPI profile response once, keeping only what's used
+
+    :param response: A requests Response, requested with stream=True if
+        stream is True
+    :param stream: If True parse the response incrementally as it's read
+    :return: A pruned profile or None if the response isn't valid JSON
+    """
+    try:
+        if stream:
+            response.raw.decode_content = True
+            return stream_profile(response.raw)
+        profile = json_loads(response.content)
+    except PARSE_ERRORS as e:
+        logger.error('Unable to parse user profile : %s', e)
+        return None
+    finally:
+        response.close()
+    if not isinstance(profile, dict):
+        return None
+    return prune_profile(profile)
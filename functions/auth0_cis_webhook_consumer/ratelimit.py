@@ -0,0 +1,326 @@
+import logging
+import random
+import threading
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Every call ends well within this many seconds, so reservations older than
+# this which were never answered or cancelled are forgotten
+IN_FLIGHT_EXPIRY = 60
+
+
+def parse_ratelimit_headers(headers) -> Optional[tuple]:
+    """Parse the Auth0 Management API ratelimit headers
+
+    https://auth0.com/docs/troubleshoot/customer-support/operational-policies/rate-limit-policy
+
+    :param headers: HTTP response headers
+    :return: A tuple of limit, remaining and reset or None if the headers are
+        missing
+    """
+    try:
+        return (int(headers['X-RateLimit-Limit']),
+                int(headers['X-RateLimit-Remaining']),
+                int(headers['X-RateLimit-Reset']))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def estimate_rate(
+        limit: int,
+        remaining: int,
+        reset: int,
+        now: float) -> Optional[float]:
+    """Estimate the refill rate of the server's bucket
+
+    Auth0 reports the time at which the bucket will be full again, so the
+    refill rate is the number of missing tokens over the time until then.
+    As the reset time is rounded up to a whole second this is a lower bound
+    of the true rate.
+
+    :return: Tokens per second or None if the bucket is full and the rate
+        can't be estimated
+    """
+    if remaining >= limit or reset <= now:
+        return None
+    return (limit - remaining) / (reset - now)
+
+
+def refill(state: dict, now: float) -> None:
+    """Add the tokens that have accumulated since the state was updated"""
+    if state['rate'] and state['tokens'] is not None:
+        state['tokens'] = min(
+            state['capacity'],
+            state['tokens'] + (now - state['updated']) * state['rate'])
+    state['updated'] = now
+
+
+def expire_in_flight(state: dict, now: float) -> None:
+    """Forget reservations which are too old to still be in flight
+
+    Reservations are counted in two generations, the current one in
+    in_flight and the previous one in in_flight_previous. Each generation
+    lasts IN_FLIGHT_EXPIRY seconds, after which the previous generation is
+    dropped, so a reservation whose call never finished is only counted for
+    at most twice that.
+    """
+    elapsed = now - (state['in_flight_since'] or 0)
+    if elapsed < IN_FLIGHT_EXPIRY:
+        return
+    state['in_flight_previous'] = (
+        (state['in_flight'] or 0) if elapsed < 2 * IN_FLIGHT_EXPIRY else 0)
+    state['in_flight'] = 0
+    state['in_flight_since'] = now
+
+
+def count_in_flight(state: dict) -> float:
+    return (state['in_flight'] or 0) + (state['in_flight_previous'] or 0)
+
+
+def finish_call(state: dict, now: float) -> None:
+    """Stop counting one reservation as in flight, taking it from the
+    older generation first"""
+    expire_in_flight(state, now)
+    if state['in_flight_previous']:
+        state['in_flight_previous'] -= 1
+    elif state['in_flight']:
+        state['in_flight'] -= 1
+
+
+def take_token(state: dict, now: float) -> float:
+    """Take a token from a bucket's state
+
+    If the bucket is empty a future token is reserved, so concurrent callers
+    queue up behind each other instead of all waking at once.
+
+    :param state: A dictionary of rate, capacity, tokens, updated,
+        in_flight, in_flight_previous and in_flight_since
+    :param now: Seconds since the epoch
+    :return: Seconds the caller must wait before making its call
+    """
+    refill(state, now)
+    expire_in_flight(state, now)
+    state['in_flight'] = (state['in_flight'] or 0) + 1
+    if not state['rate'] or state['tokens'] is None:
+        return 0
+    state['tokens'] -= 1
+    return 0 if state['tokens'] >= 0 else -state['tokens'] / state['rate']
+
+
+def learn_from_headers(state: dict, headers, now: float) -> None:
+    """Update a bucket's state from the ratelimit headers of a response
+
+    The server's remaining count doesn't include calls which have been
+    reserved but not yet answered, so those are subtracted from it.
+
+    :param state: A dictionary of rate, capacity, tokens, updated,
+        in_flight, in_flight_previous and in_flight_since
+    :param headers: HTTP response headers
+    :param now: Seconds since the epoch
+    """
+    refill(state, now)
+    finish_call(state, now)
+    parsed = parse_ratelimit_headers(headers)
+    if parsed is None:
+        return
+    limit, remaining, reset = parsed
+    rate = estimate_rate(limit, remaining, reset, now)
+    if state['rate'] and state['capacity'] == limit:
+        # Each estimate is a lower bound so keep the highest, unless the
+        # limit itself has changed
+        state['rate'] = max(state['rate'], rate or 0)
+    elif rate is not None:
+        state['rate'] = rate
+    state['capacity'] = limit
+    state['tokens'] = remaining - count_in_flight(state)
+
+
+class TokenBucket:
+    """A client side token bucket that paces Auth0 Management API calls
+
+    The bucket's size and refill rate are learned from the
+    X-RateLimit-Limit, X-RateLimit-Remaining and X-RateLimit-Reset headers
+    of each response so that calls are spread out before Auth0 starts
+    returning 429 responses. Until the first response is seen calls are only
+    limited by the optional initial rate.
+
+    :param rate: Optional initial refill rate in tokens per second
+    :param capacity: Optional initial bucket size
+    """
+
+    def __init__(
+            self,
+            rate: Optional[float] = None,
+            capacity: Optional[float] = None):
+        capacity = capacity if capacity is not None else rate
+        self.state = {
+            'rate': rate,
+            'capacity': capacity,
+            'tokens': capacity,
+            'updated': time.time(),
+            'in_flight': 0,
+            'in_flight_previous': 0,
+            'in_flight_since': time.time()}
+        self._lock = threading.Lock()
+        self.stats = {'reservations': 0, 'delayed': 0, 'wait_seconds': 0.0}
+
+    @property
+    def rate(self) -> Optional[float]:
+        return self.state['rate']
+
+    def _record(self, wait: float) -> float:
+        self.stats['reservations'] += 1
+        if wait:
+            self.stats['delayed'] += 1
+            self.stats['wait_seconds'] += wait
+        return wait
+
+    def reserve(self) -> float:
+        """Take a token from the bucket before making a call
+
+        Every call to reserve must be followed by a call to update with the
+        response's headers, or to cancel if the call failed without a
+        response.
+
+        :return: Seconds the caller must wait before making its call
+        """
+        with self._lock:
+            wait = take_token(self.state, time.time())
+        return self._record(wait)
+
+    def update(self, headers) -> None:
+        """Learn the server's bucket from the ratelimit headers of a response
+
+        :param headers: HTTP response headers
+        """
+        with self._lock:
+            learn_from_headers(self.state, headers, time.time())
+
+    def cancel(self) -> None:
+        """End a reservation whose call failed without a response"""
+        with self._lock:
+            finish_call(self.state, time.time())
+
+
+class DynamoDBTokenBucket(TokenBucket):
+    """A token bucket whose state is shared by all containers in DynamoDB
+
+    The table must have a string partition key named "id". Updates use
+    optimistic concurrency on a version attribute. If DynamoDB can't be
+    reached calls are not paced and fall back to waiting after a 429.
+
+    :param table_name: The name of the DynamoDB table
+    :param key: The id of the item holding the bucket's state
+    :param rate: Optional initial refill rate in tokens per second
+    :param capacity: Optional initial bucket size
+    """
+
+    def __init__(
+            self,
+            table_name: str,
+            key: str = 'auth0-management-api-ratelimit',
+            rate: Optional[float] = None,
+            capacity: Optional[float] = None):
+        super().__init__(rate, capacity)
+        self.table_name = table_name
+        self.key = key
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import boto3
+            self._client = boto3.client('dynamodb')
+        return self._client
+
+    def _transact(self, change) -> Optional[float]:
+        """Read, modify and conditionally write the shared bucket state
+
+        :param change: Function given the current state dictionary and the
+            time that modifies the state in place
+        :return: The result of change or None if the state couldn't be
+            written
+        """
+        from botocore.exceptions import ClientError
+        for attempt in range(10):
+            if attempt:
+                # Back off so that writers contending for the item spread out
+                time.sleep(random.uniform(0, 0.005 * 2 ** min(attempt, 5)))
+            try:
+                item = self.client.get_item(
+                    TableName=self.table_name,
+                    Key={'id': {'S': self.key}},
+                    ConsistentRead=True).get('Item')
+            except ClientError as e:
+                logger.error('Unable to read ratelimit state : %s', e)
+                return None
+            if item is None:
+                version = 0
+                state = dict(self.state)
+            else:
+                version = int(item['version']['N'])
+                state = {
+                    name: float(item[name]['N']) if name in item else None
+                    for name in self.state}
+            result = change(state, time.time())
+            attributes = {
+                'id': {'S': self.key},
+                'version': {'N': str(version + 1)}}
+            attributes.update({
+                name: {'N': repr(value)}
+                for name, value in state.items() if value is not None})
+            try:
+                self.client.put_item(
+                    TableName=self.table_name,
+                    Item=attributes,
+                    ConditionExpression=(
+                        'attribute_not_exists(id) OR version = :version'),
+                    ExpressionAttributeValues={
+                        ':version': {'N': str(version)}})
+                self.state = state
+                return result
+            except ClientError as e:
+                if (e.response['Error']['Code']
+                        != 'ConditionalCheckFailedException'):
+                    logger.error('Unable to write ratelimit state : %s', e)
+                    return None
+        logger.error('Unable to write ratelimit state due to contention')
+        return None
+
+    def reserve(self) -> float:
+        return self._record(self._transact(take_token) or 0)
+
+    def update(self, headers) -> None:
+        self._transact(
+            lambda state, now: learn_from_headers(state, headers, now))
+
+    def cancel(self) -> None:
+        self._transact(finish_call)
+
+
+def get_rate_limiter(
+        backend: str,
+        table_name: Optional[str] = None,
+        rate: Optional[float] = None,
+        capacity: Optional[float] = None,
+        key: str = 'auth0-management-api-ratelimit') -> Optional[TokenBucket]:
+    """Build the Auth0 Management API rate limiter for a backend
+
+    :param backend: One of "memory", "dynamodb" or "none"
+    :param table_name: The DynamoDB table name for the dynamodb backend
+    :param rate: Optional initial refill rate in tokens per second
+    :param capacity: Optional initial bucket size
+    :param key: The id of the DynamoDB item holding the bucket's state, which
+        must differ for each Auth0 tenant
+    :return: A token bucket or None if rate limiting is disabled
+    """
+    if backend == 'none':
+        return None
+    elif backend == 'dynamodb':
+        return DynamoDBTokenBucket(
+            table_name, key=key, rate=rate, capacity=capacity)
+    elif backend != 'memory':
+        logger.error('Unknown rate limiter %s, using memory', backend)
+    return TokenBucket(rate, capacity)
@@ -0,0 +1,347 @@
+import json
+import logging
+import os
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, List, Optional, Tuple
+
+import requests
+
+from . import utils
+from .config import CONFIG
+from .digest_cache import groups_digest
+from .sessions import http_request
+
+logger = logging.getLogger(__name__)
+
+# Stop starting new pages once less time than this remains
+RECONCILE_MARGIN_MILLIS = 120000
+
+# The number of user IDs looked up in each Auth0 user search
+AUTH0_SEARCH_SIZE = 25
+
+
+class FileCheckpointStore:
+    """Keep the reconciliation checkpoint in a file
+
+    :param path: The path of the checkpoint file
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> Optional[dict]:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.error('Unable to read reconcile checkpoint : %s', e)
+            return None
+
+    def save(self, checkpoint: dict) -> None:
+        temporary_path = '{}.{}'.format(self.path, os.getpid())
+        with open(temporary_path, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(temporary_path, self.path)
+
+    def clear(self) -> None:
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class DynamoDBCheckpointStore:
+    """Keep the reconciliation checkpoint in a DynamoDB table
+
+    The table must have a string partition key named "id".
+
+    :param table_name: The name of the DynamoDB table
+    :param key: The id of the item holding the checkpoint
+    """
+
+    def __init__(self, table_name: str, key: str = 'reconcile-checkpoint'):
+        self.table_name = table_name
+        self.key = key
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import boto3
+            self._client = boto3.client('dynamodb')
+        return self._client
+
+    def load(self) -> Optional[dict]:
+        item = self.client.get_item(
+            TableName=self.table_name,
+            Key={'id': {'S': self.key}},
+            ConsistentRead=True).get('Item')
+        return json.loads(item['checkpoint']['S']) if item else None
+
+    def save(self, checkpoint: dict) -> None:
+        self.client.put_item(
+            TableName=self.table_name,
+            Item={'id': {'S': self.key},
+                  'checkpoint': {'S': json.dumps(checkpoint)}})
+
+    def clear(self) -> None:
+        self.client.delete_item(
+            TableName=self.table_name, Key={'id': {'S': self.key}})
+
+
+def get_checkpoint_store(backend: str, location: str):
+    """Build the reconciliation checkpoint store for a backend
+
+    :param backend: One of "file" or "dynamodb"
+    :param location: The file path for the file backend or the table name
+        for the dynamodb backend
+    :return: A checkpoint store
+    """
+    if backend == 'dynamodb':
+        return DynamoDBCheckpointStore(location)
+    elif backend != 'file':
+        logger.error('Unknown checkpoint store %s, using file', backend)
+    return FileCheckpointStore(location)
+
+
+def get_profile_pages(
+        next_page: Optional[str]
+) -> Iterator[Tuple[List[dict], Optional[str]]]:
+    """Stream pages of user profiles from the PersonAPI
+
+    Only one page is held in memory at a time.
+
+    :param next_page: The PersonAPI nextPage token to start from or None to
+        start from the beginning
+    :return: An iterator of tuples of a list of profiles and the nextPage
+        token that follows them, which is None after the last page
+    :raises RuntimeError: If a token or page can't be fetched
+    :raises requests.RequestException: If the PersonAPI can't be reached,
+        including when its circuit is open or the deadline has passed
+    """
+    url = '{}/v2/users'.format(CONFIG.personapi_url)
+    while True:
+        authorization = utils.get_authorization(
+            CONFIG.personapi_discovery_document, CONFIG.person_api)
+        if authorization is None:
+            raise RuntimeError('Unable to get a PersonAPI access token')
+        params = {'nextPage': next_page} if next_page else {}
+        response = http_request(
+            'GET',
+            url=url,
+            headers={'authorization': 'Bearer {}'.format(authorization)},
+            params=params)
+        if not response.ok:
+            raise RuntimeError(
+                'Unable to fetch PersonAPI users page {} : {} {}'.format(
+                    next_page, response.status_code, response.text))
+        body = response.json()
+        next_page = body.get('nextPage') or None
+        yield body.get('Items', []), next_page
+        if next_page is None:
+            return
+
+
+def get_auth0_groups_for_users(
+        auth0_user_ids: List[str],
+        headers: dict) -> Optional[dict]:
+    """Fetch the current groups of several Auth0 users in one search
+
+    Requires the Auth0 Management API scope read:users
+
+    :param auth0_user_ids: Auth0 user IDs
+    :param headers: Headers including the Management API authorization
+    :return: A dictionary of Auth0 user ID and list of groups for the users
+        which exist or None if the search failed
+    """
+    query = 'user_id:({})'.format(' OR '.join(
+        '"{}"'.format(user_id.replace('\\', '\\\\').replace('"', '\\"'))
+        for user_id in auth0_user_ids))
+    if utils.AUTH0_RATE_LIMITER is not None:
+        time.sleep(utils.AUTH0_RATE_LIMITER.reserve())
+    response = utils.rate_limited_request(
+        utils.AUTH0_RATE_LIMITER,
+        'GET',
+        url='{}api/v2/users'.format(
+            CONFIG.management_api_discovery_document['issuer']),
+        headers=headers,
+        params={'q': query,
+                'search_engine': 'v3',
+                'fields': 'user_id,app_metadata',
+                'include_fields': 'true',
+                'per_page': len(auth0_user_ids)})
+    if not response.ok:
+        logger.error('Unable to search Auth0 users : %s %s',
+                     response.status_code, response.text)
+        return None
+    return {
+        user['user_id']: user.get('app_metadata', {}).get('groups', [])
+        for user in response.json()}
+
+
+def reconcile_page(
+        profiles: List[dict],
+        headers: dict,
+        writer: ThreadPoolExecutor,
+        get_remaining_time_in_millis: Callable[[], int],
+        dry_run: bool = False) -> dict:
+    """Write the groups of a page of profiles to the Auth0 users which differ
+
+    :param profiles: A list of CIS user profiles
+    :param headers: Headers including the Management API authorization
+    :param writer: The thread pool to send updates with
+    :param get_remaining_time_in_millis: Function that returns how much time
+        remains to complete execution
+    :param dry_run: If True only count the users which differ
+    :return: A dictionary of counts of profiles, unchanged, missing,
+        written and failed
+    """
+    stats = {'profiles': len(profiles), 'unchanged': 0, 'missing': 0,
+             'written': 0, 'failed': 0}
+    issuer = CONFIG.management_api_discovery_document['issuer']
+    wanted = {}
+    for profile in profiles:
+        user_id = profile.get('user_id', {}).get('value')
+        if user_id is None:
+            continue
+        if (CONFIG.user_whitelist is not None
+                and user_id not in CONFIG.user_whitelist):
+            continue
+        wanted[utils.hack_user_id(user_id)] = (
+            user_id, utils.get_access_groups(profile))
+    updates = []
+    auth0_user_ids = list(wanted)
+    for start in range(0, len(auth0_user_ids), AUTH0_SEARCH_SIZE):
+        chunk = auth0_user_ids[start:start + AUTH0_SEARCH_SIZE]
+        current = get_auth0_groups_for_users(chunk, headers)
+        if current is None:
+            stats['failed'] += len(chunk)
+            continue
+        for auth0_user_id in chunk:
+            user_id, access_groups = wanted[auth0_user_id]
+            if auth0_user_id not in current:
+                stats['missing'] += 1
+                continue
+            digest = (''.join([issuer, auth0_user_id]),
+                      groups_digest(access_groups))
+            if groups_digest(current[auth0_user_id]) == digest[1]:
+                stats['unchanged'] += 1
+                if utils.GROUP_DIGESTS is not None:
+                    utils.GROUP_DIGESTS.put(*digest)
+                continue
+            updates.append((user_id, {
+                'url': '{}api/v2/users/{}'.format(
+                    issuer, urllib.parse.quote_plus(auth0_user_id)),
+                'headers': headers,
+                'payload': {'app_metadata': {'groups': access_groups}},
+                'digest': digest}))
+    if dry_run:
+        stats['written'] = len(updates)
+        return stats
+    results = writer.map(
+        lambda update: utils.send_auth0_update(
+            update[0], update[1], get_remaining_time_in_millis),
+        updates)
+    for result in results:
+        stats['written' if result else 'failed'] += 1
+    return stats
+
+
+def new_checkpoint(dry_run: bool) -> dict:
+    return {
+        'next_page': None, 'complete': False, 'started': int(time.time()),
+        'dry_run': dry_run,
+        'stats': {'pages': 0, 'profiles': 0, 'unchanged': 0, 'missing': 0,
+                  'written': 0, 'failed': 0}}
+
+
+def reconcile(
+        get_remaining_time_in_millis: Callable[[], int],
+        dry_run: bool = False,
+        checkpoint: Optional[dict] = None,
+        restart: bool = False) -> dict:
+    """Sync every user's groups from the PersonAPI to Auth0
+
+    Profiles are streamed from the PersonAPI a page at a time and compared
+    with the groups currently in Auth0, and only users whose groups differ
+    are written. After each page a checkpoint is saved so that when time
+    runs out the next invocation resumes from the following page.
+
+    A paused dry run is never resumed as a real run or the other way
+    around, as a real run would skip pages which were never written.
+
+    Requires the Auth0 Management API scopes read:users, update:users and
+    update:users_app_metadata
+
+    :param get_remaining_time_in_millis: Function that returns how much time
+        remains to complete execution
+    :param dry_run: If True only count the users which differ
+    :param checkpoint: The checkpoint to resume from, passed along by the
+        invocation that paused, otherwise it's loaded from the checkpoint
+        store
+    :param restart: If True discard any saved checkpoint and start from the
+        first page
+    :return: The checkpoint, a dictionary of the next_page to resume from,
+        whether the reconciliation is complete, whether it was a dry_run and
+        the counts so far, with the number of pages done by this invocation
+        in "progress" and an "error" if it couldn't run
+    """
+    store = get_checkpoint_store(
+        CONFIG.reconcile_checkpoint_store,
+        CONFIG.reconcile_checkpoint_location)
+    if restart:
+        store.clear()
+    elif checkpoint is None:
+        checkpoint = store.load()
+    if checkpoint is None:
+        checkpoint = new_checkpoint(dry_run)
+    if checkpoint.get('dry_run', False) != dry_run:
+        error = ('A {} reconciliation is paused, resume it or restart'.format(
+            'dry run' if checkpoint.get('dry_run') else 'real'))
+        logger.error(error)
+        return dict(checkpoint, progress=0, error=error)
+    if checkpoint['next_page'] is not None:
+        logger.info('Resuming reconciliation from page %s',
+                    checkpoint['next_page'])
+    authorization = utils.get_authorization(
+        CONFIG.management_api_discovery_document, CONFIG.management_api)
+    if authorization is None:
+        error = 'Unable to get a Management API access token'
+        logger.error(error)
+        return dict(checkpoint, progress=0, error=error)
+    progress = 0
+    headers = {'authorization': 'Bearer {}'.format(authorization)}
+    with ThreadPoolExecutor(
+            max_workers=CONFIG.management_api_concurrency,
+            thread_name_prefix='reconcile') as writer:
+        try:
+            for profiles, next_page in get_profile_pages(
+                    checkpoint['next_page']):
+                page_stats = reconcile_page(
+                    profiles, headers, writer, get_remaining_time_in_millis,
+                    dry_run)
+                checkpoint['stats']['pages'] += 1
+                progress += 1
+                for name, value in page_stats.items():
+                    checkpoint['stats'][name] += value
+                checkpoint['next_page'] = next_page
+                checkpoint['complete'] = next_page is None
+                store.save(checkpoint)
+                if get_remaining_time_in_millis() < RECONCILE_MARGIN_MILLIS:
+                    break
+        except (RuntimeError, requests.RequestException) as e:
+            # The checkpoint of the last page done is saved, so the next
+            # reconciliation resumes from the page that failed
+            error = 'Unable to fetch PersonAPI profiles : {}'.format(e)
+            logger.error(error)
+            return dict(checkpoint, progress=progress, error=error)
+    logger.info('Reconciliation %s : %s',
+                'complete' if checkpoint['complete'] else 'paused',
+                checkpoint['stats'])
+    if checkpoint['complete']:
+        store.clear()
+    return dict(checkpoint, progress=progress)
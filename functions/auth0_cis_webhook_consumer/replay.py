@@ -0,0 +1,270 @@
+"""Replay CIS notifications from a JSONL event log without AWS Lambda
+
+Run from the root of the repository with
+
+    python -m functions.auth0_cis_webhook_consumer.replay events.jsonl \\
+        --output results.jsonl --workers 8 --rate 20
+
+Each line of the input is a CIS notification, for example
+{"id": "ad|Mozilla-LDAP|jdoe", "operation": "update"}, or a JSON string of
+a user ID which is given the --operation option's operation. The input is
+read as a stream, so it can be piped to stdin with "-", and each
+notification is processed by process_auth0_user exactly as a webhook would
+be, using the same configuration environment variables. A JSON result is
+written to the output for each line and throughput is reported on stderr.
+With --dry-run the profiles and Management API tokens are fetched and the
+updates that would be sent are written to the output instead of being
+sent. CloudWatch metrics aren't recorded. Run with --help for the
+options.
+"""
+import argparse
+import json
+import logging
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional, TextIO, Tuple
+
+from . import utils
+from .metrics import METRICS
+from .notifications import Notification
+from .profiles import json_loads
+from .ratelimit import TokenBucket
+from .structured_logging import configure_logging
+
+logger = logging.getLogger(__name__)
+
+# Replays have no AWS Lambda deadline, so each notification is given the
+# longest time an invocation could have to wait out an Auth0 ratelimit
+REPLAY_TIME_BUDGET_MILLIS = 900000
+
+
+def get_remaining_time_in_millis() -> int:
+    return REPLAY_TIME_BUDGET_MILLIS
+
+
+def read_notifications(
+        stream: TextIO,
+        operation: str) -> Iterator[Tuple[int, Optional[Notification]]]:
+    """Parse the lines of a JSONL event log as they are read
+
+    :param stream: A text stream of JSONL
+    :param operation: The operation for lines which are only a user ID
+    :return: An iterator of tuples of the line number and the notification
+        or None if the line isn't a valid notification. Blank lines are
+        skipped
+    """
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            value = json_loads(line)
+        except ValueError:
+            yield number, None
+            continue
+        if isinstance(value, str):
+            yield number, Notification(value, operation)
+        else:
+            yield number, Notification.from_dict(value)
+
+
+def replay_notification(notification: Notification, dry_run: bool) -> dict:
+    """Process one notification
+
+    :param notification: The CIS notification to replay
+    :param dry_run: Whether to only prepare the Management API updates
+        rather than send them
+    :return: A dictionary of the notification's result
+    """
+    result = {'id': notification.id, 'operation': notification.operation}
+    start = time.perf_counter()
+    try:
+        utils.invalidate_user_profiles([notification])
+        if dry_run:
+            success, updates = utils.prepare_auth0_updates(
+                notification.id, notification.operation)
+            result['updates'] = [
+                {'target': update['target'], 'url': update['url'],
+                 'payload': update['payload']} for update in updates]
+        else:
+            success = utils.process_auth0_user(
+                notification.id, notification.operation,
+                get_remaining_time_in_millis)
+    except Exception as e:
+        logger.exception('Unable to replay %s', notification)
+        success = False
+        result['error'] = str(e)
+    result['success'] = bool(success)
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    return result
+
+
+class Progress:
+    """Count replayed notifications and report throughput on a stream
+
+    :param stream: Where to write the reports
+    :param interval: Seconds between reports
+    """
+
+    def __init__(self, stream: TextIO = sys.stderr, interval: float = 5.0):
+        self.stream = stream
+        self.interval = interval
+        self.counts = {'succeeded': 0, 'failed': 0}
+        self.start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def record(self, success: bool) -> None:
+        with self._lock:
+            self.counts['succeeded' if success else 'failed'] += 1
+
+    def report(self) -> None:
+        with self._lock:
+            counts = dict(self.counts)
+        total = counts['succeeded'] + counts['failed']
+        elapsed = time.perf_counter() - self.start
+        print('{} replayed, {} succeeded, {} failed, {:.1f} per second'.format(
+            total, counts['succeeded'], counts['failed'],
+            total / elapsed if elapsed else 0), file=self.stream, flush=True)
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            self.report()
+
+    def __enter__(self) -> 'Progress':
+        if self.interval > 0:
+            self._thread = threading.Thread(
+                target=self._run, name='progress', daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.report()
+
+
+def replay(
+        notifications: Iterator[Tuple[int, Optional[Notification]]],
+        output: TextIO,
+        workers: int = 4,
+        rate: Optional[float] = None,
+        dry_run: bool = False,
+        progress: Optional[Progress] = None) -> dict:
+    """Replay notifications with a pool of workers, writing a JSON result
+    line for each to the output as it completes
+
+    At most twice as many notifications as there are workers are read ahead
+    of those being processed so that an event log of any size can be
+    streamed.
+
+    :param notifications: An iterator of tuples of line number and
+        notification, as returned by read_notifications
+    :param output: A text stream to write the results to
+    :param workers: The number of notifications to process concurrently
+    :param rate: The maximum number of notifications to start each second or
+        None to start them as fast as the workers allow
+    :param dry_run: Whether to only prepare the Management API updates
+        rather than send them
+    :param progress: Optional Progress to record each result in
+    :return: A dictionary of the counts of succeeded and failed
+        notifications
+    """
+    pacer = TokenBucket(rate, 1) if rate else None
+    slots = threading.BoundedSemaphore(workers * 2)
+    lock = threading.Lock()
+    counts = {'succeeded': 0, 'failed': 0}
+
+    def write(line_number: int, result: dict) -> None:
+        result['line'] = line_number
+        with lock:
+            counts['succeeded' if result['success'] else 'failed'] += 1
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+        if progress is not None:
+            progress.record(result['success'])
+
+    def run(line_number: int, notification: Notification) -> None:
+        try:
+            write(line_number, replay_notification(notification, dry_run))
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='replay') as executor:
+        for line_number, notification in notifications:
+            if notification is None:
+                write(line_number, {'success': False,
+                                    'error': 'Invalid notification'})
+                continue
+            slots.acquire()
+            if pacer is not None:
+                time.sleep(pacer.reserve())
+            executor.submit(run, line_number, notification)
+    return counts
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Replay CIS notifications from a JSONL event log')
+    parser.add_argument(
+        'input', nargs='?', default='-',
+        help='JSONL file of notifications, "-" for stdin (default)')
+    parser.add_argument(
+        '--output', default='-',
+        help='JSONL file to write results to, "-" for stdout (default)')
+    parser.add_argument(
+        '--workers', type=int, default=4,
+        help='Notifications to process concurrently (default 4)')
+    parser.add_argument(
+        '--rate', type=float,
+        help='Maximum notifications to start per second (default unlimited)')
+    parser.add_argument(
+        '--operation', default='update',
+        choices=('update', 'delete', 'create'),
+        help='Operation for lines which are only a user ID (default update)')
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help='Prepare the Management API updates and write them to the '
+             'output without sending them')
+    parser.add_argument(
+        '--force', action='store_true',
+        help="Send updates even if the group digest store says the user's "
+             "groups are unchanged")
+    parser.add_argument(
+        '--progress-interval', type=float, default=5.0,
+        help='Seconds between throughput reports on stderr, 0 to only report '
+             'at the end (default 5)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    configure_logging()
+    # Nothing extracts EMF from a replay's stdout, where it would be mixed
+    # with the results, and with no invocations to flush at the end of
+    # every timing would be kept in memory for the whole event log
+    METRICS.enabled = False
+    if args.dry_run or args.force:
+        # A dry run mustn't change the digests shared with the consumer and
+        # a forced replay must not skip users whose groups seem unchanged
+        utils.GROUP_DIGESTS = None
+    input_stream = sys.stdin if args.input == '-' else open(args.input)
+    output = sys.stdout if args.output == '-' else open(args.output, 'w')
+    try:
+        with Progress(interval=args.progress_interval) as progress:
+            counts = replay(
+                read_notifications(input_stream, args.operation), output,
+                args.workers, args.rate, args.dry_run, progress)
+    finally:
+        for stream in (input_stream, output):
+            if stream not in (sys.stdin, sys.stdout):
+                stream.close()
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
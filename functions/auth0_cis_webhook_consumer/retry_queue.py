@@ -0,0 +1,228 @@
+import json
+import logging
+import os
+import time
+import uuid
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def get_backoff(attempts: int, backoff: float, max_backoff: float) -> float:
+    """Return the delay before retrying a notification again
+
+    :param attempts: The number of times the notification has been tried
+    :param backoff: Seconds to wait after the first attempt, doubling with
+        each further attempt
+    :param max_backoff: The maximum number of seconds to wait
+    :return: Seconds to wait
+    """
+    return min(max_backoff, backoff * 2 ** max(attempts - 1, 0))
+
+
+def parse_message(body: str) -> Optional[dict]:
+    """Decode the body of a retry message
+
+    :param body: The JSON message
+    :return: The message or None if it isn't a JSON object
+    """
+    try:
+        message = json.loads(body)
+    except ValueError:
+        return None
+    return message if isinstance(message, dict) else None
+
+
+class FileRetryQueue:
+    """A queue of CIS notifications to retry, kept as files in a directory
+
+    Each message is a JSON file whose name begins with the time it becomes
+    visible so that listing the directory in order returns the messages
+    which are due first. A received message is claimed by renaming it, and a
+    claim which is never deleted is returned to the queue after the
+    visibility timeout.
+
+    :param directory: The directory to write message files to
+    :param visibility_timeout: Seconds before a received message which
+        hasn't been deleted can be received again
+    """
+
+    def __init__(self, directory: str, visibility_timeout: int = 900):
+        self.directory = directory
+        self.visibility_timeout = visibility_timeout
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def send(self, message: dict, delay: float = 0) -> None:
+        """Add a message to the queue
+
+        :param message: A CIS notification dictionary with "id" and
+            "operation" and optionally the number of "attempts"
+        :param delay: Seconds before the message can be received
+        """
+        name = '{:017.6f}-{}.json'.format(time.time() + delay, uuid.uuid4())
+        temporary_path = os.path.join(self.directory, '.' + name)
+        file_descriptor = os.open(
+            temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(file_descriptor, 'w') as f:
+            json.dump(message, f)
+        os.replace(temporary_path, os.path.join(self.directory, name))
+
+    def receive(self, max_messages: int = 10) -> List[Tuple[str, dict]]:
+        """Claim the messages which are due
+
+        :param max_messages: The maximum number of messages to return
+        :return: A list of tuples of a receipt handle and the message
+        """
+        now = time.time()
+        messages = []
+        for name in sorted(os.listdir(self.directory)):
+            if len(messages) >= max_messages:
+                break
+            path = os.path.join(self.directory, name)
+            if name.endswith('.claimed'):
+                try:
+                    if now - os.path.getmtime(path) > self.visibility_timeout:
+                        # The previous receiver never deleted the message
+                        os.replace(path, path[:-len('.claimed')])
+                except OSError:
+                    pass
+                continue
+            if not name.endswith('.json') or name.startswith('.'):
+                continue
+            try:
+                due = float(name.split('-', 1)[0])
+            except ValueError:
+                # Not a message, such as a file left by an editor, so it's
+                # left alone
+                logger.warning('Skipping unexpected retry queue file %s',
+                               name)
+                continue
+            if due > now:
+                break
+            handle = path + '.claimed'
+            try:
+                os.replace(path, handle)
+                os.utime(handle)
+                with open(handle) as f:
+                    body = f.read()
+            except FileNotFoundError:
+                # Another receiver claimed this message first
+                continue
+            except OSError as e:
+                logger.error('Unable to read retry message %s : %s', name, e)
+                continue
+            message = parse_message(body)
+            if message is None:
+                # It would never parse, so it's dropped rather than being
+                # returned to the queue after every visibility timeout
+                logger.critical('Deleting unparsable retry message %s : %s',
+                                name, body)
+                self.delete(handle)
+                continue
+            messages.append((handle, message))
+        return messages
+
+    def delete(self, handle: str) -> None:
+        """Remove a received message from the queue
+
+        :param handle: The receipt handle returned by receive
+        """
+        try:
+            os.remove(handle)
+        except FileNotFoundError:
+            pass
+
+
+class SQSRetryQueue:
+    """A queue of CIS notifications, kept in an AWS SQS queue
+
+    SQS can delay a message for at most 900 seconds so longer backoffs are
+    shortened to that.
+
+    :param queue_url: The URL of the SQS queue
+    """
+
+    MAX_DELAY = 900
+    # The most messages SQS accepts in one SendMessageBatch call
+    MAX_BATCH = 10
+
+    def __init__(self, queue_url: str):
+        self.queue_url = queue_url
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import boto3
+            self._client = boto3.client('sqs')
+        return self._client
+
+    def send(self, message: dict, delay: float = 0) -> None:
+        self.client.send_message(
+            QueueUrl=self.queue_url,
+            MessageBody=json.dumps(message),
+            DelaySeconds=int(min(delay, self.MAX_DELAY)))
+
+    def send_batch(self, messages: List[dict]) -> List[bool]:
+        """Send messages, up to ten in each call to SQS
+
+        :param messages: A list of message dictionaries
+        :return: A list of booleans, one for each message, indicating if it
+            was sent
+        """
+        results = [False] * len(messages)
+        for start in range(0, len(messages), self.MAX_BATCH):
+            response = self.client.send_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[
+                    {'Id': str(index),
+                     'MessageBody': json.dumps(
+                         messages[index], separators=(',', ':'))}
+                    for index in range(
+                        start, min(start + self.MAX_BATCH, len(messages)))])
+            for entry in response.get('Successful', []):
+                results[int(entry['Id'])] = True
+            for entry in response.get('Failed', []):
+                logger.error('Unable to send message %s : %s %s',
+                             messages[int(entry['Id'])], entry.get('Code'),
+                             entry.get('Message'))
+        return results
+
+    def receive(self, max_messages: int = 10) -> List[Tuple[str, dict]]:
+        response = self.client.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=min(max_messages, 10))
+        messages = []
+        for sqs_message in response.get('Messages', []):
+            message = parse_message(sqs_message['Body'])
+            if message is None:
+                logger.critical('Deleting unparsable retry message : %s',
+                                sqs_message['Body'])
+                self.delete(sqs_message['ReceiptHandle'])
+                continue
+            messages.append((sqs_message['ReceiptHandle'], message))
+        return messages
+
+    def delete(self, handle: str) -> None:
+        self.client.delete_message(
+            QueueUrl=self.queue_url, ReceiptHandle=handle)
+
+
+def get_retry_queue(
+        backend: str,
+        location: Optional[str]) -> Optional[FileRetryQueue]:
+    """Build a retry queue for a backend
+
+    :param backend: One of "file", "sqs" or "none"
+    :param location: The directory for the file backend or the queue URL for
+        the sqs backend
+    :return: A retry queue or None if retrying is disabled
+    """
+    if backend == 'none' or not location:
+        return None
+    elif backend == 'file':
+        return FileRetryQueue(location)
+    elif backend == 'sqs':
+        return SQSRetryQueue(location)
+    logger.error('Unknown retry queue %s, retrying is disabled', backend)
+    return None
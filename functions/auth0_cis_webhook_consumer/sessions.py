@@ -0,0 +1,349 @@
+import logging
+import os
+import threading
+import time
+import urllib.parse
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .circuit_breaker import CircuitBreaker, CircuitOpenError
+from .metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+# HTTP sessions are created once per host and kept in the AWS Lambda global
+# scope so that warm invocations reuse live keep-alive connections instead of
+# paying for a new TCP and TLS handshake on every call
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# The circuit breaker and latency estimate of each upstream host
+_upstreams = {}
+
+# The time.monotonic() after which no new calls are started, set for each
+# invocation from its remaining time
+_deadline = None
+
+
+def get_http_settings() -> dict:
+    """Read the connection pool settings from the environment
+
+    :return: A dictionary of pool_size, connect_timeout, read_timeout,
+        retries, backoff_factor, max_retry_after, the adaptive timeout
+        settings and the circuit breaker settings
+    """
+    return {
+        'pool_size': int(os.getenv('HTTP_POOL_SIZE', '10')),
+        'connect_timeout': float(os.getenv('HTTP_CONNECT_TIMEOUT', '3.05')),
+        'read_timeout': float(os.getenv('HTTP_READ_TIMEOUT', '10')),
+        'retries': int(os.getenv('HTTP_RETRIES', '2')),
+        'backoff_factor': float(os.getenv('HTTP_BACKOFF_FACTOR', '0.3')),
+        'max_retry_after': float(os.getenv('HTTP_MAX_RETRY_AFTER', '5')),
+        'adaptive_timeout': (
+            os.getenv('HTTP_ADAPTIVE_TIMEOUT', 'true').lower() == 'true'),
+        'min_read_timeout': float(os.getenv('HTTP_MIN_READ_TIMEOUT', '1')),
+        'circuit_breaker': (
+            os.getenv('CIRCUIT_BREAKER', 'true').lower() == 'true'),
+        'circuit_breaker_failure_rate': float(
+            os.getenv('CIRCUIT_BREAKER_FAILURE_RATE', '0.5')),
+        'circuit_breaker_min_calls': int(
+            os.getenv('CIRCUIT_BREAKER_MIN_CALLS', '10')),
+        'circuit_breaker_window': int(
+            os.getenv('CIRCUIT_BREAKER_WINDOW', '20')),
+        'circuit_breaker_cooldown': float(
+            os.getenv('CIRCUIT_BREAKER_COOLDOWN', '30'))
+    }
+
+
+HTTP_SETTINGS = get_http_settings()
+
+
+def cap_sleep(seconds: float) -> float:
+    """Shorten a sleep so that it ends by the invocation's deadline"""
+    if _deadline is None:
+        return seconds
+    return max(0.0, min(seconds, _deadline - time.monotonic()))
+
+
+class DeadlineRetry(Retry):
+    """A Retry whose sleeps between attempts are bounded
+
+    A Retry-After header is respected for at most HTTP_MAX_RETRY_AFTER
+    seconds, and neither it nor the backoff sleeps past the invocation's
+    deadline, so a degraded upstream can't hold the container
+    """
+
+    def get_retry_after(self, response) -> Optional[float]:
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return cap_sleep(min(retry_after, HTTP_SETTINGS['max_retry_after']))
+
+    def get_backoff_time(self) -> float:
+        return cap_sleep(super().get_backoff_time())
+
+
+def build_session(settings: dict) -> requests.Session:
+    """Create a requests Session with a pooled, retrying adapter
+
+    Connection errors and 5xx responses are retried with exponential backoff,
+    or after the time in a Retry-After header, bounded by DeadlineRetry.
+    429 responses are not retried here as ratelimiting is handled by the
+    caller.
+
+    :param settings: A dictionary of HTTP settings from get_http_settings
+    :return: A new requests Session
+    """
+    retry = DeadlineRetry(
+        total=settings['retries'],
+        backoff_factor=settings['backoff_factor'],
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset(['GET', 'POST', 'PATCH']),
+        raise_on_status=False,
+        respect_retry_after_header=True)
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=settings['pool_size'],
+        max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session(url: str) -> requests.Session:
+    """Return the shared Session for the host of the URL, creating it if needed
+
+    :param url: The URL that will be requested
+    :return: A requests Session dedicated to the scheme and host of the URL
+    """
+    parsed_url = urllib.parse.urlsplit(url)
+    key = (parsed_url.scheme, parsed_url.netloc)
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                logger.debug('Creating HTTP session for %s://%s', *key)
+                session = build_session(HTTP_SETTINGS)
+                _sessions[key] = session
+    return session
+
+
+class DeadlineExceededError(requests.Timeout):
+    """Raised instead of starting a call once the invocation's time is up"""
+
+
+class LatencyEstimate:
+    """Track the smoothed latency of an upstream and its variation
+
+    The read timeout adapts to the upstream the way TCP's retransmission
+    timeout does (RFC 6298), so a call that takes far longer than usual is
+    abandoned early instead of waiting for the fixed read timeout.
+
+    :param min_timeout: The shortest timeout to use
+    :param max_timeout: The longest timeout to use, also used until the
+        first response is seen
+    """
+
+    def __init__(self, min_timeout: float, max_timeout: float):
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.smoothed = None
+        self.variation = None
+        self._lock = threading.Lock()
+
+    def update(self, seconds: float) -> None:
+        """Add the duration of a call
+
+        :param seconds: How long the call took, or the timeout it exceeded
+        """
+        with self._lock:
+            if self.smoothed is None:
+                self.smoothed = seconds
+                self.variation = seconds / 2
+            else:
+                self.variation = (0.75 * self.variation
+                                  + 0.25 * abs(self.smoothed - seconds))
+                self.smoothed = 0.875 * self.smoothed + 0.125 * seconds
+
+    def timeout(self) -> float:
+        """Return the read timeout to use for the next call"""
+        if self.smoothed is None:
+            return self.max_timeout
+        return min(self.max_timeout, max(
+            self.min_timeout, self.smoothed + 4 * self.variation))
+
+
+class Upstream:
+    """The circuit breaker and latency estimate of an upstream host
+
+    :param name: The host
+    :param settings: A dictionary of HTTP settings from get_http_settings
+    """
+
+    def __init__(self, name: str, settings: dict):
+        self.name = name
+        self.adaptive_timeout = settings['adaptive_timeout']
+        self.read_timeout = settings['read_timeout']
+        self.latency = LatencyEstimate(
+            min(settings['min_read_timeout'], settings['read_timeout']),
+            settings['read_timeout'])
+        self.circuit_breaker = CircuitBreaker(
+            name,
+            failure_rate=settings['circuit_breaker_failure_rate'],
+            min_calls=settings['circuit_breaker_min_calls'],
+            window=settings['circuit_breaker_window'],
+            cooldown=settings['circuit_breaker_cooldown']
+        ) if settings['circuit_breaker'] else None
+
+    def get_timeout(self) -> tuple:
+        """Return the connect and read timeouts for the next call"""
+        return (HTTP_SETTINGS['connect_timeout'],
+                self.latency.timeout() if self.adaptive_timeout
+                else self.read_timeout)
+
+
+def get_upstream(name: str) -> Upstream:
+    """Return the Upstream for a host, creating it if needed
+
+    :param name: The host, the netloc of the URL
+    """
+    upstream = _upstreams.get(name)
+    if upstream is None:
+        with _sessions_lock:
+            upstream = _upstreams.get(name)
+            if upstream is None:
+                upstream = Upstream(name, HTTP_SETTINGS)
+                _upstreams[name] = upstream
+    return upstream
+
+
+def get_circuit_breaker_stats() -> dict:
+    """Return the counts of every upstream's circuit breaker added together
+
+    :return: A dictionary of opened and rejected
+    """
+    stats = {'opened': 0, 'rejected': 0}
+    for upstream in list(_upstreams.values()):
+        if upstream.circuit_breaker is not None:
+            for name in stats:
+                stats[name] += upstream.circuit_breaker.stats[name]
+    return stats
+
+
+def set_deadline(remaining_millis: Optional[float]) -> None:
+    """Set how long calls may be started for
+
+    :param remaining_millis: Milliseconds from now after which calls fail
+        without being made, or None to remove the deadline
+    """
+    global _deadline
+    _deadline = (None if remaining_millis is None
+                 else time.monotonic() + remaining_millis / 1000)
+
+
+def cap_timeout(timeout, budget: float):
+    """Shorten a requests timeout so the call ends within the budget
+
+    :param timeout: A requests timeout, a number or a tuple of connect and
+        read timeouts
+    :param budget: Seconds remaining
+    :return: The shortened timeout
+    """
+    if isinstance(timeout, tuple):
+        return tuple(budget if value is None else min(value, budget)
+                     for value in timeout)
+    return budget if timeout is None else min(timeout, budget)
+
+
+def http_request(method: str, url: str, **kwargs) -> requests.Response:
+    """Make an HTTP request over the shared connection pool for the URL's host
+
+    Unless a timeout is passed the read timeout adapts to the host's recent
+    latency. Timeouts are shortened so that calls end before the
+    invocation's deadline, and no call is started once it has passed. Calls
+    to a host whose circuit breaker is open fail without being made. The
+    latency, status code and retries of each call are recorded in the
+    upstream metrics for the host
+
+    :param method: The HTTP method, "GET", "POST", "PATCH" etc
+    :param url: The URL to request
+    :param kwargs: Any additional arguments accepted by requests
+    :return: The requests Response
+    :raises DeadlineExceededError: If the invocation's deadline has passed
+    :raises CircuitOpenError: If the host's circuit breaker is open
+    """
+    netloc = urllib.parse.urlsplit(url).netloc
+    upstream = get_upstream(netloc)
+    if 'timeout' not in kwargs:
+        kwargs['timeout'] = upstream.get_timeout()
+    if _deadline is not None:
+        budget = _deadline - time.monotonic()
+        if budget <= 0:
+            METRICS.count('DeadlineExceeded')
+            raise DeadlineExceededError(
+                'No time remains to call {}'.format(netloc))
+        kwargs['timeout'] = cap_timeout(kwargs['timeout'], budget)
+    breaker = upstream.circuit_breaker
+    if breaker is not None and not breaker.allow():
+        METRICS.count('CircuitOpenRejected')
+        raise CircuitOpenError('The circuit to {} is open'.format(netloc))
+    start = time.perf_counter()
+    try:
+        response = get_session(url).request(method, url, **kwargs)
+    except BaseException as e:
+        # Anything raised, not only a requests error, must be recorded or a
+        # half-open circuit would wait forever for its probe's outcome
+        elapsed = time.perf_counter() - start
+        if breaker is not None:
+            breaker.record(False)
+        if isinstance(e, requests.Timeout):
+            upstream.latency.update(elapsed)
+        METRICS.record_upstream(netloc, None, elapsed * 1000)
+        raise
+    elapsed = time.perf_counter() - start
+    if breaker is not None:
+        breaker.record(response.status_code < 500)
+    if response.status_code < 500:
+        upstream.latency.update(elapsed)
+    retries = getattr(response.raw, 'retries', None)
+    METRICS.record_upstream(
+        netloc,
+        response.status_code,
+        elapsed * 1000,
+        len(retries.history) if retries is not None else 0)
+    return response
+
+
+def open_connection(url: str) -> bool:
+    """Open a keep-alive connection to the URL's host in its shared pool
+
+    A HEAD request is made and its response ignored, so that the TCP and TLS
+    handshakes are done before the first real call. It isn't recorded in the
+    host's circuit breaker, latency estimate or metrics
+
+    :param url: A URL on the host to connect to
+    :return: True if the host answered, whatever the status code, otherwise
+        False
+    """
+    try:
+        get_session(url).head(url, timeout=(
+            HTTP_SETTINGS['connect_timeout'], HTTP_SETTINGS['read_timeout']))
+    except requests.RequestException as e:
+        logger.warning('Unable to open a connection to %s : %s', url, e)
+        return False
+    return True
+
+
+def close_sessions() -> None:
+    """Close every pooled session and its connections and forget each
+    upstream's circuit breaker and latency"""
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+        _upstreams.clear()
@@ -0,0 +1,231 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+TEXT_FORMAT = (
+    "[%(levelname)s] %(asctime)s %(filename)s:%(lineno)d %(message)s\n")
+
+REDACTED = '[REDACTED]'
+
+# Dictionary keys whose values are never logged
+SECRET_KEYS = frozenset((
+    'access_token', 'authorization', 'client_secret', 'id_token', 'password',
+    'refresh_token', 'secret', 'token'))
+
+# JWTs, bearer tokens and secrets embedded in already formatted text
+SECRET_PATTERN = re.compile(
+    r'eyJ[\w-]+\.[\w-]+\.[\w-]*'
+    r'|(?<=Bearer )[^\s\'",]+'
+    r'|(?<=client_secret[\'"]: [\'"])[^\'"]+'
+    r'|(?<=client_secret=)[^\s&]+')
+SECRET_MARKERS = ('eyJ', 'Bearer ', 'client_secret')
+
+CONTAINERS = (dict, list, tuple)
+
+# The attributes every LogRecord has, anything else was passed in extra
+RECORD_ATTRIBUTES = frozenset(
+    logging.LogRecord('', 0, '', 0, '', None, None).__dict__) | {'message'}
+
+
+def get_logging_settings() -> dict:
+    """Read the logging settings from the environment
+
+    These are read here rather than in Config so that logging is set up
+    before Config fetches anything
+
+    :return: A dictionary of level, format, debug_sample_rate and async
+    """
+    return {
+        'level': os.getenv('LOG_LEVEL', 'INFO'),
+        'format': os.getenv('LOG_FORMAT', 'json'),
+        'debug_sample_rate': float(os.getenv('LOG_DEBUG_SAMPLE_RATE', '1')),
+        'async': os.getenv('LOG_ASYNC', 'false') == 'true',
+    }
+
+
+def redact(value):
+    """Copy a log argument with the values of secret keys replaced
+
+    :param value: A log argument, dictionaries, lists and tuples of which are
+        searched for secret keys
+    :return: The value with secrets replaced by [REDACTED]
+    """
+    if isinstance(value, dict):
+        return {
+            key: REDACTED if str(key).lower() in SECRET_KEYS
+            else redact(item) if isinstance(item, CONTAINERS) else item
+            for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        items = [redact(item) if isinstance(item, CONTAINERS) else item
+                 for item in value]
+        return items if isinstance(value, list) else tuple(items)
+    return value
+
+
+def redact_text(text: str) -> str:
+    """Replace JWTs, bearer tokens and client secrets in formatted text"""
+    # Searching for the markers is far quicker than running the pattern
+    if any(marker in text for marker in SECRET_MARKERS):
+        return SECRET_PATTERN.sub(REDACTED, text)
+    return text
+
+
+class RedactingFormatter(logging.Formatter):
+    """A text formatter which keeps secrets out of the message"""
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        return redact_text(super().formatMessage(record))
+
+    def formatException(self, ei) -> str:
+        return redact_text(super().formatException(ei))
+
+    def format(self, record: logging.LogRecord) -> str:
+        if record.args:
+            record.args = redact(record.args)
+        return super().format(record)
+
+
+class JsonFormatter(RedactingFormatter):
+    """Format each record as a single line JSON object
+
+    The object has the level, time, logger, location and message of the
+    record, the exception if there was one and any fields passed with
+    `extra`, so that CloudWatch Logs Insights can query them.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        if record.args:
+            record.args = redact(record.args)
+        document = {
+            'level': record.levelname,
+            'time': '{}.{:03d}Z'.format(
+                time.strftime('%Y-%m-%dT%H:%M:%S',
+                              time.gmtime(record.created)),
+                int(record.msecs)),
+            'logger': record.name,
+            'location': '{}:{}'.format(record.filename, record.lineno),
+            'message': redact_text(record.getMessage()),
+        }
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRIBUTES:
+                document[key] = (
+                    REDACTED if key.lower() in SECRET_KEYS else redact(value))
+        if record.exc_info:
+            document['exception'] = self.formatException(record.exc_info)
+        return json.dumps(document, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Pass only a fraction of DEBUG records
+
+    Records of INFO and above are always passed.
+
+    :param rate: The fraction of DEBUG records to pass, from 0 to 1
+    """
+
+    def __init__(self, rate: float = 1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return (record.levelno > logging.DEBUG or self.rate >= 1
+                or random.random() < self.rate)
+
+
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    """Hand records to a listener thread which formats and writes them
+
+    The stock QueueHandler formats the message before queueing it. Here only
+    the arguments are copied, so that the caller can't change them before
+    they're formatted, and the formatting, redaction and writing are left to
+    the listener.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.args:
+            record.args = redact(record.args)
+        return record
+
+
+def configure_logging(settings: Optional[dict] = None) -> None:
+    """Set up the root logger
+
+    The root logger's existing handler, the Lambda runtime's in AWS Lambda,
+    or a new stream handler is given a JSON or text formatter. With async
+    enabled the handler is moved behind a queue and a listener thread so that
+    logging a record costs the caller little more than queueing it. DEBUG
+    records are sampled at debug_sample_rate.
+
+    :param settings: The result of get_logging_settings, read from the
+        environment if not passed
+    """
+    global _log_queue, _listener
+    settings = get_logging_settings() if settings is None else settings
+    root = logging.getLogger()
+    handlers = [handler for handler in root.handlers
+                if not isinstance(handler, AsyncQueueHandler)]
+    if '_listener' in globals():
+        handlers.extend(_listener.handlers)
+    stop_logging()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    if not handlers:
+        handlers = [logging.StreamHandler()]
+    formatter = (
+        RedactingFormatter(fmt=TEXT_FORMAT) if settings['format'] == 'text'
+        else JsonFormatter())
+    for handler in handlers:
+        handler.setFormatter(formatter)
+        for old_filter in handler.filters[:]:
+            if isinstance(old_filter, SamplingFilter):
+                handler.removeFilter(old_filter)
+    # Neither format includes them and gathering them is a third of the cost
+    # of creating a record
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+    sampling_filter = SamplingFilter(settings['debug_sample_rate'])
+    if settings['async']:
+        _log_queue = queue.Queue()
+        queue_handler = AsyncQueueHandler(_log_queue)
+        queue_handler.addFilter(sampling_filter)
+        root.addHandler(queue_handler)
+        _listener = logging.handlers.QueueListener(
+            _log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+    else:
+        for handler in handlers:
+            handler.addFilter(sampling_filter)
+            root.addHandler(handler)
+    root.setLevel(settings['level'])
+
+
+def flush_logs() -> None:
+    """Wait for the listener thread to write every queued record
+
+    Called at the end of each invocation as AWS Lambda freezes the process,
+    and the listener thread with it, once the handler returns.
+    """
+    if '_log_queue' in globals():
+        _log_queue.join()
+
+
+def stop_logging() -> None:
+    """Write any queued records and stop the listener thread"""
+    global _log_queue, _listener
+    if '_listener' in globals():
+        _listener.stop()
+        del _listener
+        del _log_queue
+
+
+atexit.register(stop_logging)
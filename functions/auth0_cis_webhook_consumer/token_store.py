@@ -0,0 +1,248 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryTokenStore:
+    """Store access tokens in the AWS Lambda global scope
+
+    Each store keeps tokens in memory. Persistent stores extend this, using
+    memory as a front cache and only reading from their backend when the
+    token in memory is missing or about to expire.
+
+    :param entries: Optional dictionary to keep the tokens in
+    """
+
+    def __init__(self, entries: Optional[dict] = None):
+        self.entries = entries if entries is not None else {}
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def get(self, key: str, min_expiry: float = 0) -> Optional[dict]:
+        """Return the stored token for a key
+
+        :param key: The key identifying the issuer and audience of the token
+        :param min_expiry: Seconds since the epoch the token should be valid
+            until. Persistent stores check their backend for a newer token if
+            the one in memory expires before this
+        :return: A dictionary of token and expiry or None
+        """
+        return self.entries.get(key)
+
+    def put(self, key: str, token: str, expiry: int) -> None:
+        """Store a token
+
+        :param key: The key identifying the issuer and audience of the token
+        :param token: The access token
+        :param expiry: Seconds since the epoch at which the token expires
+        """
+        self.entries[key] = {'token': token, 'expiry': expiry}
+
+    def acquire(self, key: str, lease_seconds: int = 30) -> bool:
+        """Try to become the only caller refreshing the token for a key
+
+        :param key: The key identifying the issuer and audience of the token
+        :param lease_seconds: How long the lease is held for if it's never
+            released
+        :return: True if the caller holds the lease and should refresh the
+            token, False if someone else is already refreshing it
+        """
+        with self._locks_lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        return lock.acquire(blocking=False)
+
+    def release(self, key: str) -> None:
+        """Release a lease acquired with acquire
+
+        :param key: The key identifying the issuer and audience of the token
+        """
+        lock = self._locks.get(key)
+        if lock is not None and lock.locked():
+            lock.release()
+
+
+class FileTokenStore(MemoryTokenStore):
+    """Store access tokens in files shared by containers using the same /tmp
+
+    :param directory: The directory to write token files to
+    :param entries: Optional dictionary to keep the tokens in memory in
+    """
+
+    def __init__(self, directory: str, entries: Optional[dict] = None):
+        super().__init__(entries)
+        self.directory = directory
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def _path(self, key: str, suffix: str) -> str:
+        return os.path.join(
+            self.directory,
+            hashlib.sha256(key.encode('utf-8')).hexdigest() + suffix)
+
+    def get(self, key: str, min_expiry: float = 0) -> Optional[dict]:
+        entry = super().get(key)
+        if entry is not None and entry['expiry'] >= min_expiry:
+            return entry
+        try:
+            with open(self._path(key, '.json')) as f:
+                stored = json.load(f)
+        except FileNotFoundError:
+            return entry
+        except (OSError, ValueError) as e:
+            logger.error('Unable to read stored token : %s', e)
+            return entry
+        if entry is None or stored['expiry'] > entry['expiry']:
+            super().put(key, stored['token'], stored['expiry'])
+            return self.entries[key]
+        return entry
+
+    def put(self, key: str, token: str, expiry: int) -> None:
+        super().put(key, token, expiry)
+        path = self._path(key, '.json')
+        temporary_path = '{}.{}.{}'.format(
+            path, os.getpid(), threading.get_ident())
+        try:
+            file_descriptor = os.open(
+                temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(file_descriptor, 'w') as f:
+                json.dump({'token': token, 'expiry': expiry}, f)
+            os.replace(temporary_path, path)
+        except OSError as e:
+            logger.error('Unable to store token : %s', e)
+
+    def acquire(self, key: str, lease_seconds: int = 30) -> bool:
+        if not super().acquire(key, lease_seconds):
+            return False
+        path = self._path(key, '.lease')
+        try:
+            if time.time() - os.path.getmtime(path) > lease_seconds:
+                # The previous holder never released the lease
+                os.remove(path)
+        except OSError:
+            pass
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL, 0o600))
+            return True
+        except FileExistsError:
+            super().release(key)
+            return False
+
+    def release(self, key: str) -> None:
+        try:
+            os.remove(self._path(key, '.lease'))
+        except OSError:
+            pass
+        super().release(key)
+
+
+class DynamoDBTokenStore(MemoryTokenStore):
+    """Store access tokens in a DynamoDB table shared by all containers
+
+    The table must have a string partition key named "id". Enabling
+    DynamoDB TTL on the "expiry" attribute removes expired tokens.
+
+    :param table_name: The name of the DynamoDB table
+    :param entries: Optional dictionary to keep the tokens in memory in
+    """
+
+    def __init__(self, table_name: str, entries: Optional[dict] = None):
+        super().__init__(entries)
+        self.table_name = table_name
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import boto3
+            self._client = boto3.client('dynamodb')
+        return self._client
+
+    def get(self, key: str, min_expiry: float = 0) -> Optional[dict]:
+        entry = super().get(key)
+        if entry is not None and entry['expiry'] >= min_expiry:
+            return entry
+        from botocore.exceptions import ClientError
+        try:
+            item = self.client.get_item(
+                TableName=self.table_name,
+                Key={'id': {'S': key}},
+                ConsistentRead=True).get('Item')
+        except ClientError as e:
+            logger.error('Unable to read stored token : %s', e)
+            return entry
+        if item is None or 'token' not in item:
+            return entry
+        expiry = int(item['expiry']['N'])
+        if entry is None or expiry > entry['expiry']:
+            super().put(key, item['token']['S'], expiry)
+            return self.entries[key]
+        return entry
+
+    def put(self, key: str, token: str, expiry: int) -> None:
+        super().put(key, token, expiry)
+        from botocore.exceptions import ClientError
+        try:
+            self.client.put_item(
+                TableName=self.table_name,
+                Item={'id': {'S': key},
+                      'token': {'S': token},
+                      'expiry': {'N': str(int(expiry))}})
+        except ClientError as e:
+            logger.error('Unable to store token : %s', e)
+
+    def acquire(self, key: str, lease_seconds: int = 30) -> bool:
+        if not super().acquire(key, lease_seconds):
+            return False
+        from botocore.exceptions import ClientError
+        now = int(time.time())
+        try:
+            self.client.put_item(
+                TableName=self.table_name,
+                Item={'id': {'S': '{}#lease'.format(key)},
+                      'expiry': {'N': str(now + lease_seconds)}},
+                ConditionExpression=(
+                    'attribute_not_exists(id) OR expiry < :now'),
+                ExpressionAttributeValues={':now': {'N': str(now)}})
+            return True
+        except ClientError as e:
+            if (e.response['Error']['Code']
+                    != 'ConditionalCheckFailedException'):
+                logger.error('Unable to acquire token lease : %s', e)
+            super().release(key)
+            return False
+
+    def release(self, key: str) -> None:
+        from botocore.exceptions import ClientError
+        try:
+            self.client.delete_item(
+                TableName=self.table_name,
+                Key={'id': {'S': '{}#lease'.format(key)}})
+        except ClientError as e:
+            logger.error('Unable to release token lease : %s', e)
+        super().release(key)
+
+
+def get_token_store(
+        backend: str,
+        location: Optional[str],
+        entries: Optional[dict] = None) -> MemoryTokenStore:
+    """Build the token store for a backend
+
+    :param backend: One of "memory", "file" or "dynamodb"
+    :param location: The directory for the file backend or the table name for
+        the dynamodb backend
+    :param entries: Optional dictionary to keep the tokens in memory in
+    :return: A token store
+    """
+    if backend == 'file':
+        return FileTokenStore(location, entries)
+    elif backend == 'dynamodb':
+        return DynamoDBTokenStore(location, entries)
+    elif backend != 'memory':
+        logger.error('Unknown token store %s, using memory', backend)
+    return MemoryTokenStore(entries)
@@ -0,0 +1,217 @@
+import email.utils
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Optional
+
+from .sessions import http_request
+
+logger = logging.getLogger(__name__)
+
+MAX_AGE_PATTERN = re.compile(r'(?:^|,)\s*(?:s-)?max-age\s*=\s*"?(\d+)"?')
+
+
+def get_ttl(headers, default_ttl: float) -> Optional[float]:
+    """Determine how long a response may be cached from its headers
+
+    :param headers: The HTTP response headers
+    :param default_ttl: Seconds to cache for if the headers don't say
+    :return: The number of seconds the response is fresh for or None if the
+        response must not be cached
+    """
+    cache_control = (headers.get('Cache-Control') or '').lower()
+    if 'no-store' in cache_control:
+        return None
+    if 'no-cache' in cache_control:
+        return 0
+    match = MAX_AGE_PATTERN.search(cache_control)
+    if match:
+        return float(match.group(1))
+    if headers.get('Expires'):
+        try:
+            expires = email.utils.parsedate_to_datetime(headers['Expires'])
+        except (TypeError, ValueError):
+            # An invalid Expires means already expired
+            return 0
+        return max(expires.timestamp() - time.time(), 0)
+    return default_ttl
+
+
+class UrlCache:
+    """A cache of fetched JSON documents which honors HTTP caching headers
+
+    * Fresh entries are returned without any network call
+    * Stale entries are returned immediately while a background thread
+      fetches a replacement
+    * Failed fetches are remembered and retried with exponential backoff so
+      that an outage doesn't cause every request to hit the URL. Any
+      previously fetched value continues to be served in the meantime
+    * Entries can optionally be snapshotted to a file so that new containers
+      sharing the same /tmp skip the network fetch
+
+    :param default_ttl: Seconds to cache a response without caching headers
+    :param min_ttl: Minimum seconds to cache any response for
+    :param max_ttl: Maximum seconds to cache any response for
+    :param negative_ttl: Seconds to wait before retrying after a first failure
+    :param max_negative_ttl: Maximum seconds to wait between retries
+    :param snapshot_path: Optional file path to persist the cache to
+    """
+
+    def __init__(
+            self,
+            default_ttl: float = 3600,
+            min_ttl: float = 60,
+            max_ttl: float = 86400,
+            negative_ttl: float = 5,
+            max_negative_ttl: float = 300,
+            snapshot_path: Optional[str] = None):
+        self.default_ttl = default_ttl
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.max_negative_ttl = max_negative_ttl
+        self.snapshot_path = snapshot_path
+        self._entries = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'failures': 0}
+        self.load_snapshot()
+
+    def get(self, url: str, force: bool = False) -> Optional[dict]:
+        """Return the document at a URL, fetching it if needed
+
+        :param url: The URL of a JSON document
+        :param force: Fetch the URL now even if the cached value is fresh.
+            Forced fetches are limited to one per min_ttl seconds
+        :return: The parsed JSON document or None if it's unavailable
+        """
+        now = time.time()
+        entry = self._entries.get(url)
+        if entry is None:
+            self.stats['misses'] += 1
+            return self.fetch(url)
+        if force:
+            if now - entry['fetched'] >= self.min_ttl:
+                return self.fetch(url)
+            logger.debug('Skipping forced fetch of recently fetched %s', url)
+        if entry['value'] is None:
+            if now < entry['retry_at']:
+                self.stats['misses'] += 1
+                return None
+            return self.fetch(url)
+        if now < entry['expires']:
+            self.stats['hits'] += 1
+        else:
+            self.stats['stale_hits'] += 1
+            if now >= entry['retry_at']:
+                self.refresh_in_background(url)
+        return entry['value']
+
+    def fetch(self, url: str) -> Optional[dict]:
+        """Fetch a URL and store the result
+
+        :param url: The URL of a JSON document
+        :return: The newly fetched document or, if the fetch failed, any
+            previously fetched document or None
+        """
+        logger.debug('Fetching URL : %s', url)
+        now = time.time()
+        try:
+            response = http_request('GET', url)
+            value = response.json() if response.ok else None
+        except (OSError, ValueError) as e:
+            response, value = None, None
+            logger.error('Unable to fetch %s : %s', url, e)
+        with self._lock:
+            entry = self._entries.get(url, {'value': None, 'failures': 0})
+            if value is None:
+                if response is not None:
+                    logger.error('Unable to fetch %s : %s %s',
+                                 url, response.status_code, response.text)
+                self.stats['failures'] += 1
+                entry['failures'] += 1
+                entry['retry_at'] = now + min(
+                    self.negative_ttl * 2 ** (entry['failures'] - 1),
+                    self.max_negative_ttl)
+                entry.setdefault('expires', 0)
+                entry['fetched'] = now
+                self._entries[url] = entry
+                return entry['value']
+            ttl = get_ttl(response.headers, self.default_ttl)
+            if ttl is None:
+                self._entries.pop(url, None)
+                return value
+            self._entries[url] = {
+                'value': value,
+                'expires': now + min(max(ttl, self.min_ttl), self.max_ttl),
+                'fetched': now,
+                'retry_at': 0,
+                'failures': 0}
+        self.save_snapshot()
+        return value
+
+    def refresh_in_background(self, url: str) -> None:
+        """Fetch a URL in a background thread unless already being fetched
+
+        :param url: The URL of a JSON document
+        """
+        with self._lock:
+            if url in self._refreshing:
+                return
+            self._refreshing.add(url)
+
+        def refresh():
+            try:
+                self.fetch(url)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(url)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def load_snapshot(self) -> None:
+        """Load previously fetched documents from the snapshot file"""
+        if not self.snapshot_path:
+            return
+        try:
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error('Unable to load URL cache snapshot %s : %s',
+                         self.snapshot_path, e)
+            return
+        for url, entry in snapshot.items():
+            self._entries[url] = {
+                'value': entry['value'],
+                'expires': entry['expires'],
+                'fetched': entry['fetched'],
+                'retry_at': 0,
+                'failures': 0}
+        logger.debug('Loaded %s URLs from snapshot %s',
+                     len(snapshot), self.snapshot_path)
+
+    def save_snapshot(self) -> None:
+        """Atomically write the successfully fetched documents to the
+        snapshot file"""
+        if not self.snapshot_path:
+            return
+        with self._lock:
+            snapshot = {
+                url: {key: entry[key]
+                      for key in ('value', 'expires', 'fetched')}
+                for url, entry in self._entries.items()
+                if entry['value'] is not None}
+        temporary_path = '{}.{}.{}'.format(
+            self.snapshot_path, os.getpid(), threading.get_ident())
+        try:
+            with open(temporary_path, 'w') as f:
+                json.dump(snapshot, f)
+            os.replace(temporary_path, self.snapshot_path)
+        except OSError as e:
+            logger.error('Unable to save URL cache snapshot %s : %s',
+                         self.snapshot_path, e)
@@ -1,23 +1,80 @@
 import logging
 import time
 
-import requests
 import urllib.parse
-from jose import jwt, exceptions
-from typing import Optional, Callable
-
-from .config import Config
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Callable, List, Tuple
 
-logger = logging.getLogger(__name__)
-CONFIG = Config()
+import requests
 
+from .config import CONFIG, DEFAULT_TARGET_NAME
+from .sessions import get_circuit_breaker_stats, http_request
+from .jwt_cache import KeySet, VerifiedTokenCache
+from .token_store import get_token_store
+from .ratelimit import TokenBucket, get_rate_limiter
+from .dedup_store import get_dedup_store
+from .digest_cache import get_digest_store, groups_digest
+from .group_mapping import GroupMapper
+from .profiles import ijson, read_profile
+from .profile_cache import get_profile_cache
+from .metrics import METRICS, timed
 
-def filter_profile(item):
-    """Strip metadata and signatures from a user profile for easy display"""
-    return (
-        item if type(item) != dict
-        else {key: filter_profile(value) for key, value in item.items()
-              if key not in ['metadata', 'signature']})
+logger = logging.getLogger(__name__)
+VERIFIED_TOKENS = VerifiedTokenCache(CONFIG.verified_token_cache_size)
+JWKS_STATS = {'refreshes': 0}
+TOKEN_STORE = get_token_store(
+    CONFIG.token_store, CONFIG.token_store_location, CONFIG.authorization)
+AUTH0_RATE_LIMITER = get_rate_limiter(
+    CONFIG.rate_limiter,
+    CONFIG.rate_limiter_table,
+    CONFIG.rate_limiter_initial_rate,
+    CONFIG.rate_limiter_initial_burst)
+# The rate limiters of Management API targets other than the default one,
+# created on first use
+TARGET_RATE_LIMITERS = {}
+GROUP_DIGESTS = get_digest_store(
+    CONFIG.group_digest_store,
+    CONFIG.group_digest_table,
+    CONFIG.group_digest_ttl,
+    CONFIG.group_digest_max_size)
+DEDUP_STORE = get_dedup_store(
+    CONFIG.dedup_store,
+    CONFIG.dedup_table,
+    CONFIG.dedup_ttl,
+    CONFIG.dedup_max_size)
+GROUP_MAPPER = GroupMapper(CONFIG.group_mapping_rules)
+PROFILE_CACHE = get_profile_cache(
+    CONFIG.profile_cache,
+    CONFIG.profile_cache_table,
+    CONFIG.profile_cache_ttl,
+    CONFIG.profile_cache_max_size)
+
+
+def wait_for(seconds: float, get_remaining_time_in_millis) -> bool:
+    """If there's enough execution time remaining, sleep for some seconds
+
+    :param seconds: The number of seconds to sleep
+    :param get_remaining_time_in_millis: Function that returns the amount of
+        time remaining to complete execution of the AWS Lambda function in
+        milliseconds
+    :return: True if we have enough time to sleep and we've slept, False if not
+    """
+    if get_remaining_time_in_millis() > (seconds + 30) * 1000:
+        # We have enough remaining time in execution to sleep
+        logger.debug(
+            'Sleeping for %s seconds until the ratelimit resets and more '
+            'calls are available.', seconds)
+        time.sleep(seconds)
+        METRICS.add_time('RateLimitSleep', seconds * 1000)
+        return True
+    else:
+        # We don't have enough time
+        logger.error(
+            'It will be %s seconds until the ratelimit resets and more calls '
+            'are available which exceeds the execution time available to this '
+            'AWS Lambda function of %s milliseconds.',
+            seconds, get_remaining_time_in_millis())
+        return False
 
 
 def wait_for_ratelimit_reset(reset_time, get_remaining_time_in_millis):
@@ -35,75 +92,125 @@ def wait_for_ratelimit_reset(reset_time, get_remaining_time_in_millis):
         reset_time = 0
     reset_time = int(reset_time)
     seconds_until_reset = max(reset_time - time.time(), 0)
-    if get_remaining_time_in_millis() > (seconds_until_reset + 30) * 1000:
-        # We have enough remaining time in execution to sleep
-        logger.debug(
-            'Sleeping for {} seconds until the ratelimit resets and more '
-            'calls are available.'.format(seconds_until_reset))
-        time.sleep(seconds_until_reset)
-        return True
-    else:
-        # We don't have enough time
-        logger.error(
-            'It will be {} seconds until the ratelimit resets and more calls '
-            'are available which exceeds the execution time available to this '
-            'AWS Lambda function of {} milliseconds.'.format(
-                seconds_until_reset,
-                get_remaining_time_in_millis()))
-        return False
+    return wait_for(seconds_until_reset, get_remaining_time_in_millis)
+
+
+def rate_limited_request(
+        rate_limiter: Optional[TokenBucket],
+        method: str,
+        url: str,
+        **kwargs) -> requests.Response:
+    """Make a Management API call which was reserved with the rate limiter
+
+    The limiter learns from the response's ratelimit headers, or if the call
+    fails without a response its reservation is cancelled so that it isn't
+    counted as in flight
+
+    :param rate_limiter: The rate_limiter the call was reserved with, or
+        None
+    :param method: The HTTP method
+    :param url: The URL to request
+    :param kwargs: Any additional arguments accepted by http_request
+    :return: The requests Response
+    """
+    try:
+        response = http_request(method, url=url, **kwargs)
+    except BaseException:
+        if rate_limiter is not None:
+            rate_limiter.cancel()
+        raise
+    if rate_limiter is not None:
+        rate_limiter.update(response.headers)
+    return response
+
 
+def get_key_set(jwks: dict) -> KeySet:
+    """Return the parsed KeySet for a JWKS, parsing it only if it changed
 
-def verify_token(authorization: str, jwks: dict, issuer: str) -> bool:
+    :param jwks: JSON Web Key Set dictionary
+    :return: The KeySet for the JWKS
+    """
+    global key_set
+    if 'key_set' not in globals() or key_set.jwks is not jwks:
+        key_set = KeySet(jwks)
+    return key_set
+
+
+@timed('VerifyToken')
+def verify_token(
+        authorization: str,
+        jwks: dict,
+        issuer: str,
+        refresh_jwks: Optional[Callable[[], dict]] = None) -> bool:
     """Verify that bearer token is valid
 
+    Tokens which have already been verified are remembered until they expire
+    so that a bearer token reused across many webhooks only has its signature
+    checked once.
+
     :param issuer: Expected issuer of the token
     :param jwks: JSON Web Key Set to verify the token against
     :param authorization: Bearer token
+    :param refresh_jwks: Optional function that fetches a fresh JWKS which is
+        called when the token is signed by a key that isn't in jwks
     :return: True if the token is valid otherwise False
     """
-    if (len(authorization.split()) != 2
-            or authorization.split()[0].lower() != 'bearer'):
-        logger.error("Invalid authorization header {}".format(authorization))
+    # jose is imported on first use to keep it off the cold start path of
+    # requests that don't verify tokens
+    from jose import jwt, exceptions
+    parts = authorization.split() if authorization else []
+    if len(parts) != 2 or parts[0].lower() != 'bearer':
+        logger.error("Invalid authorization header of type %s",
+                     parts[0] if parts else None)
         return False
 
-    token = authorization.split()[1]
+    token = parts[1]
+    cache_key = VERIFIED_TOKENS.key(
+        token, issuer, CONFIG.notification_audience)
+    if VERIFIED_TOKENS.get(cache_key):
+        return True
     try:
+        kid = jwt.get_unverified_header(token).get('kid')
+        key = get_key_set(jwks).get(kid)
+        if key is None and kid is not None and refresh_jwks is not None:
+            logger.info(
+                'Bearer token signed with unknown key %s, refreshing JWKS',
+                kid)
+            JWKS_STATS['refreshes'] += 1
+            jwks = refresh_jwks() or jwks
+            key = get_key_set(jwks).get(kid)
         id_token = jwt.decode(
             token=token,
-            key=jwks,
+            key=key[0] if key is not None else jwks,
+            algorithms=[key[1]] if key is not None else None,
             audience=CONFIG.notification_audience,
             issuer=issuer
         )
     except exceptions.JOSEError as e:
         logger.error(
-            "Invalid bearer token (issuer : {} audience : {}) : {} : "
-            "{}".format(issuer, CONFIG.notification_audience, token, e))
+            "Invalid bearer token (issuer : %s audience : %s) : %s",
+            issuer, CONFIG.notification_audience, e)
         return False
+    VERIFIED_TOKENS.put(cache_key, id_token.get('exp'))
     logger.debug(
-        "Bearer token verified successfully for issuer {} and audience "
-        "{}".format(issuer, CONFIG.notification_audience))
+        "Bearer token verified successfully for issuer %s and audience %s",
+        issuer, CONFIG.notification_audience)
     return True
 
 
-def get_authorization(
+def fetch_access_token(
         discovery_document: dict,
-        client_details: dict) -> Optional[str]:
-    """Call a token endpoint to provision an access token and return it
+        client_details: dict) -> Optional[dict]:
+    """Call a token endpoint to provision a new access token
 
     :param discovery_document: Discovery document containing the token endpoint
     :param client_details: A dictionary containing
                client_id: The OIDC client_id
                client_secret: The associated OIDC client_secret
                audience: The OIDC audience to provision the access token for
-    :return: An access token string
+    :return: A dictionary of the token and its expiry or None
     """
-    key = '-'.join([discovery_document['issuer'], client_details['audience']])
-    if (key in CONFIG.authorization
-            and CONFIG.authorization[key]['expiry'] - time.time()) > 300:
-        return CONFIG.authorization[key]['token']
-    # TODO : Now that we're caching access tokens in AWS Lambda global cache
-    # we may want to go further and persist the token into some data store
-    # as it's valid for 24 hours
+    from jose import jwt, exceptions
     if client_details.get('client_secret') is None:
         logger.error('Unable to fetch user profile without client_secret')
         return None
@@ -113,80 +220,227 @@ def get_authorization(
         'audience': client_details['audience'],
         'grant_type': 'client_credentials'
     }
-    response = requests.post(
+    response = http_request(
+        'POST',
         url=discovery_document['token_endpoint'],
         json=payload
     )
     if not response.ok:
         logger.error(
-            'Unable to fetch access token from {} with payload {} : {} '
-            '{}'.format(
-                discovery_document['token_endpoint'],
-                payload, response.status_code, response.text))
+            'Unable to fetch access token from %s with payload %s : %s %s',
+            discovery_document['token_endpoint'], payload,
+            response.status_code, response.text)
         return None
-    access_token = response.json().get('access_token')
-    token_type = response.json().get('token_type')
+    response_body = response.json()
+    access_token = response_body.get('access_token')
+    token_type = response_body.get('token_type')
 
     try:
         id_token = jwt.get_unverified_claims(token=access_token)
     except exceptions.JOSEError as e:
-        logger.error("Unable to parse token : {} : {}".format(access_token, e))
+        logger.error("Unable to parse access token from %s : %s",
+                     discovery_document['token_endpoint'], e)
+        return None
+    logger.debug('Access token fetched of type %s from %s with audience %s',
+                 token_type, discovery_document['token_endpoint'],
+                 client_details['audience'])
+    return {'token': access_token, 'expiry': id_token['exp']}
+
+
+@timed('GetAuthorization')
+def get_authorization(
+        discovery_document: dict,
+        client_details: dict) -> Optional[str]:
+    """Return a cached access token or provision a new one
+
+    Tokens are kept in the configured token store so that they can be shared
+    by other containers. Tokens are renewed once they are within the renew
+    margin of expiring, and only one caller renews a token at a time while
+    the others continue to use the current token.
+
+    :param discovery_document: Discovery document containing the token endpoint
+    :param client_details: A dictionary containing
+               client_id: The OIDC client_id
+               client_secret: The associated OIDC client_secret
+               audience: The OIDC audience to provision the access token for
+    :return: An access token string
+    """
+    key = '-'.join([discovery_document['issuer'], client_details['audience']])
+    renew_time = time.time() + CONFIG.token_renew_margin
+    entry = TOKEN_STORE.get(key, renew_time)
+    if entry is not None and entry['expiry'] > renew_time:
+        return entry['token']
+    usable_token = (
+        entry['token']
+        if entry is not None and entry['expiry'] - time.time() > 300
+        else None)
+    if TOKEN_STORE.acquire(key):
+        try:
+            # Another container may have renewed the token while we waited
+            entry = TOKEN_STORE.get(key, renew_time)
+            if entry is not None and entry['expiry'] > renew_time:
+                return entry['token']
+            entry = fetch_access_token(discovery_document, client_details)
+            if entry is None:
+                return usable_token
+            TOKEN_STORE.put(key, entry['token'], entry['expiry'])
+            return entry['token']
+        finally:
+            TOKEN_STORE.release(key)
+    elif usable_token is not None:
+        logger.debug('Using current access token for %s while it is renewed '
+                     'elsewhere', client_details['audience'])
+        return usable_token
+    # Wait for whoever holds the lease to store a new token
+    for _ in range(25):
+        time.sleep(0.2)
+        entry = TOKEN_STORE.get(key, time.time() + 300)
+        if entry is not None and entry['expiry'] - time.time() > 300:
+            return entry['token']
+    entry = fetch_access_token(discovery_document, client_details)
+    if entry is None:
         return None
-    logger.debug('Access token fetched of type {} from {} with audience '
-                 '{}'.format(token_type,
-                             discovery_document['token_endpoint'],
-                             client_details['audience']))
-    key = '-'.join([id_token['iss'], id_token['aud']])
-    if key not in CONFIG.authorization:
-        CONFIG.authorization[key] = {}
-    CONFIG.authorization[key]['expiry'] = id_token['exp']
-    CONFIG.authorization[key]['token'] = access_token
-    return access_token
+    TOKEN_STORE.put(key, entry['token'], entry['expiry'])
+    return entry['token']
 
 
+@timed('GetUserProfile')
 def get_user_profile(user_id: str) -> Optional[dict]:
     """Fetch the user profile from CIS PersonAPI for the user_id
 
+    Only the uuid and access_information attributes are kept. The response
+    is decoded once, or with PROFILE_FETCH set to "stream" and ijson
+    installed, parsed incrementally as it's read. Profiles are cached until
+    a new notification for the user invalidates them.
+
     :param user_id: A CIS user ID
-    :return:
+    :return: A profile of uuid and access_information or None
     """
+    if PROFILE_CACHE is not None:
+        profile = PROFILE_CACHE.get(user_id)
+        if profile is not None:
+            logger.debug('User profile for %s found in cache', user_id)
+            return profile
+    discovery_document = CONFIG.personapi_discovery_document
+    if discovery_document is None:
+        return None
     person_api_authorization = get_authorization(
-        CONFIG.personapi_discovery_document,
-        CONFIG.person_api)
+        discovery_document, CONFIG.person_api)
     if person_api_authorization is None:
         return None
     headers = {'authorization': 'Bearer {}'.format(person_api_authorization)}
-    url = 'https://person.{audience}/v2/user/user_id/{escaped_user_id}'.format(
-        audience=CONFIG.person_api['audience'],
+    url = '{personapi_url}/v2/user/user_id/{escaped_user_id}'.format(
+        personapi_url=CONFIG.personapi_url,
         escaped_user_id=urllib.parse.quote_plus(user_id)
     )
-    response = requests.get(url=url, headers=headers, params={'active': 'Any'})
-    if response.ok and response.json().get('uuid', {}).get('value'):
-        profile = response.json()
-        logger.debug('User profile successfully fetched from {}'.format(
-            url))
-        return profile
-    else:
+    stream = CONFIG.profile_fetch == 'stream' and ijson is not None
+    response = http_request(
+        'GET', url=url, headers=headers, params={'active': 'Any'},
+        stream=stream)
+    if not response.ok:
         logger.error(
-            'Unable to fetch valid user profile for {} from {} : {} {}'.format(
-                user_id, url, response.status_code, response.text))
+            'Unable to fetch user profile for %s from %s : %s %s',
+            user_id, url, response.status_code, response.text)
         return None
+    profile = read_profile(response, stream)
+    if profile is None or not profile['uuid'].get('value'):
+        logger.error('Unable to fetch valid user profile for %s from %s',
+                     user_id, url)
+        return None
+    logger.debug('User profile successfully fetched from %s', url)
+    if PROFILE_CACHE is not None:
+        PROFILE_CACHE.put(user_id, profile)
+    return profile
+
 
+def invalidate_user_profiles(notifications: list) -> None:
+    """Drop the cached profiles of the users in new CIS notifications
 
-def hack_user_id(user_id):
-    """Return a transformed user_id for LDAP users for the dev management API
+    A notification means the user's profile has changed, so it must be
+    fetched again rather than served from the cache
 
-    If the Auth0 CIS Webhook Consumer is POSTing changes to the auth-dev
-    Auth0 management API, then transform any LDAP user_id's from their prod
-    syntax to an equivalent dev syntax. This will enable querying the prod
-    PersonAPI while writing to the dev Management API
+    :param notifications: A list of CIS notifications, None for those which
+        were invalid
+    """
+    if PROFILE_CACHE is None:
+        return
+    for user_id in {notification.id for notification in notifications
+                    if notification is not None}:
+        PROFILE_CACHE.invalidate(user_id)
+
+
+def log_invocation_stats() -> None:
+    """Log the profile cache counts for the invocation and reset them, and
+    record the counts of every cache and the rate limiter as metrics"""
+    if PROFILE_CACHE is not None:
+        stats = PROFILE_CACHE.pop_stats()
+        logger.info('Profile cache : %s', stats)
+        METRICS.record_stats(
+            'ProfileCache',
+            {name: value for name, value in stats.items() if name != 'size'},
+            cumulative=False)
+    METRICS.record_stats('VerifiedTokenCache', VERIFIED_TOKENS.stats)
+    METRICS.record_stats('UrlCache', CONFIG.url_cache_stats)
+    METRICS.record_stats('Jwks', JWKS_STATS)
+    if GROUP_DIGESTS is not None:
+        METRICS.record_stats('GroupDigest', GROUP_DIGESTS.stats)
+    if DEDUP_STORE is not None:
+        METRICS.record_stats('Dedup', DEDUP_STORE.stats)
+    rate_limiters = [
+        rate_limiter for rate_limiter in [
+            AUTH0_RATE_LIMITER, *TARGET_RATE_LIMITERS.values()]
+        if rate_limiter is not None]
+    if rate_limiters:
+        METRICS.record_stats('RateLimiter', {
+            name: sum(rate_limiter.stats[name]
+                      for rate_limiter in rate_limiters)
+            for name in rate_limiters[0].stats})
+    METRICS.record_stats('CircuitBreaker', get_circuit_breaker_stats())
+
+
+def get_target_rate_limiter(target: dict) -> Optional[TokenBucket]:
+    """Return the rate limiter for a Management API target
+
+    Each Auth0 tenant has its own ratelimit so each target is paced by its
+    own token bucket
+
+    :param target: A Management API target from CONFIG.management_api_targets
+    :return: The target's token bucket or None if rate limiting is disabled
+    """
+    if target['name'] == DEFAULT_TARGET_NAME:
+        return AUTH0_RATE_LIMITER
+    if target['name'] not in TARGET_RATE_LIMITERS:
+        TARGET_RATE_LIMITERS.setdefault(target['name'], get_rate_limiter(
+            CONFIG.rate_limiter,
+            CONFIG.rate_limiter_table,
+            CONFIG.rate_limiter_initial_rate,
+            CONFIG.rate_limiter_initial_burst,
+            'auth0-management-api-ratelimit-{}'.format(target['name'])))
+    return TARGET_RATE_LIMITERS[target['name']]
+
+
+def hack_user_id(user_id: str, target: Optional[dict] = None) -> str:
+    """Return the user_id a Management API target knows the user by
+
+    A target with user_id_prefixes has the first prefix of the user_id found
+    in it replaced. Otherwise, if the Auth0 CIS Webhook Consumer is POSTing
+    changes to the auth-dev Auth0 management API, then transform any LDAP
+    user_id's from their prod syntax to an equivalent dev syntax. This will
+    enable querying the prod PersonAPI while writing to the dev Management API
 
     :param user_id: String of the user's user ID
+    :param target: The Management API target, the default one if not passed
     :return: Either the original user ID or a transformed user ID
     """
+    target = CONFIG.management_api if target is None else target
+    if target.get('user_id_prefixes') is not None:
+        for prefix, replacement in target['user_id_prefixes'].items():
+            if user_id.startswith(prefix):
+                return replacement + user_id[len(prefix):]
+        return user_id
     prod_ldap_user_id_prefix = 'ad|Mozilla-LDAP|'
     dev_ldap_user_id_prefix = 'ad|Mozilla-LDAP-Dev|'
-    issuer = CONFIG.management_api_discovery_document['issuer']
+    issuer = CONFIG.get_url(target['discovery_url'])['issuer']
     dev_issuer = 'https://dev.mozilla-dev.auth0.com/'
     if user_id.startswith(prod_ldap_user_id_prefix) and issuer == dev_issuer:
         # Hack to translate LDAP user IDs fetched from production and added to
@@ -194,49 +448,98 @@ def hack_user_id(user_id):
         result = "{}{}".format(
             dev_ldap_user_id_prefix,
             user_id[len(prod_ldap_user_id_prefix):])
-        logger.debug('Hacking user_id from {} to {}'.format(user_id, result))
+        logger.debug('Hacking user_id from %s to %s', user_id, result)
         return result
     else:
         return user_id
 
 
-def process_auth0_user(
+@timed('GetAuth0Groups')
+def get_auth0_groups(
+        url: str,
+        headers: dict,
+        rate_limiter: Optional[TokenBucket]) -> Optional[list]:
+    """Fetch the groups currently set on an Auth0 user
+
+    Requires the Auth0 Management API scope read:users
+
+    :param url: The Management API URL of the user
+    :param headers: Headers including the Management API authorization
+    :param rate_limiter: The rate limiter of the user's Auth0 tenant
+    :return: The list of groups in the user's app_metadata or None if the
+        user couldn't be fetched
+    """
+    if rate_limiter is not None:
+        wait = rate_limiter.reserve()
+        if wait:
+            time.sleep(wait)
+            METRICS.add_time('RateLimitSleep', wait * 1000)
+    response = rate_limited_request(
+        rate_limiter,
+        'GET',
+        url=url,
+        headers=headers,
+        params={'fields': 'app_metadata', 'include_fields': 'true'})
+    if not response.ok:
+        logger.error('Unable to fetch Auth0 user %s : %s %s',
+                     url, response.status_code, response.text)
+        return None
+    return response.json().get('app_metadata', {}).get('groups', [])
+
+
+def get_access_groups(profile: dict) -> list:
+    """Build the list of Auth0 groups from a CIS user profile
+
+    :param profile: A CIS user profile
+    :return: A list of group names
+    """
+    return GROUP_MAPPER.map(profile.get('access_information') or {})
+
+
+@timed('PrepareAuth0Update')
+def prepare_auth0_update(
         user_id: str,
         operation: str,
-        get_remaining_time_in_millis: Callable[[], int]) -> bool:
-    """Process the operation on the Auth0 user
+        target: Optional[dict] = None,
+        profile: Optional[dict] = None) -> Tuple[bool, Optional[dict]]:
+    """Fetch everything needed to perform the operation on the Auth0 user
 
-    Requires Auth0 Management API scopes
-    * update:users
-    * update:users_app_metadata
+    This includes the Management API access token and, for updates, the
+    user's profile from the PersonAPI
 
     :param user_id: The user's user ID
     :param operation: The operation to perform, "create", "update", "delete"
-    :param get_remaining_time_in_millis: Function that returns how much time
-        remains to complete execution
-    :return:
+    :param target: The Management API target to write to, the default one if
+        not passed
+    :param profile: The user's profile if it has already been fetched
+    :return: A tuple of whether processing has succeeded so far and the update
+        to send to the Management API, a dictionary of url, headers, payload,
+        rate_limiter and target name, or None if there is nothing to send
     """
     if operation == "create":
         # Would we ever want to trigger user creation in Auth0 because a CIS
         # profile was created? I'd imagine not, as the Auth0 management API
         # create only creates database and passwordless users
         logger.debug(
-            "Ignoring request to create {} as we don't do Auth0 user "
-            "creation".format(user_id))
-        return True
-
-    if CONFIG.management_api_discovery_document is None:
-        return False
+            "Ignoring request to create %s as we don't do Auth0 user "
+            "creation", user_id)
+        return True, None
+
+    target = CONFIG.management_api if target is None else target
+    discovery_document = CONFIG.get_url(target['discovery_url'])
+    if discovery_document is None:
+        return False, None
     auth0_management_api_authorization = get_authorization(
-        CONFIG.management_api_discovery_document,
-        CONFIG.management_api)
+        discovery_document, target)
     if auth0_management_api_authorization is None:
-        return False
+        return False, None
     headers = {'authorization': f'Bearer {auth0_management_api_authorization}'}
+    auth0_user_id = hack_user_id(user_id, target)
     url = '{issuer}api/v2/users/{escaped_user_id}'.format(
-        issuer=CONFIG.management_api_discovery_document['issuer'],
-        escaped_user_id=urllib.parse.quote_plus(hack_user_id(user_id))
+        issuer=discovery_document['issuer'],
+        escaped_user_id=urllib.parse.quote_plus(auth0_user_id)
     )
+    rate_limiter = get_target_rate_limiter(target)
 
     if operation == "delete":
         # https://github.com/mozilla-iam/auth0-deploy/blob/8659ce4cef35ac22e459b35c09ffcc038b7f9bf8/rules/activate-new-users-in-CIS.js#L36
@@ -246,68 +549,135 @@ def process_auth0_user(
             }
         }
     elif operation == "update":
-        profile = get_user_profile(user_id)
         if profile is None:
-            return False
-        access_groups = []
-        for publisher_name, data in profile.get(
-                'access_information', {}).items():
-            if data.get('values') is None:
-                continue
-            for value in data['values']:
-                if publisher_name == 'ldap':
-                    access_groups.append(value)
-                elif publisher_name == 'hris':
-                    # The hris section of access_information doesn't contain
-                    # groups, but instead contains employee_id, worker_type etc
-                    continue
-                elif publisher_name == 'access_provider':
-                    # The access_provider section of access_information doesn't
-                    # seem to contain groups (or anything)
-                    continue
-                else:
-                    # prepend "publisher_" to all groups except those from
-                    # the ldap publisher
-                    access_groups.append('_'.join([publisher_name, value]))
-
+            profile = get_user_profile(user_id)
+        if profile is None:
+            return False, None
+        access_groups = get_access_groups(profile)
         payload = {
             'app_metadata': {
                 'groups': access_groups
             }
         }
     else:
-        logger.error('Unknown operation {}'.format(operation))
-        return False
+        logger.error('Unknown operation %s', operation)
+        return False, None
 
     if CONFIG.user_whitelist is not None:
         if user_id in CONFIG.user_whitelist:
             logger.info(
-                'Performing Auth0 update on {} as the user is in the '
-                'whitelist'.format(user_id))
+                'Performing Auth0 update on %s as the user is in the '
+                'whitelist', user_id)
         else:
             logger.debug(
-                'Skipping Auth0 update on {} as the user is not in the '
-                'whitelist'.format(user_id))
-            return True
+                'Skipping Auth0 update on %s as the user is not in the '
+                'whitelist', user_id)
+            return True, None
+
+    digest = None
+    if GROUP_DIGESTS is not None:
+        digest_key = ''.join([discovery_document['issuer'], auth0_user_id])
+        if operation == "update":
+            digest = (digest_key, groups_digest(access_groups))
+            unchanged = GROUP_DIGESTS.is_unchanged(*digest)
+            if unchanged is None and CONFIG.group_digest_verify:
+                current_groups = get_auth0_groups(url, headers, rate_limiter)
+                unchanged = (current_groups is not None
+                             and groups_digest(current_groups) == digest[1])
+                if unchanged:
+                    GROUP_DIGESTS.put(*digest)
+                    GROUP_DIGESTS.stats['verified_skips'] += 1
+            if unchanged:
+                logger.debug(
+                    'Skipping Auth0 update on %s as their groups are '
+                    'unchanged', user_id)
+                return True, None
+        else:
+            GROUP_DIGESTS.delete(digest_key)
 
-    update_can_succeed = True
-    global last_auth0_request
-    if 'last_auth0_request' in globals():
-        if last_auth0_request.get('X-RateLimit-Remaining') == 0:
-            # No remaining requests available, sleep until there are
-            if not wait_for_ratelimit_reset(
-                    last_auth0_request.get('X-RateLimit-Reset'),
-                    get_remaining_time_in_millis):
-                update_can_succeed = False
+    return True, {'url': url, 'headers': headers, 'payload': payload,
+                  'digest': digest, 'rate_limiter': rate_limiter,
+                  'target': target['name']}
+
+
+def prepare_auth0_updates(
+        user_id: str,
+        operation: str) -> Tuple[bool, List[dict]]:
+    """Prepare the operation on the Auth0 user for every Management API
+    target
+
+    For updates the user's profile is fetched from the PersonAPI once and
+    shared by every target
 
+    :param user_id: The user's user ID
+    :param operation: The operation to perform, "create", "update", "delete"
+    :return: A tuple of whether processing has succeeded so far for every
+        target and the list of updates to send to the Management APIs
+    """
+    profile = None
+    if operation == "update":
+        profile = get_user_profile(user_id)
+        if profile is None:
+            return False, []
+    success = True
+    updates = []
+    for target in CONFIG.management_api_targets:
+        target_success, update = prepare_auth0_update(
+            user_id, operation, target, profile)
+        success = success and target_success
+        if update is not None:
+            updates.append(update)
+    return success, updates
+
+
+def get_target_executor() -> ThreadPoolExecutor:
+    """Return the thread pool used to send a user's updates to the
+    Management API targets after the first, creating it on first use"""
+    global target_executor
+    if 'target_executor' not in globals():
+        target_executor = ThreadPoolExecutor(
+            max_workers=CONFIG.management_api_concurrency * max(
+                CONFIG.management_api_target_count - 1, 1),
+            thread_name_prefix='target')
+    return target_executor
+
+
+@timed('SendAuth0Update')
+def send_auth0_update(
+        user_id: str,
+        update: dict,
+        get_remaining_time_in_millis: Callable[[], int]) -> bool:
+    """Send an update prepared by prepare_auth0_update to the Management API
+
+    :param user_id: The user's user ID
+    :param update: A dictionary of the url, headers and payload to PATCH and
+        optionally the rate_limiter to pace the call with
+    :param get_remaining_time_in_millis: Function that returns how much time
+        remains to complete execution
+    :return: True if the update succeeded otherwise False
+    """
+    url, headers, payload = update['url'], update['headers'], update['payload']
+    rate_limiter = update.get('rate_limiter', AUTH0_RATE_LIMITER)
+    update_can_succeed = True
     while update_can_succeed:
+        if rate_limiter is not None:
+            # Pace calls to stay within the ratelimit before Auth0 enforces it
+            wait = rate_limiter.reserve()
+            if wait and not wait_for(wait, get_remaining_time_in_millis):
+                rate_limiter.cancel()
+                update_can_succeed = False
+                break
         # https://auth0.com/docs/api/management/v2/#!/Users/patch_users_by_id
-        response = requests.patch(
+        response = rate_limited_request(
+            rate_limiter,
+            'PATCH',
             url=url,
             json=payload,
             headers=headers)
-        last_auth0_request = response.headers
         if response.status_code == 429:
+            METRICS.count('ManagementAPIRateLimited')
+            # Retrying as soon as the limiter allows mostly draws more 429s
+            # while Auth0's bucket is empty, so wait for it to reset
             update_can_succeed = wait_for_ratelimit_reset(
                 response.headers.get('X-RateLimit-Reset'),
                 get_remaining_time_in_millis)
@@ -315,19 +685,59 @@ def process_auth0_user(
             # We weren't ratelimited
             if not response.ok:
                 logger.critical(
-                    'Auth0 Management API profile update failed {} : {} : '
-                    '{}'.format(
-                        url,
-                        payload,
-                        response.text))
+                    'Auth0 Management API profile update failed %s : %s : '
+                    '%s', url, payload, response.text)
                 return False
             break
     if not update_can_succeed:
         logger.critical(
             'Currently ratelimited by Auth0. As a result this update to '
-            'Auth0 can not be sent and will be lost. The user is {} and the '
-            'update is : {}'.format(user_id, payload))
+            'Auth0 can not be sent now and will be lost unless a retry queue '
+            'is configured. The user is %s and the update is : %s',
+            user_id, payload)
         return False
-    logger.info('Successfully updated Auth0 user {} : {}'.format(
-        user_id, payload))
+    if update.get('digest') is not None and GROUP_DIGESTS is not None:
+        GROUP_DIGESTS.put(*update['digest'])
+    logger.info('Successfully updated Auth0 user %s : %s',
+                user_id, payload)
     return True
+
+
+@timed('ProcessAuth0User')
+def process_auth0_user(
+        user_id: str,
+        operation: str,
+        get_remaining_time_in_millis: Callable[[], int]) -> bool:
+    """Process the operation on the Auth0 user
+
+    Requires Auth0 Management API scopes
+    * update:users
+    * update:users_app_metadata
+
+    :param user_id: The user's user ID
+    :param operation: The operation to perform, "create", "update", "delete"
+    :param get_remaining_time_in_millis: Function that returns how much time
+        remains to complete execution
+    :return: True if the operation succeeded for every Management API target
+        otherwise False, including when an upstream timed out or its circuit
+        breaker is open
+    """
+    try:
+        success, updates = prepare_auth0_updates(user_id, operation)
+        if not updates:
+            return success
+        # The first update is sent from this thread while the rest are sent
+        # concurrently by the pool
+        futures = [
+            get_target_executor().submit(
+                send_auth0_update, user_id, update,
+                get_remaining_time_in_millis)
+            for update in updates[1:]]
+        results = [send_auth0_update(
+            user_id, updates[0], get_remaining_time_in_millis)]
+        results.extend(future.result() for future in futures)
+        return success and all(results)
+    except requests.RequestException as e:
+        logger.error('Unable to process %s for %s : %s',
+                     operation, user_id, e)
+        return False
@@ -0,0 +1,93 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Callable, Dict, Optional
+
+from . import utils
+from .config import CONFIG
+from .lambda_types import LambdaDict
+from .sessions import open_connection
+
+logger = logging.getLogger(__name__)
+
+
+def is_warm_up_event(event: LambdaDict) -> bool:
+    """Recognize a warm-up ping, an event with a "warm" field such as the
+    constant input {"warm": {}} of an Amazon EventBridge schedule"""
+    return isinstance(event, dict) and 'warm' in event
+
+
+def warm_notification_jwks() -> bool:
+    return CONFIG.notification_jwks is not None
+
+
+def warm_personapi_token() -> bool:
+    discovery_document = CONFIG.personapi_discovery_document
+    return discovery_document is not None and utils.get_authorization(
+        discovery_document, CONFIG.person_api) is not None
+
+
+def warm_personapi_connection() -> bool:
+    return open_connection(CONFIG.personapi_url)
+
+
+def warm_management_api_token(index: int) -> bool:
+    # Auth0's token endpoint is on the Management API's host, so fetching
+    # the token also opens the pooled connection that updates are sent on
+    target = CONFIG.management_api_targets[index]
+    discovery_document = CONFIG.get_url(target['discovery_url'])
+    return discovery_document is not None and utils.get_authorization(
+        discovery_document, target) is not None
+
+
+def get_warm_up_tasks() -> Dict[str, Callable[[], bool]]:
+    """Return every independent piece of work done ahead of the first
+    request, each a function returning whether it succeeded"""
+    tasks = {
+        'notification_jwks': warm_notification_jwks,
+        'personapi_token': warm_personapi_token,
+        'personapi_connection': warm_personapi_connection,
+    }
+    for index, name in enumerate(CONFIG.management_api_target_names):
+        tasks['management_api_token_{}'.format(name)] = (
+            lambda index=index: warm_management_api_token(index))
+    return tasks
+
+
+def run_task(name: str, task: Callable[[], bool]) -> bool:
+    try:
+        return bool(task())
+    except Exception as e:
+        logger.warning('Unable to warm up %s : %s', name, e)
+        return False
+
+
+def warm_up(timeout: Optional[float] = None) -> dict:
+    """Fetch the discovery documents, JWKS and access tokens and open the
+    pooled connections that requests need, all in parallel
+
+    Everything fetched is kept in the same caches that requests use, so on a
+    warm container this returns quickly. Client secrets are loaded by the
+    first task that needs them while the notification JWKS is fetched.
+    Tasks still running after the timeout are left to finish in the
+    background.
+
+    :param timeout: Seconds to wait for the tasks, WARM_UP_TIMEOUT if not
+        passed
+    :return: A dictionary of whether each task succeeded and the seconds
+        taken
+    """
+    start = time.perf_counter()
+    tasks = get_warm_up_tasks()
+    executor = ThreadPoolExecutor(
+        max_workers=len(tasks), thread_name_prefix='warm-up')
+    futures = {name: executor.submit(run_task, name, task)
+               for name, task in tasks.items()}
+    wait(futures.values(),
+         timeout=CONFIG.warm_up_timeout if timeout is None else timeout)
+    executor.shutdown(wait=False)
+    results = {name: future.done() and future.result()
+               for name, future in futures.items()}
+    seconds = round(time.perf_counter() - start, 3)
+    logger.info('Warmed up in %s seconds : %s', seconds, results)
+    return {'warm_up': results, 'seconds': seconds}
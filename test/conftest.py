@@ -0,0 +1,41 @@
+import os
+
+import pytest
+
+
+@pytest.fixture
+def aws_environment():
+    """Establish the fake AWS credentials that moto requires"""
+    os.environ['AWS_DEFAULT_REGION'] = 'us-west-2'
+    os.environ['AWS_ACCESS_KEY_ID'] = 'fake-access-key'
+    os.environ['AWS_SECRET_ACCESS_KEY'] = 'fake-secret-key'
+    os.environ['AWS_SECURITY_TOKEN'] = 'fake-security-token'
+    os.environ['AWS_SESSION_TOKEN'] = 'fake-session-token'
+    os.environ['ENVIRONMENT_NAME'] = 'testing'
+
+
+class FakeContext:
+    function_name = 'auth0-cis-webhook-consumer'
+
+    @staticmethod
+    def get_remaining_time_in_millis():
+        return 900000
+
+
+@pytest.fixture
+def lambda_context():
+    """An AWS Lambda context with plenty of time remaining"""
+    return FakeContext()
+
+
+@pytest.fixture
+def verified_app(monkeypatch):
+    """The app module with every bearer token accepted, so that POSTs reach
+    the processing of their notifications"""
+    from functions.auth0_cis_webhook_consumer import app
+    monkeypatch.setattr(app, 'verify_token', lambda *args: True)
+    monkeypatch.setattr(
+        type(app.CONFIG), 'notification_oidc_discovery_document',
+        {'issuer': 'https://auth.example.com/'})
+    monkeypatch.setattr(type(app.CONFIG), 'notification_jwks', {})
+    return app
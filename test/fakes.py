@@ -0,0 +1,12 @@
+class FakeResponse:
+    """A requests Response with a JSON body"""
+
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.body = body
+        self.headers = headers or {}
+        self.text = '' if body is None else str(body)
+
+    def json(self):
+        return self.body
@@ -0,0 +1,113 @@
+import json
+
+from moto import mock_aws
+
+from functions.auth0_cis_webhook_consumer.notifications import Notification
+
+
+@mock_aws
+def test_process_auth0_users_coalesces(
+        aws_environment, monkeypatch, lambda_context):
+    """Test that a batch runs a single operation for each user"""
+    from functions.auth0_cis_webhook_consumer import pipeline, utils
+    from functions.auth0_cis_webhook_consumer.metrics import METRICS
+    monkeypatch.setattr(METRICS, 'enabled', True)
+    METRICS.build_documents()
+    calls = []
+
+    def fake_prepare_auth0_updates(user_id, operation):
+        calls.append((user_id, operation))
+        return user_id != 'bad', []
+
+    monkeypatch.setattr(
+        utils, 'prepare_auth0_updates', fake_prepare_auth0_updates)
+    results = pipeline.process_auth0_users(
+        [Notification('a', 'update'),
+         Notification('a', 'delete'),
+         Notification('a', 'update'),
+         Notification('bad', 'update'),
+         Notification('c', 'create'),
+         Notification('c', 'update'),
+         None],
+        lambda_context.get_remaining_time_in_millis)
+    assert calls == [('a', 'delete'), ('bad', 'update'), ('c', 'update')]
+    assert results == [True, True, True, False, True, True, False]
+    assert METRICS.counts['CoalesceReceived'] == 6
+    assert METRICS.counts['CoalesceCollapsed'] == 3
+
+
+@mock_aws
+def test_large_batches_use_several_windows(
+        aws_environment, monkeypatch, lambda_context):
+    """Test that no more than COALESCE_MAX_USERS users are held at once"""
+    from functions.auth0_cis_webhook_consumer import pipeline, utils
+    monkeypatch.setattr(pipeline.CONFIG, 'coalesce_max_users', 2)
+    calls = []
+    monkeypatch.setattr(
+        utils, 'prepare_auth0_updates',
+        lambda user_id, operation: calls.append(user_id) or (True, []))
+    results = pipeline.process_auth0_users(
+        [Notification(user_id, 'update')
+         for user_id in ['a', 'b', 'a', 'c', 'a']],
+        lambda_context.get_remaining_time_in_millis)
+    assert calls == ['a', 'b', 'c', 'a']
+    assert results == [True] * 5
+
+
+@mock_aws
+def test_sqs_event_reports_failures(
+        aws_environment, monkeypatch, lambda_context):
+    """Test that failed SQS messages are reported as batch item failures"""
+    from functions.auth0_cis_webhook_consumer import app
+    monkeypatch.setattr(
+        app, 'process_auth0_users',
+        lambda notifications, _: [
+            n is not None and n.id == 'a' for n in notifications])
+    event = {'Records': [
+        {'messageId': '1', 'body': json.dumps(
+            {'id': 'a', 'operation': 'update'})},
+        {'messageId': '2', 'body': json.dumps(
+            {'id': 'b', 'operation': 'update'})},
+        {'messageId': '3', 'body': 'not json'}]}
+    response = app.lambda_handler(event, lambda_context)
+    assert response == {'batchItemFailures': [
+        {'itemIdentifier': '2'}, {'itemIdentifier': '3'}]}
+
+
+@mock_aws
+def test_profile_fetches_overlap_with_writes(
+        aws_environment, monkeypatch, lambda_context):
+    """Test that profile fetches and Management API writes run concurrently
+    within their per upstream limits"""
+    import threading
+    import time
+    from functions.auth0_cis_webhook_consumer import pipeline, utils
+    monkeypatch.setattr(utils.CONFIG, 'personapi_concurrency', 2)
+    monkeypatch.setattr(utils.CONFIG, 'management_api_concurrency', 1)
+    monkeypatch.delitem(pipeline.__dict__, 'executor', raising=False)
+    active = {'prepare': 0, 'send': 0}
+    peak = {'prepare': 0, 'send': 0, 'both': 0}
+    lock = threading.Lock()
+
+    def track(stage, result):
+        with lock:
+            active[stage] += 1
+            peak[stage] = max(peak[stage], active[stage])
+            if active['prepare'] and active['send']:
+                peak['both'] = 1
+        time.sleep(0.02)
+        with lock:
+            active[stage] -= 1
+        return result
+
+    monkeypatch.setattr(
+        utils, 'prepare_auth0_updates',
+        lambda user_id, operation: track('prepare', (True, [{}])))
+    monkeypatch.setattr(
+        utils, 'send_auth0_update',
+        lambda user_id, update, _: track('send', True))
+    results = pipeline.process_auth0_users(
+        [Notification(str(i), 'update') for i in range(8)],
+        lambda_context.get_remaining_time_in_millis)
+    assert results == [True] * 8
+    assert peak == {'prepare': 2, 'send': 1, 'both': 1}
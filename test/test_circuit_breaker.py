@@ -0,0 +1,29 @@
+import time
+
+from functions.auth0_cis_webhook_consumer.circuit_breaker import CircuitBreaker
+
+
+def test_circuit_opens_on_failures_and_probes_after_cooldown():
+    """Test that the circuit opens once enough calls fail, rejects calls while
+    open and lets a single probe through after the cooldown"""
+    breaker = CircuitBreaker(
+        'person.example.com', failure_rate=0.5, min_calls=4, window=4,
+        cooldown=0.05)
+    for success in (True, False, True):
+        assert breaker.allow()
+        breaker.record(success)
+    assert breaker.state == 'closed'
+    breaker.allow()
+    breaker.record(False)
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record(False)
+    assert breaker.state == 'open'
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record(True)
+    assert breaker.state == 'closed'
+    assert breaker.stats == {'opened': 2, 'rejected': 2}
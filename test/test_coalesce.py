@@ -0,0 +1,33 @@
+from functions.auth0_cis_webhook_consumer.coalesce import CoalescingWindow
+
+
+def test_operation_ordering():
+    """Test that delete beats update and update beats create"""
+    window = CoalescingWindow()
+    window.add('a', 'update')
+    window.add('a', 'delete')
+    window.add('a', 'update')
+    window.add('b', 'update')
+    window.add('b', 'create')
+    window.add('c', 'create')
+    assert window.drain() == [
+        ('a', 'a', 'delete'), ('b', 'b', 'update'), ('c', 'c', 'create')]
+    assert window.stats == {'received': 6, 'collapsed': 3, 'windows': 1}
+    assert len(window) == 0
+
+
+def test_unknown_operations_are_not_collapsed():
+    """Test that an unknown operation is kept apart from the user's others"""
+    window = CoalescingWindow()
+    assert window.add('a', 'update') == 'a'
+    assert window.add('a', 'merge') == ('a', 'merge')
+    assert [operation for _, _, operation in window.drain()] == [
+        'update', 'merge']
+
+
+def test_window_is_bounded():
+    """Test that a full window only accepts users it already holds"""
+    window = CoalescingWindow(max_size=1)
+    window.add('a', 'update')
+    assert not window.is_full('a', 'delete')
+    assert window.is_full('b', 'update')
@@ -1,3 +1,4 @@
+import json
 import pytest
 import os
 import boto3
@@ -33,9 +34,34 @@ def test_get_secret_value_success():
 
 
     """
-    Most of the work in Config happens in the constructor and
-    runs automatically when the object is created. 
+    Creating Config fetches nothing. Both client secrets are loaded by
+    get_secret_values the first time either client's details are read.
     """
     CONFIG = Config()
     assert CONFIG.person_api['client_secret'] == "person-secret-123"
     assert CONFIG.management_api['client_secret'] == "mgmt-secret-123"
+
+
+@mock_aws
+def test_secrets_are_fetched_once_on_first_use(aws_environment, monkeypatch):
+    """Test that secrets are fetched lazily in a single batch"""
+    from functions.auth0_cis_webhook_consumer import config
+    ssm = boto3.client('secretsmanager', region_name='us-west-2')
+    for name, value in (('personapi_client_secret', 'person-secret-123'),
+                        ('management_api_client_secret', 'mgmt-secret-123')):
+        secret_id = '/iam/cis/testing/auth0_cis_webhook_consumer/' + name
+        ssm.create_secret(
+            Name=secret_id, SecretString=json.dumps({secret_id: value}))
+    monkeypatch.delitem(
+        config.__dict__, 'secrets_manager_client', raising=False)
+    calls = []
+    original_get_secret_values = config.get_secret_values
+    monkeypatch.setattr(
+        config, 'get_secret_values',
+        lambda *args: calls.append(args) or original_get_secret_values(*args))
+
+    CONFIG = Config()
+    assert calls == []
+    assert CONFIG.person_api['client_secret'] == "person-secret-123"
+    assert CONFIG.management_api['client_secret'] == "mgmt-secret-123"
+    assert len(calls) == 1
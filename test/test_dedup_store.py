@@ -0,0 +1,105 @@
+import json
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from functions.auth0_cis_webhook_consumer.dedup_store import (
+    DynamoDBDedupStore,
+    MemoryDedupStore,
+    notification_key
+)
+from functions.auth0_cis_webhook_consumer.notifications import Notification
+
+
+def test_memory_store_claims_once():
+    """Test that a key is only claimed once until it's released"""
+    store = MemoryDedupStore()
+    key = notification_key(Notification('a', 'update', 1700000000))
+    assert key != notification_key(Notification('a', 'update', 1700000001))
+    assert notification_key(Notification('a', 'update')) is None
+    assert store.claim(key)
+    assert not store.claim(key)
+    store.release(key)
+    assert store.claim(key)
+    assert store.stats == {'claimed': 2, 'duplicates': 1, 'released': 1}
+
+
+@mock_aws
+def test_dynamodb_store_is_shared(aws_environment):
+    """Test that a notification claimed by one container is a duplicate in
+    another and that expired claims can be claimed again"""
+    boto3.client('dynamodb').create_table(
+        TableName='dedup',
+        KeySchema=[{'AttributeName': 'id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'id', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST')
+    first = DynamoDBDedupStore('dedup')
+    second = DynamoDBDedupStore('dedup')
+    assert first.claim('a')
+    assert not second.claim('a')
+    assert not first.claim('a')
+    first.release('a')
+    assert second.claim('a')
+    expired = DynamoDBDedupStore('dedup', ttl=-10)
+    assert expired.claim('b')
+    assert first.claim('b')
+
+
+@mock_aws
+def test_duplicate_post_is_not_processed(
+        aws_environment, monkeypatch, lambda_context, verified_app):
+    """Test that a redelivered notification skips all upstream work unless
+    the first delivery failed"""
+    from functions.auth0_cis_webhook_consumer import utils
+    app = verified_app
+    monkeypatch.setattr(utils, 'DEDUP_STORE', MemoryDedupStore())
+    monkeypatch.setattr(app, 'queue_retries', lambda *args: 0)
+    processed = []
+    outcomes = iter([False, True])
+    monkeypatch.setattr(
+        app, 'process_auth0_user',
+        lambda user_id, *args: processed.append(user_id) or next(outcomes))
+    monkeypatch.setattr(
+        app, 'process_auth0_users',
+        lambda notifications, _: [
+            processed.append(notification.id) or False
+            for notification in notifications])
+
+    def post(body):
+        return app.lambda_handler(
+            {'resource': '/{proxy+}', 'path': '/post', 'httpMethod': 'POST',
+             'headers': {'Authorization': 'Bearer x'},
+             'body': json.dumps(body)}, lambda_context)
+
+    notification = {'id': 'a', 'operation': 'update', 'time': 1700000000}
+    assert post(notification)['statusCode'] == 500
+    assert post(notification)['statusCode'] == 200
+    assert post(notification)['statusCode'] == 200
+    response = post([notification, dict(notification, id='b')])
+    assert [result['success'] for result in json.loads(response['body'])] == (
+        [True, False])
+    assert processed == ['a', 'a', 'b']
+    assert utils.DEDUP_STORE.stats['duplicates'] == 2
+
+
+def test_claims_are_released_when_processing_raises(monkeypatch):
+    """Test that notifications are processed again after processing them
+    raised rather than being skipped as duplicates"""
+    from functions.auth0_cis_webhook_consumer import pipeline, utils
+    monkeypatch.setattr(utils, 'DEDUP_STORE', MemoryDedupStore())
+    notifications = [Notification('a', 'update', 1700000000),
+                     Notification('b', 'update', 1700000000)]
+
+    def fail(new_notifications):
+        raise TypeError('no discovery document')
+
+    with pytest.raises(TypeError):
+        pipeline.skip_duplicates(notifications, fail)
+    processed = []
+    assert pipeline.skip_duplicates(
+        notifications,
+        lambda new_notifications: [
+            processed.append(notification.id) or True
+            for notification in new_notifications]) == [True, True]
+    assert processed == ['a', 'b']
@@ -0,0 +1,73 @@
+from moto import mock_aws
+
+from functions.auth0_cis_webhook_consumer.digest_cache import (
+    MemoryDigestStore,
+    groups_digest
+)
+
+from .fakes import FakeResponse
+
+
+def test_groups_digest_ignores_order():
+    """Test that the same set of groups always has the same digest"""
+    assert groups_digest(['b', 'a']) == groups_digest(['a', 'b', 'a'])
+    assert groups_digest(['a']) != groups_digest(['a', 'b'])
+
+
+@mock_aws
+def test_unchanged_groups_are_not_written(aws_environment, monkeypatch):
+    """Test that a PATCH is only sent when the user's groups change"""
+    from functions.auth0_cis_webhook_consumer import utils
+    store = MemoryDigestStore()
+    monkeypatch.setattr(utils, 'GROUP_DIGESTS', store)
+    monkeypatch.setattr(utils, 'AUTH0_RATE_LIMITER', None)
+    monkeypatch.setattr(utils.CONFIG, 'user_whitelist', None)
+    monkeypatch.setattr(utils.CONFIG, 'group_digest_verify', False)
+    monkeypatch.setattr(
+        utils.CONFIG, 'get_url',
+        lambda url, force=False: {'issuer': 'https://auth.example.com/'})
+    monkeypatch.setattr(utils, 'get_authorization', lambda *args: 'token')
+    profile = {'uuid': {'value': 'x'},
+               'access_information': {'ldap': {'values': {'team': None}}}}
+    monkeypatch.setattr(utils, 'get_user_profile', lambda user_id: profile)
+    patches = []
+    monkeypatch.setattr(
+        utils, 'http_request',
+        lambda method, **kwargs: patches.append(kwargs) or FakeResponse(200))
+
+    assert utils.process_auth0_user('ad|a', 'update', lambda: 900000)
+    assert utils.process_auth0_user('ad|a', 'update', lambda: 900000)
+    assert len(patches) == 1
+    assert store.stats['skipped_writes'] == 1
+
+    profile['access_information']['ldap']['values']['other'] = None
+    assert utils.process_auth0_user('ad|a', 'update', lambda: 900000)
+    assert len(patches) == 2
+
+
+@mock_aws
+def test_unknown_digest_is_verified(aws_environment, monkeypatch):
+    """Test that with verification enabled a cold cache checks Auth0 first"""
+    from functions.auth0_cis_webhook_consumer import utils
+    store = MemoryDigestStore()
+    monkeypatch.setattr(utils, 'GROUP_DIGESTS', store)
+    monkeypatch.setattr(utils, 'AUTH0_RATE_LIMITER', None)
+    monkeypatch.setattr(utils.CONFIG, 'user_whitelist', None)
+    monkeypatch.setattr(utils.CONFIG, 'group_digest_verify', True)
+    monkeypatch.setattr(
+        utils.CONFIG, 'get_url',
+        lambda url, force=False: {'issuer': 'https://auth.example.com/'})
+    monkeypatch.setattr(utils, 'get_authorization', lambda *args: 'token')
+    monkeypatch.setattr(
+        utils, 'get_user_profile',
+        lambda user_id: {'access_information': {
+            'mozilliansorg': {'values': {'nda': None}}}})
+    calls = []
+    monkeypatch.setattr(
+        utils, 'http_request',
+        lambda method, **kwargs: calls.append(method) or FakeResponse(
+            200, {'app_metadata': {'groups': ['mozilliansorg_nda']}}))
+
+    assert utils.process_auth0_user('ad|b', 'update', lambda: 900000)
+    assert calls == ['GET']
+    assert store.stats['verified_skips'] == 1
@@ -0,0 +1,44 @@
+import pytest
+
+from functions.auth0_cis_webhook_consumer.group_mapping import GroupMapper
+
+
+def test_default_rules():
+    """Test that the default rules prefix all publishers but ldap and skip
+    hris and access_provider"""
+    access_information = {
+        'ldap': {'values': {'team_a': None, 'team_b': None}},
+        'hris': {'values': {'employee_id': '1'}},
+        'access_provider': {'values': None},
+        'mozilliansorg': {'values': {'nda': None}},
+        'github': {'values': None}}
+    assert GroupMapper().map(access_information) == [
+        'team_a', 'team_b', 'mozilliansorg_nda']
+
+
+def test_configured_rules():
+    """Test include, exclude, regex, rename and prefix rules"""
+    mapper = GroupMapper({
+        'ldap': {'prefix': '', 'exclude_regex': '^vpn_',
+                 'rename': {'old': 'new'}},
+        'mozilliansorg': {'include': ['nda', 'staff'], 'prefix': 'm_'},
+        'github': {'include_regex': '^mozilla-iam/', 'exclude': [
+            'mozilla-iam/secret']},
+        '*': {'enabled': False}})
+    access_information = {
+        'ldap': {'values': {'old': None, 'vpn_x': None, 'team': None}},
+        'mozilliansorg': {'values': {'nda': None, 'other': None}},
+        'github': {'values': {'mozilla-iam/cis': None,
+                              'mozilla-iam/secret': None,
+                              'elsewhere/x': None}},
+        'unknown': {'values': {'ignored': None}}}
+    assert mapper.map(access_information) == [
+        'new', 'team', 'm_nda', 'github_mozilla-iam/cis']
+
+
+def test_invalid_rules_fail_at_compile_time():
+    """Test that mistakes in the rules are found when they're compiled"""
+    with pytest.raises(ValueError):
+        GroupMapper({'ldap': {'prefixx': ''}})
+    with pytest.raises(ValueError):
+        GroupMapper({'*': {'include_regex': '('}})
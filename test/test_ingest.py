@@ -0,0 +1,64 @@
+import json
+
+import boto3
+from moto import mock_aws
+
+
+def post_event(body):
+    return {'resource': '/{proxy+}', 'path': '/post', 'httpMethod': 'POST',
+            'headers': {'Authorization': 'Bearer x'},
+            'body': json.dumps(body)}
+
+
+def receive_all(queue_url):
+    bodies = []
+    while True:
+        messages = boto3.client('sqs').receive_message(
+            QueueUrl=queue_url, MaxNumberOfMessages=10).get('Messages', [])
+        if not messages:
+            return bodies
+        bodies.extend(json.loads(message['Body']) for message in messages)
+
+
+def not_processed(*args):
+    raise AssertionError('Queued notifications must not be processed')
+
+
+def patch_app(monkeypatch, app, queue_url):
+    from functions.auth0_cis_webhook_consumer import pipeline
+    monkeypatch.setattr(app.CONFIG, 'ingest_queue_url', queue_url)
+    monkeypatch.delitem(pipeline.__dict__, 'ingest_queue', raising=False)
+    monkeypatch.setattr(app, 'process_auth0_user', not_processed)
+    return app
+
+
+@mock_aws
+def test_post_is_queued_not_processed(
+        aws_environment, monkeypatch, lambda_context, verified_app):
+    """Test that with an ingest queue a notification is only queued"""
+    queue_url = boto3.client('sqs').create_queue(
+        QueueName='ingest')['QueueUrl']
+    app = patch_app(monkeypatch, verified_app, queue_url)
+    response = app.lambda_handler(
+        post_event({'id': 'a', 'operation': 'update', 'extra': 'x'}),
+        lambda_context)
+    assert response['statusCode'] == 202
+    assert receive_all(queue_url) == [{'id': 'a', 'operation': 'update'}]
+
+
+@mock_aws
+def test_batch_post_reports_invalid_notifications(
+        aws_environment, monkeypatch, lambda_context, verified_app):
+    """Test that a batch larger than one SQS call is queued and that invalid
+    notifications fail the POST"""
+    queue_url = boto3.client('sqs').create_queue(
+        QueueName='ingest')['QueueUrl']
+    app = patch_app(monkeypatch, verified_app, queue_url)
+    body = [{'id': str(i), 'operation': 'update'} for i in range(12)]
+    body.append({'id': 'missing operation'})
+    response = app.lambda_handler(post_event(body), lambda_context)
+    assert response['statusCode'] == 500
+    assert [result['queued'] for result in json.loads(response['body'])] == (
+        [True] * 12 + [False])
+    assert sorted(message['id'] for message in receive_all(queue_url)) == (
+        sorted(str(i) for i in range(12)))
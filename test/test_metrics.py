@@ -0,0 +1,68 @@
+import json
+import time
+
+from functions.auth0_cis_webhook_consumer.metrics import Metrics
+from functions.auth0_cis_webhook_consumer.profiler import SamplingProfiler
+
+
+def test_emf_documents():
+    """Test that timings, counts and upstream calls become EMF documents"""
+    metrics = Metrics(namespace='Test')
+    with metrics.timer('VerifyToken'):
+        pass
+    metrics.count('Notifications', 2)
+    metrics.record_upstream('person.example.com', 200, 12.5, retries=1)
+    metrics.record_upstream('person.example.com', 429, 3)
+    metrics.record_stats('Cache', {'hits': 3, 'stale_hits': 1})
+    metrics.record_stats('Cache', {'hits': 5, 'stale_hits': 1})
+
+    service, upstream = metrics.build_documents()
+    assert service['Service'] == 'auth0-cis-webhook-consumer'
+    assert len(service['VerifyToken']) == 1
+    assert service['Notifications'] == 2
+    assert service['CacheHits'] == 5
+    assert service['CacheStaleHits'] == 1
+    definition = service['_aws']['CloudWatchMetrics'][0]
+    assert definition['Namespace'] == 'Test'
+    assert definition['Dimensions'] == [['Service']]
+    assert {'Name': 'VerifyToken', 'Unit': 'Milliseconds'} in (
+        definition['Metrics'])
+
+    assert upstream['Upstream'] == 'person.example.com'
+    assert upstream['Latency'] == [12.5, 3]
+    assert upstream['Requests'] == 2
+    assert upstream['Status2xx'] == 1
+    assert upstream['Status429'] == 1
+    assert upstream['Retries'] == 1
+    assert metrics.build_documents() == []
+
+
+def test_disabled_metrics_record_nothing():
+    """Test that METRICS=none turns recording off"""
+    metrics = Metrics(enabled=False)
+    metrics.count('Notifications')
+    metrics.record_upstream('example.com', 200, 1)
+    assert metrics.build_documents() == []
+
+
+def test_handler_emits_emf(capsys):
+    """Test that each invocation writes its metrics to stdout"""
+    from functions.auth0_cis_webhook_consumer import app
+    app.lambda_handler(
+        {'resource': '/{proxy+}', 'httpMethod': 'POST', 'path': '/test',
+         'headers': {}, 'body': '{}'}, None)
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines()
+             if line.startswith('{')]
+    assert any('Handler' in line for line in lines)
+
+
+def test_sampling_profiler():
+    """Test that the profiler samples the stacks of running threads"""
+    profiler = SamplingProfiler(interval=0.001)
+    profiler.start()
+    deadline = time.time() + 0.05
+    while time.time() < deadline:
+        sum(range(1000))
+    profiler.stop()
+    assert any('test_sampling_profiler' in stack
+               for stack in profiler.stacks)
@@ -0,0 +1,74 @@
+import json
+
+import pytest
+
+from functions.auth0_cis_webhook_consumer.notifications import (
+    Notification,
+    hash_token,
+    parse_notifications
+)
+
+
+def test_parse_single_notification():
+    """Test that a single notification is parsed with its time and token"""
+    notifications, is_batch = parse_notifications(
+        json.dumps({'id': 'a', 'operation': 'update', 'time': 1700000000}),
+        hash_token('token'))
+    assert not is_batch
+    assert notifications == [Notification('a', 'update')]
+    assert notifications[0].timestamp == 1700000000
+    assert notifications[0].token_hash == hash_token('token')
+    assert not hasattr(notifications[0], '__dict__')
+
+
+def test_parse_batch_marks_invalid_notifications():
+    """Test that invalid entries in a batch become None"""
+    notifications, is_batch = parse_notifications(json.dumps(
+        [{'id': 'a', 'operation': 'delete'}, {'id': 'b'}, 'c']))
+    assert is_batch
+    assert notifications == [Notification('a', 'delete'), None, None]
+    assert notifications[0].to_dict() == {'id': 'a', 'operation': 'delete'}
+    with pytest.raises(ValueError):
+        parse_notifications('not json')
+
+
+def test_routes_and_headers(monkeypatch):
+    """Test that static paths are answered without reading the body and that
+    the authorization header is found in any case"""
+    from functions.auth0_cis_webhook_consumer import app
+    seen = []
+    monkeypatch.setitem(
+        app.ROUTES, '/post',
+        lambda event, context, authorization: seen.append(authorization)
+        or app.UPDATE_SUCCEEDED_RESPONSE)
+
+    def call(path, headers=None, method='POST'):
+        return app.process_api_call(
+            {'resource': '/{proxy+}', 'path': path, 'httpMethod': method,
+             'headers': headers, 'body': 'not json'}, None)['statusCode']
+
+    assert call('/test') == 200
+    assert call('/error') == 400
+    assert call('/missing') == 404
+    assert call('/post', method='GET') == 405
+    assert call('/post', {'Authorization': 'Bearer a'}) == 200
+    assert call('/post', {'aUTHORIZATION': 'Bearer b'}) == 200
+    assert call('/post') == 200
+    assert seen == ['Bearer a', 'Bearer b', None]
+
+
+def test_only_unparsable_bodies_are_reported_as_such(monkeypatch, caplog):
+    """Test that a ValueError raised after the body was parsed isn't
+    reported as an unparsable body, which would log the body"""
+    from functions.auth0_cis_webhook_consumer import app
+
+    def fail(event, context, authorization):
+        raise ValueError('downstream')
+
+    monkeypatch.setitem(app.ROUTES, '/post', fail)
+    response = app.process_api_call(
+        {'resource': '/{proxy+}', 'path': '/post', 'httpMethod': 'POST',
+         'headers': None, 'body': '{"id": "secret body"}'}, None)
+    assert response['statusCode'] == 500
+    assert 'downstream' in caplog.text
+    assert 'secret body' not in caplog.text
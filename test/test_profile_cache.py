@@ -0,0 +1,82 @@
+import json
+
+import boto3
+from moto import mock_aws
+
+from functions.auth0_cis_webhook_consumer.profile_cache import (
+    DynamoDBProfileCache,
+    MemoryProfileCache
+)
+
+PROFILE = {'uuid': {'value': 'x'}, 'access_information': {}}
+
+
+def test_memory_cache_is_bounded():
+    """Test that the least recently used and expired profiles are evicted"""
+    cache = MemoryProfileCache(ttl=300, max_size=2)
+    cache.put('a', PROFILE)
+    cache.put('b', PROFILE)
+    assert cache.get('a') == PROFILE
+    cache.put('c', PROFILE)
+    assert cache.get('b') is None
+    cache.invalidate('a')
+    assert cache.get('a') is None
+    assert cache.pop_stats() == {
+        'hits': 1, 'misses': 2, 'evictions': 1, 'invalidations': 1,
+        'size': 1}
+    assert cache.pop_stats()['hits'] == 0
+
+    expiring = MemoryProfileCache(ttl=-1)
+    expiring.put('a', PROFILE)
+    assert expiring.get('a') is None
+
+
+@mock_aws
+def test_dynamodb_cache(aws_environment):
+    """Test that profiles are shared through DynamoDB"""
+    boto3.client('dynamodb').create_table(
+        TableName='cache',
+        KeySchema=[{'AttributeName': 'id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'id', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST')
+    DynamoDBProfileCache('cache').put('a', PROFILE)
+    other_container = DynamoDBProfileCache('cache')
+    assert other_container.get('a') == PROFILE
+    other_container.invalidate('a')
+    assert DynamoDBProfileCache('cache').get('a') is None
+
+
+@mock_aws
+def test_notifications_invalidate_cached_profiles(
+        aws_environment, monkeypatch, lambda_context):
+    """Test that a cached profile is reused until a notification for the
+    user arrives"""
+    from functions.auth0_cis_webhook_consumer import app, utils
+    cache = MemoryProfileCache()
+    monkeypatch.setattr(utils, 'PROFILE_CACHE', cache)
+    monkeypatch.setattr(utils, 'get_authorization', lambda *args: 'token')
+    monkeypatch.setattr(
+        type(utils.CONFIG), 'person_api',
+        {'audience': 'example.com', 'discovery_url': 'https://x/'})
+    monkeypatch.setattr(utils.CONFIG, 'get_url', lambda url, force=False: {})
+    fetches = []
+
+    class FakeResponse:
+        ok = True
+        content = json.dumps(PROFILE).encode()
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(
+        utils, 'http_request',
+        lambda method, url, **kwargs: fetches.append(url) or FakeResponse())
+    assert utils.get_user_profile('a') == PROFILE
+    assert utils.get_user_profile('a') == PROFILE
+    assert len(fetches) == 1
+
+    monkeypatch.setattr(app, 'process_auth0_users', lambda *args: [True])
+    app.lambda_handler({'Records': [{'messageId': '1', 'body': json.dumps(
+        {'id': 'a', 'operation': 'update'})}]}, lambda_context)
+    assert utils.get_user_profile('a') == PROFILE
+    assert len(fetches) == 2
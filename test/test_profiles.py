@@ -0,0 +1,52 @@
+import io
+import json
+
+import pytest
+import requests
+
+from functions.auth0_cis_webhook_consumer.profiles import (
+    prune_profile,
+    read_profile,
+    stream_profile
+)
+
+PROFILE = {
+    'uuid': {'value': 'abc', 'metadata': {}, 'signature': {}},
+    'first_name': {'value': 'Jane', 'metadata': {}, 'signature': {}},
+    'identities': {'github_id_v3': {'value': '1'}},
+    'access_information': {
+        'ldap': {'values': {'team': None}, 'metadata': {'x': 1},
+                 'signature': {'publisher': {'value': 'sig'}}},
+        'mozilliansorg': {'values': None, 'metadata': {}}}}
+PRUNED = {
+    'uuid': {'value': 'abc', 'metadata': {}, 'signature': {}},
+    'access_information': {
+        'ldap': {'values': {'team': None}},
+        'mozilliansorg': {'values': None}}}
+
+
+def make_response(body: bytes) -> requests.Response:
+    response = requests.Response()
+    response.status_code = 200
+    response.raw = io.BytesIO(body)
+    return response
+
+
+def test_prune_profile():
+    """Test that only uuid and access_information values are kept"""
+    assert prune_profile(PROFILE) == PRUNED
+
+
+def test_read_profile():
+    """Test that a response is decoded and pruned"""
+    assert read_profile(make_response(json.dumps(PROFILE).encode())) == PRUNED
+    assert read_profile(make_response(b'not json')) is None
+
+
+def test_stream_profile():
+    """Test that incremental parsing keeps only the attributes used"""
+    pytest.importorskip('ijson')
+    body = json.dumps(PROFILE).encode()
+    assert stream_profile(io.BytesIO(body)) == PRUNED
+    assert read_profile(make_response(body), stream=True) == PRUNED
+    assert read_profile(make_response(b'{"uuid": '), stream=True) is None
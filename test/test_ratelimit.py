@@ -0,0 +1,97 @@
+import time
+
+import boto3
+import pytest
+import requests
+from moto import mock_aws
+
+from functions.auth0_cis_webhook_consumer import ratelimit
+from functions.auth0_cis_webhook_consumer.ratelimit import (
+    DynamoDBTokenBucket,
+    TokenBucket
+)
+
+
+def headers(limit, remaining, reset_in):
+    return {'X-RateLimit-Limit': str(limit),
+            'X-RateLimit-Remaining': str(remaining),
+            'X-RateLimit-Reset': str(int(time.time()) + reset_in)}
+
+
+def test_bucket_paces_calls_once_learned():
+    """Test that calls are delayed once the bucket learns it's empty"""
+    bucket = TokenBucket()
+    assert bucket.reserve() == 0
+    bucket.update(headers(10, 0, 2))
+    assert bucket.rate >= 5
+    first_wait = bucket.reserve()
+    second_wait = bucket.reserve()
+    assert 0 < first_wait < second_wait
+    assert bucket.stats['delayed'] == 2
+
+
+def test_bucket_allows_burst_while_tokens_remain():
+    """Test that calls aren't delayed while the server reports capacity"""
+    bucket = TokenBucket()
+    bucket.reserve()
+    bucket.update(headers(10, 5, 1))
+    assert [bucket.reserve() for _ in range(5)] == [0] * 5
+    assert bucket.reserve() > 0
+
+
+def test_failed_calls_stop_being_in_flight(monkeypatch):
+    """Test that cancelled reservations, and after a while those never
+    answered, aren't subtracted from the server's remaining count"""
+    bucket = TokenBucket()
+    for _ in range(3):
+        bucket.reserve()
+        bucket.cancel()
+    bucket.reserve()
+    bucket.update(headers(10, 5, 1))
+    assert bucket.state['tokens'] == 5
+    for _ in range(3):
+        bucket.reserve()
+    bucket.reserve()
+    bucket.update(headers(10, 5, 1))
+    assert bucket.state['tokens'] == 2
+    now = time.time()
+    monkeypatch.setattr(
+        ratelimit.time, 'time',
+        lambda: now + 2 * ratelimit.IN_FLIGHT_EXPIRY)
+    bucket.reserve()
+    bucket.update(headers(10, 5, 1))
+    assert bucket.state['tokens'] == 5
+
+
+def test_failed_request_cancels_its_reservation(monkeypatch):
+    """Test that a Management API call which raises ends its
+    reservation"""
+    from functions.auth0_cis_webhook_consumer import utils
+    bucket = TokenBucket()
+
+    def timeout(*args, **kwargs):
+        raise requests.Timeout('timed out')
+
+    monkeypatch.setattr(utils, 'http_request', timeout)
+    update = {'url': 'https://auth.example.com/api/v2/users/a',
+              'headers': {}, 'payload': {}, 'rate_limiter': bucket}
+    for _ in range(5):
+        with pytest.raises(requests.Timeout):
+            utils.send_auth0_update('a', update, lambda: 900000)
+    assert ratelimit.count_in_flight(bucket.state) == 0
+
+
+@mock_aws
+def test_dynamodb_bucket_is_shared(aws_environment):
+    """Test that containers sharing a DynamoDB bucket pace each other"""
+    boto3.client('dynamodb').create_table(
+        TableName='ratelimit',
+        KeySchema=[{'AttributeName': 'id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'id', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST')
+    first = DynamoDBTokenBucket('ratelimit')
+    second = DynamoDBTokenBucket('ratelimit')
+    first.reserve()
+    first.update(headers(10, 1, 60))
+    assert second.reserve() == 0
+    assert first.reserve() > 0
@@ -0,0 +1,168 @@
+from moto import mock_aws
+
+from .fakes import FakeResponse
+
+
+def profile(user_id, groups):
+    return {'user_id': {'value': user_id},
+            'access_information': {'ldap': {
+                'values': {group: None for group in groups}}}}
+
+
+PAGES = {
+    None: {'Items': [profile('ad|a', ['x']), profile('ad|b', ['y'])],
+           'nextPage': 'page2'},
+    'page2': {'Items': [profile('ad|c', ['z']), profile('ad|d', ['z'])],
+              'nextPage': None}}
+AUTH0_USERS = [
+    {'user_id': 'ad|a', 'app_metadata': {'groups': ['x']}},
+    {'user_id': 'ad|b', 'app_metadata': {'groups': []}},
+    {'user_id': 'ad|c', 'app_metadata': {'groups': ['old']}}]
+
+
+def setup(monkeypatch, tmp_path):
+    from functions.auth0_cis_webhook_consumer import reconcile, utils
+    monkeypatch.setattr(utils.CONFIG, 'user_whitelist', None)
+    monkeypatch.setattr(
+        utils.CONFIG, 'reconcile_checkpoint_location',
+        str(tmp_path / 'checkpoint.json'))
+    monkeypatch.setattr(
+        utils.CONFIG, 'get_url',
+        lambda url, force=False: {'issuer': 'https://auth.example.com/'})
+    monkeypatch.setattr(
+        type(utils.CONFIG), 'person_api',
+        {'audience': 'x', 'discovery_url': 'https://x/'})
+    monkeypatch.setattr(
+        type(utils.CONFIG), 'management_api', {'discovery_url': 'https://y/'})
+    monkeypatch.setattr(utils, 'get_authorization', lambda *args: 'token')
+    monkeypatch.setattr(utils, 'AUTH0_RATE_LIMITER', None)
+    monkeypatch.setattr(utils, 'GROUP_DIGESTS', None)
+    calls = []
+
+    def fake_http_request(method, url, **kwargs):
+        calls.append((method, url))
+        if url.startswith('https://person.'):
+            return FakeResponse(200, PAGES[kwargs['params'].get('nextPage')])
+        elif method == 'GET':
+            return FakeResponse(200, [
+                user for user in AUTH0_USERS
+                if '"{}"'.format(user['user_id']) in kwargs['params']['q']])
+        return FakeResponse(200, {})
+
+    monkeypatch.setattr(reconcile, 'http_request', fake_http_request)
+    monkeypatch.setattr(utils, 'http_request', fake_http_request)
+    return reconcile, calls
+
+
+@mock_aws
+def test_reconcile_writes_only_differences(
+        aws_environment, monkeypatch, tmp_path):
+    """Test that only Auth0 users whose groups differ are written"""
+    reconcile, calls = setup(monkeypatch, tmp_path)
+    checkpoint = reconcile.reconcile(lambda: 900000)
+    assert checkpoint['complete']
+    assert checkpoint['stats'] == {
+        'pages': 2, 'profiles': 4, 'unchanged': 1, 'missing': 1,
+        'written': 2, 'failed': 0}
+    assert sorted(url for method, url in calls if method == 'PATCH') == [
+        'https://auth.example.com/api/v2/users/ad%7Cb',
+        'https://auth.example.com/api/v2/users/ad%7Cc']
+    assert not (tmp_path / 'checkpoint.json').exists()
+
+
+@mock_aws
+def test_reconcile_resumes_from_checkpoint(
+        aws_environment, monkeypatch, tmp_path):
+    """Test that a reconciliation which runs out of time resumes from the
+    next page"""
+    reconcile, calls = setup(monkeypatch, tmp_path)
+    checkpoint = reconcile.reconcile(lambda: 1000, dry_run=True)
+    assert not checkpoint['complete']
+    assert checkpoint['next_page'] == 'page2'
+    assert checkpoint['stats']['written'] == 1
+
+    del calls[:]
+    checkpoint = reconcile.reconcile(lambda: 900000, dry_run=True)
+    assert checkpoint['complete']
+    assert checkpoint['stats']['pages'] == 2
+    assert checkpoint['stats']['written'] == 2
+    assert ('GET', 'https://person.x/v2/users') in calls
+    assert all(method == 'GET' for method, _ in calls)
+
+
+@mock_aws
+def test_reconcile_does_not_mix_dry_and_real_runs(
+        aws_environment, monkeypatch, tmp_path):
+    """Test that a paused dry run isn't resumed by a real run, which would
+    skip the pages the dry run didn't write, unless it's restarted"""
+    reconcile, calls = setup(monkeypatch, tmp_path)
+    reconcile.reconcile(lambda: 1000, dry_run=True)
+    checkpoint = reconcile.reconcile(lambda: 900000)
+    assert 'error' in checkpoint and checkpoint['progress'] == 0
+    checkpoint = reconcile.reconcile(lambda: 900000, restart=True)
+    assert checkpoint['complete'] and not checkpoint['dry_run']
+    assert checkpoint['stats']['pages'] == 2
+
+
+@mock_aws
+def test_handler_only_resumes_after_progress(
+        aws_environment, monkeypatch, tmp_path):
+    """Test that the function passes the checkpoint to the invocation that
+    resumes it, and doesn't invoke itself again when it made no progress"""
+    import json
+
+    import boto3
+    from functions.auth0_cis_webhook_consumer import app, utils
+    reconcile, calls = setup(monkeypatch, tmp_path)
+    invocations = []
+
+    class FakeLambda:
+        def invoke(self, **kwargs):
+            invocations.append(json.loads(kwargs['Payload']))
+
+    monkeypatch.setattr(boto3, 'client', lambda name: FakeLambda())
+
+    class ShortContext:
+        function_name = 'reconcile'
+
+        @staticmethod
+        def get_remaining_time_in_millis():
+            return 1000
+
+    app.lambda_handler({'reconcile': {'dry_run': True}}, ShortContext())
+    assert len(invocations) == 1
+    resume = invocations[0]['reconcile']
+    assert resume['dry_run'] is True
+    assert resume['checkpoint']['next_page'] == 'page2'
+
+    # Resuming on a container without the checkpoint file
+    (tmp_path / 'checkpoint.json').unlink()
+    monkeypatch.setattr(utils, 'get_authorization', lambda *args: None)
+    checkpoint = app.lambda_handler(invocations[0], ShortContext())
+    assert checkpoint['next_page'] == 'page2' and 'error' in checkpoint
+    assert len(invocations) == 1
+
+
+@mock_aws
+def test_reconcile_reports_page_fetch_errors(
+        aws_environment, monkeypatch, tmp_path):
+    """Test that a PersonAPI page which can't be fetched ends the
+    reconciliation with an error and a checkpoint to resume from"""
+    reconcile, calls = setup(monkeypatch, tmp_path)
+    fake_http_request = reconcile.http_request
+
+    def failing_http_request(method, url, **kwargs):
+        if kwargs.get('params', {}).get('nextPage') == 'page2':
+            return FakeResponse(503)
+        return fake_http_request(method, url, **kwargs)
+
+    monkeypatch.setattr(reconcile, 'http_request', failing_http_request)
+    checkpoint = reconcile.reconcile(lambda: 900000, dry_run=True)
+    assert 'error' in checkpoint and '503' in checkpoint['error']
+    assert checkpoint['progress'] == 1
+    assert checkpoint['next_page'] == 'page2'
+    assert not checkpoint['complete']
+
+    monkeypatch.setattr(reconcile, 'http_request', fake_http_request)
+    checkpoint = reconcile.reconcile(lambda: 900000, dry_run=True)
+    assert checkpoint['complete'] and checkpoint['stats']['pages'] == 2
@@ -0,0 +1,95 @@
+import io
+import json
+
+import pytest
+from moto import mock_aws
+
+
+@pytest.fixture(autouse=True)
+def restore_metrics(monkeypatch):
+    """Re-enable metrics after the replay CLI disables them"""
+    from functions.auth0_cis_webhook_consumer.metrics import METRICS
+    monkeypatch.setattr(METRICS, 'enabled', METRICS.enabled)
+
+
+@mock_aws
+def test_replay_writes_a_result_per_line(
+        aws_environment, monkeypatch, tmp_path):
+    """Test that every line of the event log is processed, including bare
+    user IDs, and that invalid lines are reported as failures"""
+    from functions.auth0_cis_webhook_consumer import replay, utils
+    processed = []
+    monkeypatch.setattr(
+        utils, 'process_auth0_user',
+        lambda user_id, operation, get_remaining_time_in_millis:
+        processed.append((user_id, operation)) or user_id != 'b')
+    events = tmp_path / 'events.jsonl'
+    events.write_text('\n'.join([
+        json.dumps({'id': 'a', 'operation': 'delete', 'time': 1700000000}),
+        '',
+        json.dumps('b'),
+        'not json',
+        json.dumps({'id': 'c'})]) + '\n')
+    output = tmp_path / 'results.jsonl'
+    status = replay.main([
+        str(events), '--output', str(output), '--workers', '2',
+        '--progress-interval', '0'])
+    results = sorted(
+        (json.loads(line) for line in output.read_text().splitlines()),
+        key=lambda result: result['line'])
+    assert status == 1
+    assert sorted(processed) == [('a', 'delete'), ('b', 'update')]
+    assert [(result['line'], result['success']) for result in results] == [
+        (1, True), (3, False), (4, False), (5, False)]
+    assert results[0]['id'] == 'a'
+
+
+@mock_aws
+def test_dry_run_reports_updates_without_sending(
+        aws_environment, monkeypatch):
+    """Test that a dry run prepares the updates, writes them to the output
+    and sends nothing"""
+    from functions.auth0_cis_webhook_consumer import replay, utils
+    monkeypatch.setattr(
+        utils, 'prepare_auth0_updates', lambda user_id, operation: (True, [{
+            'target': 'default', 'url': 'https://auth.example.com/a',
+            'headers': {'authorization': 'Bearer secret'},
+            'payload': {'app_metadata': {'groups': ['g']}}}]))
+    monkeypatch.setattr(
+        utils, 'send_auth0_update',
+        lambda *args: (_ for _ in ()).throw(AssertionError('sent')))
+    output = io.StringIO()
+    counts = replay.replay(
+        replay.read_notifications(io.StringIO('"a"\n'), 'update'), output,
+        dry_run=True, rate=100)
+    result = json.loads(output.getvalue())
+    assert counts == {'succeeded': 1, 'failed': 0}
+    assert result['updates'] == [{
+        'target': 'default', 'url': 'https://auth.example.com/a',
+        'payload': {'app_metadata': {'groups': ['g']}}}]
+    assert 'secret' not in output.getvalue()
+
+
+@mock_aws
+def test_replay_records_no_metrics(
+        aws_environment, monkeypatch, tmp_path, capsys):
+    """Test that metrics, which are never flushed by a replay, aren't
+    accumulated and that stdout only holds the results"""
+    from functions.auth0_cis_webhook_consumer import replay, utils
+    from functions.auth0_cis_webhook_consumer.metrics import METRICS, timed
+    METRICS.enabled = True
+    METRICS.flush()
+    capsys.readouterr()
+    monkeypatch.setattr(
+        utils, 'process_auth0_user',
+        timed('ProcessUser')(
+            lambda user_id, operation, get_remaining_time_in_millis:
+            METRICS.count('Processed') or True))
+    events = tmp_path / 'events.jsonl'
+    events.write_text('\n'.join(json.dumps(user_id) for user_id in 'abc'))
+    assert replay.main([str(events), '--progress-interval', '0']) == 0
+    assert not METRICS.timings and not METRICS.counts
+    METRICS.flush()
+    assert sorted(json.loads(line)['id']
+                  for line in capsys.readouterr().out.splitlines()) == [
+        'a', 'b', 'c']
@@ -0,0 +1,172 @@
+import json
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from functions.auth0_cis_webhook_consumer.notifications import Notification
+from functions.auth0_cis_webhook_consumer.retry_queue import (
+    FileRetryQueue,
+    SQSRetryQueue,
+    get_backoff
+)
+
+
+def test_get_backoff():
+    """Test that the retry delay doubles up to its maximum"""
+    assert [get_backoff(n, 30, 100) for n in range(1, 5)] == [30, 60, 100, 100]
+
+
+def test_file_queue_delays_and_claims(tmp_path):
+    """Test that file queue messages are only received once they're due and
+    by only one receiver"""
+    queue = FileRetryQueue(str(tmp_path))
+    queue.send({'id': 'a', 'operation': 'update'})
+    queue.send({'id': 'b', 'operation': 'update'}, delay=60)
+    messages = queue.receive()
+    assert [message for _, message in messages] == [
+        {'id': 'a', 'operation': 'update'}]
+    assert queue.receive() == []
+    queue.delete(messages[0][0])
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+def test_file_queue_reclaims_abandoned_messages(tmp_path):
+    """Test that a message which was received but never deleted returns to
+    the queue after the visibility timeout"""
+    queue = FileRetryQueue(str(tmp_path), visibility_timeout=-1)
+    queue.send({'id': 'a', 'operation': 'update'})
+    assert len(queue.receive()) == 1
+    assert queue.receive() == []
+    assert len(queue.receive()) == 1
+
+
+@mock_aws
+def test_sqs_queue(aws_environment):
+    """Test sending, receiving and deleting with an SQS queue"""
+    queue_url = boto3.client('sqs').create_queue(
+        QueueName='retry')['QueueUrl']
+    queue = SQSRetryQueue(queue_url)
+    queue.send({'id': 'a', 'operation': 'update', 'attempts': 1})
+    messages = queue.receive()
+    assert [message for _, message in messages] == [
+        {'id': 'a', 'operation': 'update', 'attempts': 1}]
+    queue.delete(messages[0][0])
+    assert 'Messages' not in boto3.client('sqs').receive_message(
+        QueueUrl=queue_url, VisibilityTimeout=0)
+
+
+@mock_aws
+def test_unparsable_messages_are_deleted(aws_environment, tmp_path):
+    """Test that messages which aren't JSON objects are dropped rather than
+    received again and again"""
+    sqs = boto3.client('sqs')
+    queue_url = sqs.create_queue(QueueName='retry')['QueueUrl']
+    for body in ('not json', '[1]'):
+        sqs.send_message(QueueUrl=queue_url, MessageBody=body)
+        (tmp_path / '0000000000.000000-{}.json'.format(len(body))).write_text(
+            body)
+    for queue in (SQSRetryQueue(queue_url),
+                  FileRetryQueue(str(tmp_path), visibility_timeout=-1)):
+        assert queue.receive() == []
+        assert queue.receive() == []
+    assert 'Messages' not in sqs.receive_message(
+        QueueUrl=queue_url, VisibilityTimeout=0)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_stray_files_are_skipped(tmp_path):
+    """Test that files in the queue directory which aren't messages don't
+    stop the messages from being received"""
+    queue = FileRetryQueue(str(tmp_path))
+    for name in ('notes.json', 'backup-copy.json', '.DS_Store'):
+        (tmp_path / name).write_text('{}')
+    queue.send({'id': 'a', 'operation': 'update'})
+    assert [message for _, message in queue.receive()] == [
+        {'id': 'a', 'operation': 'update'}]
+    assert (tmp_path / 'notes.json').exists()
+
+
+@mock_aws
+def test_failures_are_retried_then_dead_lettered(
+        aws_environment, monkeypatch, tmp_path, lambda_context):
+    """Test that failed notifications are queued, replayed with backoff and
+    moved to the dead-letter queue after the maximum attempts"""
+    from functions.auth0_cis_webhook_consumer import pipeline, utils
+    retry_queue = FileRetryQueue(str(tmp_path / 'retry'))
+    dead_letter_queue = FileRetryQueue(str(tmp_path / 'dead'))
+    monkeypatch.setitem(
+        pipeline.__dict__, 'retry_queues', (retry_queue, dead_letter_queue))
+    monkeypatch.setattr(pipeline.CONFIG, 'retry_backoff', 0)
+    monkeypatch.setattr(pipeline.CONFIG, 'retry_max_attempts', 3)
+    monkeypatch.setattr(
+        utils, 'prepare_auth0_updates',
+        lambda user_id, operation: (user_id == 'good', []))
+
+    notifications = [Notification('good', 'update'),
+                     Notification('bad', 'update'),
+                     Notification('bad', 'update')]
+    assert pipeline.queue_retries(notifications, [False, False, False]) == 2
+
+    stats = pipeline.replay_retry_queue(
+        lambda_context.get_remaining_time_in_millis)
+    assert stats == {
+        'replayed': 3, 'succeeded': 1, 'requeued': 1, 'dead_lettered': 1}
+    assert retry_queue.receive() == []
+    dead_letters = dead_letter_queue.receive()
+    assert [message for _, message in dead_letters] == [
+        {'id': 'bad', 'operation': 'update', 'attempts': 3}]
+
+
+def raise_type_error(*args):
+    raise TypeError('no discovery document')
+
+
+@pytest.mark.parametrize('process', [lambda *args: False, raise_type_error])
+@mock_aws
+def test_failed_post_is_queued(
+        aws_environment, monkeypatch, tmp_path, lambda_context, process,
+        verified_app):
+    """Test that a notification POSTed to /post which fails, or whose
+    processing raises, is queued"""
+    from functions.auth0_cis_webhook_consumer import pipeline
+    app = verified_app
+    retry_queue = FileRetryQueue(str(tmp_path))
+    monkeypatch.setitem(
+        pipeline.__dict__, 'retry_queues', (retry_queue, None))
+    monkeypatch.setattr(pipeline.CONFIG, 'retry_backoff', 0)
+    monkeypatch.setattr(app, 'process_auth0_user', process)
+    event = {'resource': '/{proxy+}', 'path': '/post', 'httpMethod': 'POST',
+             'headers': {'Authorization': 'Bearer x'},
+             'body': json.dumps({'id': 'a', 'operation': 'update'})}
+    assert app.lambda_handler(event, lambda_context)['statusCode'] == 500
+    assert [message for _, message in retry_queue.receive()] == [
+        {'id': 'a', 'operation': 'update', 'attempts': 1}]
+
+
+@mock_aws
+def test_replayed_notifications_refetch_profiles(
+        aws_environment, monkeypatch, tmp_path, lambda_context):
+    """Test that a replayed notification isn't processed with a profile
+    cached before it failed"""
+    from functions.auth0_cis_webhook_consumer import pipeline, utils
+    from functions.auth0_cis_webhook_consumer.profile_cache import (
+        MemoryProfileCache)
+    cache = MemoryProfileCache()
+    cache.put('a', {'stale': True})
+    monkeypatch.setattr(utils, 'PROFILE_CACHE', cache)
+    retry_queue = FileRetryQueue(str(tmp_path / 'retry'))
+    monkeypatch.setitem(
+        pipeline.__dict__, 'retry_queues', (retry_queue, None))
+    monkeypatch.setattr(pipeline.CONFIG, 'retry_backoff', 0)
+    cached = []
+    monkeypatch.setattr(
+        utils, 'prepare_auth0_updates',
+        lambda user_id, operation: (
+            cached.append(cache.get(user_id)) or True, []))
+
+    assert pipeline.queue_retries([Notification('a', 'update')], [False]) == 1
+    stats = pipeline.replay_retry_queue(
+        lambda_context.get_remaining_time_in_millis)
+    assert stats['succeeded'] == 1
+    assert cached == [None]
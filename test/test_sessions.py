@@ -0,0 +1,131 @@
+import pytest
+
+from functions.auth0_cis_webhook_consumer import sessions
+
+
+def test_sessions_are_shared_per_host():
+    """Test that one pooled session is reused for each host"""
+    first = sessions.get_session('https://person.example.com/v2/user/a')
+    second = sessions.get_session('https://person.example.com/v2/user/b')
+    other = sessions.get_session('https://auth.example.com/oauth/token')
+    assert first is second
+    assert first is not other
+    sessions.close_sessions()
+
+
+def test_http_request_sets_default_timeout(monkeypatch):
+    """Test that requests made through the pool always have a timeout"""
+    captured = {}
+
+    def fake_request(self, method, url, **kwargs):
+        captured.update(kwargs, method=method, url=url)
+        response = sessions.requests.Response()
+        response.status_code = 200
+        return response
+
+    monkeypatch.setattr(sessions.requests.Session, 'request', fake_request)
+    sessions.http_request('GET', 'https://person.example.com/')
+    assert captured['method'] == 'GET'
+    assert captured['timeout'] == (
+        sessions.HTTP_SETTINGS['connect_timeout'],
+        sessions.HTTP_SETTINGS['read_timeout'])
+    sessions.close_sessions()
+
+
+def fake_response(status_code):
+    def fake_request(self, method, url, **kwargs):
+        fake_request.timeouts.append(kwargs['timeout'])
+        response = sessions.requests.Response()
+        response.status_code = status_code
+        return response
+    fake_request.timeouts = []
+    return fake_request
+
+
+def test_read_timeout_adapts_to_latency(monkeypatch):
+    """Test that the read timeout shrinks towards a fast upstream's latency"""
+    fake_request = fake_response(200)
+    monkeypatch.setattr(sessions.requests.Session, 'request', fake_request)
+    for _ in range(3):
+        sessions.http_request('GET', 'https://person.example.com/')
+    assert fake_request.timeouts[0][1] == sessions.HTTP_SETTINGS['read_timeout']
+    assert fake_request.timeouts[-1][1] == (
+        sessions.HTTP_SETTINGS['min_read_timeout'])
+    sessions.close_sessions()
+
+
+def test_deadline_caps_and_stops_calls(monkeypatch):
+    """Test that timeouts end within the deadline and that no call starts
+    after it"""
+    fake_request = fake_response(200)
+    monkeypatch.setattr(sessions.requests.Session, 'request', fake_request)
+    sessions.set_deadline(500)
+    try:
+        sessions.http_request('GET', 'https://person.example.com/')
+        assert max(fake_request.timeouts[0]) <= 0.5
+        sessions.set_deadline(0)
+        with pytest.raises(sessions.DeadlineExceededError):
+            sessions.http_request('GET', 'https://person.example.com/')
+    finally:
+        sessions.set_deadline(None)
+        sessions.close_sessions()
+
+
+def test_open_circuit_fails_fast(monkeypatch):
+    """Test that calls to an upstream returning errors are stopped"""
+    fake_request = fake_response(503)
+    monkeypatch.setattr(sessions.requests.Session, 'request', fake_request)
+    min_calls = sessions.HTTP_SETTINGS['circuit_breaker_min_calls']
+    for _ in range(min_calls):
+        sessions.http_request('GET', 'https://person.example.com/')
+    with pytest.raises(sessions.CircuitOpenError):
+        sessions.http_request('GET', 'https://person.example.com/')
+    assert len(fake_request.timeouts) == min_calls
+    assert sessions.get_circuit_breaker_stats() == {
+        'opened': 1, 'rejected': 1}
+    sessions.close_sessions()
+
+
+def test_retry_sleeps_are_bounded(monkeypatch):
+    """Test that a Retry-After header can't make a retry sleep for longer
+    than the maximum or past the invocation's deadline"""
+
+    class FakeResponse:
+        headers = {'Retry-After': '120'}
+
+    retry = sessions.DeadlineRetry(total=2, backoff_factor=30)
+    retry = retry.increment('GET', '/')
+    retry = retry.increment('GET', '/')
+    assert retry.get_retry_after(FakeResponse()) == (
+        sessions.HTTP_SETTINGS['max_retry_after'])
+    sessions.set_deadline(1000)
+    try:
+        assert retry.get_retry_after(FakeResponse()) <= 1
+        assert retry.get_backoff_time() <= 1
+    finally:
+        sessions.set_deadline(None)
+
+
+def test_any_error_ends_a_circuit_probe(monkeypatch):
+    """Test that a probe which raises something other than a requests error
+    reopens the circuit rather than leaving it rejecting calls forever"""
+    fake_request = fake_response(503)
+    monkeypatch.setattr(sessions.requests.Session, 'request', fake_request)
+    for _ in range(sessions.HTTP_SETTINGS['circuit_breaker_min_calls']):
+        sessions.http_request('GET', 'https://person.example.com/')
+    breaker = sessions.get_upstream('person.example.com').circuit_breaker
+    breaker.cooldown = 0
+
+    def raise_value_error(self, method, url, **kwargs):
+        raise ValueError('from a hook')
+
+    monkeypatch.setattr(
+        sessions.requests.Session, 'request', raise_value_error)
+    with pytest.raises(ValueError):
+        sessions.http_request('GET', 'https://person.example.com/')
+    assert breaker.state == 'open'
+    monkeypatch.setattr(
+        sessions.requests.Session, 'request', fake_response(200))
+    sessions.http_request('GET', 'https://person.example.com/')
+    assert breaker.state == 'closed'
+    sessions.close_sessions()
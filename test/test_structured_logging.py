@@ -0,0 +1,96 @@
+import io
+import json
+import logging
+import random
+
+import pytest
+
+from functions.auth0_cis_webhook_consumer import structured_logging
+
+
+@pytest.fixture
+def log_stream():
+    """Route the root logger to a buffer, restoring its handlers after"""
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    stream = io.StringIO()
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(logging.StreamHandler(stream))
+    yield stream
+    structured_logging.stop_logging()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+
+
+def settings(**kwargs):
+    return dict({'level': 'DEBUG', 'format': 'json', 'debug_sample_rate': 1.0,
+                 'async': True}, **kwargs)
+
+
+def test_json_records_are_redacted(log_stream):
+    """Test that records are written as JSON with secrets removed once the
+    queue is flushed"""
+    structured_logging.configure_logging(settings())
+    log = logging.getLogger('test')
+    payload = {'client_id': 'abc', 'client_secret': 'hunter2'}
+    log.error('Unable to fetch token with payload %s', payload,
+              extra={'user_id': 'ad|jdoe'})
+    payload['client_id'] = 'changed after logging'
+    log.info('Header was Bearer abc.def and token eyJhbGci.eyJzdWIi.c2ln')
+    structured_logging.flush_logs()
+    first, second = [
+        json.loads(line) for line in log_stream.getvalue().splitlines()]
+    assert first['level'] == 'ERROR'
+    assert first['logger'] == 'test'
+    assert first['user_id'] == 'ad|jdoe'
+    assert first['location'].startswith('test_structured_logging.py:')
+    assert 'abc' in first['message']
+    assert 'hunter2' not in first['message']
+    assert 'abc.def' not in second['message']
+    assert 'eyJ' not in second['message']
+
+
+def test_text_format_and_sampling(log_stream):
+    """Test that the text format is synchronous and that DEBUG records are
+    sampled while INFO records always pass"""
+    structured_logging.configure_logging(
+        settings(format='text', debug_sample_rate=0, **{'async': False}))
+    log = logging.getLogger('test')
+    log.debug('dropped %s', 1)
+    log.info('always %s', 2)
+    output = log_stream.getvalue()
+    assert 'dropped' not in output
+    assert '[INFO]' in output and 'always 2' in output
+    sampling_filter = structured_logging.SamplingFilter(0.25)
+    debug = logging.LogRecord('test', logging.DEBUG, '', 0, '', None, None)
+    random.seed(0)
+    passed = sum(sampling_filter.filter(debug) for _ in range(1000))
+    assert 200 < passed < 300
+
+
+def test_reconfiguring_keeps_the_handler(log_stream):
+    """Test that configuring twice writes each record once to the same
+    handler"""
+    structured_logging.configure_logging(settings())
+    structured_logging.configure_logging(settings(level='INFO'))
+    logging.getLogger('test').debug('hidden')
+    logging.getLogger('test').info('shown')
+    structured_logging.flush_logs()
+    lines = log_stream.getvalue().splitlines()
+    assert [json.loads(line)['message'] for line in lines] == ['shown']
+
+
+def test_records_are_written_synchronously_by_default(
+        log_stream, monkeypatch):
+    """Test that without LOG_ASYNC records are written before the logging
+    call returns and no listener thread is started"""
+    monkeypatch.delenv('LOG_ASYNC', raising=False)
+    structured_logging.configure_logging(
+        structured_logging.get_logging_settings())
+    logging.getLogger('test').warning('written %s', 'now')
+    assert 'written now' in log_stream.getvalue()
+    assert '_listener' not in structured_logging.__dict__
@@ -0,0 +1,81 @@
+import threading
+
+from moto import mock_aws
+
+from functions.auth0_cis_webhook_consumer.ratelimit import TokenBucket
+
+
+class FakeResponse:
+    status_code = 200
+    ok = True
+    headers = {}
+    text = ''
+
+
+def patch_targets(monkeypatch, utils):
+    monkeypatch.setitem(
+        utils.CONFIG._management_api, 'discovery_url',
+        'https://auth.example.com/')
+    monkeypatch.setattr(utils.CONFIG, '_extra_management_apis', [{
+        'name': 'dev', 'client_id': 'dev-client', 'audience': 'dev',
+        'discovery_url': 'https://dev.example.com/',
+        'secret_name': 'management_api_client_secret_dev',
+        'user_id_prefixes': {'ad|Mozilla-LDAP|': 'ad|Mozilla-LDAP-Dev|'}}])
+    monkeypatch.setattr(utils.CONFIG, 'user_whitelist', None)
+    monkeypatch.setattr(
+        utils.CONFIG, 'get_url', lambda url, force=False: {'issuer': url})
+    monkeypatch.setattr(utils, 'AUTH0_RATE_LIMITER', TokenBucket())
+    monkeypatch.setattr(utils, 'TARGET_RATE_LIMITERS', {})
+    monkeypatch.setattr(utils, 'GROUP_DIGESTS', None)
+    monkeypatch.setattr(
+        utils, 'get_authorization',
+        lambda discovery_document, client_details: client_details['name'])
+
+
+@mock_aws
+def test_update_is_written_to_every_target(aws_environment, monkeypatch):
+    """Test that the profile is fetched once and written to every target with
+    its own user_id, token and rate limiter"""
+    from functions.auth0_cis_webhook_consumer import utils
+    patch_targets(monkeypatch, utils)
+    profile_fetches = []
+    monkeypatch.setattr(
+        utils, 'get_user_profile',
+        lambda user_id: profile_fetches.append(user_id) or {
+            'access_information': {'ldap': {'values': {'team': None}}}})
+    patches = []
+    lock = threading.Lock()
+
+    def fake_http_request(method, url, headers, **kwargs):
+        with lock:
+            patches.append((method, url, headers['authorization']))
+        return FakeResponse()
+
+    monkeypatch.setattr(utils, 'http_request', fake_http_request)
+    assert utils.process_auth0_user(
+        'ad|Mozilla-LDAP|jdoe', 'update', lambda: 900000)
+    assert profile_fetches == ['ad|Mozilla-LDAP|jdoe']
+    assert sorted(patches) == [
+        ('PATCH', 'https://auth.example.com/api/v2/users/'
+                  'ad%7CMozilla-LDAP%7Cjdoe', 'Bearer default'),
+        ('PATCH', 'https://dev.example.com/api/v2/users/'
+                  'ad%7CMozilla-LDAP-Dev%7Cjdoe', 'Bearer dev')]
+    assert utils.AUTH0_RATE_LIMITER.stats['reservations'] == 1
+    assert utils.TARGET_RATE_LIMITERS['dev'].stats['reservations'] == 1
+
+
+@mock_aws
+def test_one_failed_target_fails_the_notification(
+        aws_environment, monkeypatch):
+    """Test that the operation only succeeds if every target succeeded"""
+    from functions.auth0_cis_webhook_consumer import utils
+    patch_targets(monkeypatch, utils)
+
+    def fake_http_request(method, url, **kwargs):
+        response = FakeResponse()
+        if url.startswith('https://dev.example.com/'):
+            response.status_code, response.ok = 500, False
+        return response
+
+    monkeypatch.setattr(utils, 'http_request', fake_http_request)
+    assert not utils.process_auth0_user('ad|a', 'delete', lambda: 900000)
@@ -0,0 +1,80 @@
+import time
+
+import boto3
+from moto import mock_aws
+
+from functions.auth0_cis_webhook_consumer.token_store import (
+    DynamoDBTokenStore,
+    FileTokenStore,
+    MemoryTokenStore
+)
+
+DISCOVERY_DOCUMENT = {
+    'issuer': 'https://auth.example.com/',
+    'token_endpoint': 'https://auth.example.com/oauth/token'}
+CLIENT_DETAILS = {
+    'client_id': 'client', 'client_secret': 'secret',
+    'audience': 'api.example.com'}
+
+
+def test_file_store_is_shared(tmp_path):
+    """Test that a token stored by one container is read by another"""
+    first = FileTokenStore(str(tmp_path))
+    second = FileTokenStore(str(tmp_path))
+    first.put('key', 'token-1', int(time.time()) + 3600)
+    assert second.get('key')['token'] == 'token-1'
+    assert first.acquire('key')
+    assert not second.acquire('key')
+    first.release('key')
+    assert second.acquire('key')
+
+
+@mock_aws
+def test_dynamodb_store_is_shared(aws_environment):
+    """Test that tokens and leases are shared through DynamoDB"""
+    boto3.client('dynamodb').create_table(
+        TableName='tokens',
+        KeySchema=[{'AttributeName': 'id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'id', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST')
+    first = DynamoDBTokenStore('tokens')
+    second = DynamoDBTokenStore('tokens')
+    first.put('key', 'token-1', int(time.time()) + 3600)
+    assert second.get('key')['token'] == 'token-1'
+    assert first.acquire('key')
+    assert not second.acquire('key')
+    first.release('key')
+    assert second.acquire('key')
+
+
+@mock_aws
+def test_tokens_are_renewed_before_expiry(aws_environment, monkeypatch):
+    """Test that a token inside the renew margin is renewed and that the
+    current token is used while someone else renews it"""
+    from functions.auth0_cis_webhook_consumer import utils
+    store = MemoryTokenStore()
+    monkeypatch.setattr(utils, 'TOKEN_STORE', store)
+    monkeypatch.setattr(utils.CONFIG, 'token_renew_margin', 900)
+    minted = []
+
+    def fake_fetch_access_token(discovery_document, client_details):
+        minted.append(1)
+        return {'token': 'token-{}'.format(len(minted)),
+                'expiry': int(time.time()) + 86400}
+
+    monkeypatch.setattr(
+        utils, 'fetch_access_token', fake_fetch_access_token)
+    key = 'https://auth.example.com/-api.example.com'
+    store.put(key, 'old-token', int(time.time()) + 600)
+
+    assert store.acquire(key)
+    assert utils.get_authorization(
+        DISCOVERY_DOCUMENT, CLIENT_DETAILS) == 'old-token'
+    store.release(key)
+    assert minted == []
+
+    assert utils.get_authorization(
+        DISCOVERY_DOCUMENT, CLIENT_DETAILS) == 'token-1'
+    assert utils.get_authorization(
+        DISCOVERY_DOCUMENT, CLIENT_DETAILS) == 'token-1'
+    assert minted == [1]
@@ -0,0 +1,65 @@
+import time
+
+from functions.auth0_cis_webhook_consumer import url_cache
+from functions.auth0_cis_webhook_consumer.url_cache import UrlCache, get_ttl
+
+from .fakes import FakeResponse
+
+
+def fake_http(monkeypatch, responses):
+    calls = []
+
+    def fake_http_request(method, url, **kwargs):
+        calls.append(url)
+        return responses.pop(0)
+
+    monkeypatch.setattr(url_cache, 'http_request', fake_http_request)
+    return calls
+
+
+def test_get_ttl_honors_caching_headers():
+    """Test that Cache-Control and Expires headers set the TTL"""
+    assert get_ttl({'Cache-Control': 'public, max-age=600'}, 10) == 600
+    assert get_ttl({'Cache-Control': 'no-store'}, 10) is None
+    assert get_ttl({'Expires': 'Thu, 01 Jan 1970 00:00:00 GMT'}, 10) == 0
+    assert get_ttl({}, 10) == 10
+
+
+def test_stale_entries_are_served_while_refreshing(monkeypatch):
+    """Test that a stale document is returned while a new one is fetched"""
+    calls = fake_http(monkeypatch, [
+        FakeResponse(200, {'version': 1}, {'Cache-Control': 'max-age=0'}),
+        FakeResponse(200, {'version': 2})])
+    cache = UrlCache(min_ttl=0)
+    assert cache.get('https://example.com/jwks') == {'version': 1}
+    assert cache.get('https://example.com/jwks') == {'version': 1}
+    for _ in range(100):
+        if cache.get('https://example.com/jwks') == {'version': 2}:
+            break
+        time.sleep(0.01)
+    assert cache.get('https://example.com/jwks') == {'version': 2}
+    assert len(calls) == 2
+
+
+def test_failures_back_off(monkeypatch):
+    """Test that a failing URL isn't refetched until the backoff expires"""
+    calls = fake_http(monkeypatch, [
+        FakeResponse(503, 'unavailable'),
+        FakeResponse(200, {'issuer': 'https://auth.example.com/'})])
+    cache = UrlCache(negative_ttl=60)
+    assert cache.get('https://example.com/discovery') is None
+    assert cache.get('https://example.com/discovery') is None
+    assert len(calls) == 1
+    cache._entries['https://example.com/discovery']['retry_at'] = 0
+    assert cache.get('https://example.com/discovery') == {
+        'issuer': 'https://auth.example.com/'}
+
+
+def test_snapshot_is_shared_between_caches(monkeypatch, tmp_path):
+    """Test that a new cache loads documents saved by another cache"""
+    calls = fake_http(monkeypatch, [FakeResponse(200, {'keys': []})])
+    snapshot_path = str(tmp_path / 'urls.json')
+    UrlCache(snapshot_path=snapshot_path).get('https://example.com/jwks')
+    assert UrlCache(snapshot_path=snapshot_path).get(
+        'https://example.com/jwks') == {'keys': []}
+    assert len(calls) == 1
@@ -0,0 +1,83 @@
+import time
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwk, jwt
+from moto import mock_aws
+
+ISSUER = 'https://auth.example.com/'
+AUDIENCE = 'hook.example.com'
+
+
+def make_key(kid):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption())
+    public_jwk = jwk.construct(pem, 'RS256').public_key().to_dict()
+    public_jwk.update({'kid': kid, 'alg': 'RS256', 'use': 'sig'})
+    return pem, public_jwk
+
+
+def make_token(pem, kid, expiry):
+    return jwt.encode(
+        {'iss': ISSUER, 'aud': AUDIENCE, 'exp': expiry, 'sub': 'cis'},
+        pem, algorithm='RS256', headers={'kid': kid})
+
+
+@mock_aws
+def test_verified_tokens_are_cached(aws_environment, monkeypatch):
+    """Test that a reused bearer token only has its signature checked once"""
+    from functions.auth0_cis_webhook_consumer import utils
+    monkeypatch.setattr(utils.CONFIG, 'notification_audience', AUDIENCE)
+    utils.VERIFIED_TOKENS.clear()
+    pem, public_jwk = make_key('key-1')
+    jwks = {'keys': [public_jwk]}
+    token = make_token(pem, 'key-1', int(time.time()) + 3600)
+    decode_calls = []
+    original_decode = jwt.decode
+    monkeypatch.setattr(
+        jwt, 'decode',
+        lambda **kwargs: decode_calls.append(1) or original_decode(**kwargs))
+    hits = utils.VERIFIED_TOKENS.stats['hits']
+
+    assert utils.verify_token('Bearer {}'.format(token), jwks, ISSUER)
+    assert utils.verify_token('bearer {}'.format(token), jwks, ISSUER)
+    assert len(decode_calls) == 1
+    assert utils.VERIFIED_TOKENS.stats['hits'] == hits + 1
+    assert not utils.verify_token('Bearer {}'.format(token), jwks, 'other')
+    assert not utils.verify_token(None, jwks, ISSUER)
+
+
+@mock_aws
+def test_unknown_kid_refreshes_jwks(aws_environment, monkeypatch):
+    """Test that a token signed by a rotated key triggers a JWKS refresh"""
+    from functions.auth0_cis_webhook_consumer import utils
+    monkeypatch.setattr(utils.CONFIG, 'notification_audience', AUDIENCE)
+    utils.VERIFIED_TOKENS.clear()
+    old_pem, old_jwk = make_key('old')
+    new_pem, new_jwk = make_key('new')
+    token = make_token(new_pem, 'new', int(time.time()) + 3600)
+    refreshed = []
+
+    def refresh_jwks():
+        refreshed.append(1)
+        return {'keys': [old_jwk, new_jwk]}
+
+    assert utils.verify_token(
+        'Bearer {}'.format(token), {'keys': [old_jwk]}, ISSUER, refresh_jwks)
+    assert refreshed == [1]
+
+
+def test_expired_tokens_are_evicted():
+    """Test that cached tokens are dropped once they expire"""
+    from functions.auth0_cis_webhook_consumer.jwt_cache import (
+        VerifiedTokenCache)
+    cache = VerifiedTokenCache(max_size=2)
+    cache.put('expired', int(time.time()) - 1)
+    cache.put('a', int(time.time()) + 60)
+    cache.put('b', int(time.time()) + 60)
+    assert not cache.get('expired')
+    assert cache.get('a') and cache.get('b')
+    assert cache.stats == {'hits': 2, 'misses': 1, 'evictions': 1}
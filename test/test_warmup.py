@@ -0,0 +1,62 @@
+import threading
+
+from moto import mock_aws
+
+
+@mock_aws
+def test_warm_up_runs_tasks_in_parallel(aws_environment, monkeypatch):
+    """Test that every discovery document, JWKS, token and connection is
+    fetched concurrently and that one failure doesn't stop the others"""
+    from functions.auth0_cis_webhook_consumer import utils, warmup
+    monkeypatch.setattr(utils.CONFIG, '_extra_management_apis', [{
+        'name': 'dev', 'client_id': 'dev-client', 'audience': 'dev',
+        'discovery_url': 'https://auth.example.com/'}])
+    monkeypatch.setitem(
+        utils.CONFIG._management_api, 'discovery_url',
+        'https://missing.example.com/')
+    monkeypatch.setitem(
+        utils.CONFIG._person_api, 'discovery_url',
+        'https://auth.example.com/')
+    monkeypatch.setattr(
+        utils.CONFIG, 'notification_discovery_url',
+        'https://hook.example.com/')
+    documents = {
+        'https://hook.example.com/': {
+            'oidc_discovery_uri': 'https://hook.example.com/oidc'},
+        'https://hook.example.com/oidc': {
+            'jwks_uri': 'https://hook.example.com/jwks'},
+        'https://hook.example.com/jwks': {'keys': []},
+        'https://auth.example.com/': {'issuer': 'https://auth.example.com/'}}
+    monkeypatch.setattr(
+        utils.CONFIG, 'get_url',
+        lambda url, force=False: documents.get(url))
+    # Every token request waits for the others, so this only completes if
+    # they run at the same time
+    barrier = threading.Barrier(2, timeout=5)
+    monkeypatch.setattr(
+        utils, 'get_authorization',
+        lambda discovery_document, client_details:
+        barrier.wait() is not None and 'token')
+    connections = []
+    monkeypatch.setattr(
+        warmup, 'open_connection',
+        lambda url: connections.append(url) or True)
+    result = warmup.warm_up()
+    assert result['warm_up'] == {
+        'notification_jwks': True,
+        'personapi_token': True,
+        'personapi_connection': True,
+        'management_api_token_default': False,
+        'management_api_token_dev': True}
+    assert connections == [utils.CONFIG.personapi_url]
+
+
+@mock_aws
+def test_handler_answers_warm_up_pings(aws_environment, monkeypatch):
+    """Test that a warm-up ping only warms up and isn't routed"""
+    from functions.auth0_cis_webhook_consumer import app
+    monkeypatch.setattr(app, 'warm_up', lambda: {'warm_up': {}})
+    monkeypatch.setattr(
+        app, 'route_event',
+        lambda *args: (_ for _ in ()).throw(AssertionError('routed')))
+    assert app.lambda_handler({'warm': {}}, None) == {'warm_up': {}}